@@ -18,19 +18,21 @@ try:
     while True:
         time.sleep(1)
         print("Magna is Running...")
-        os.chdir(orig_image_path)
         file_names = os.listdir(orig_image_path)
         print(file_names)
         for name in file_names:
             compressor = Compression(comp_dir_path = comp_image_path)
-            compressed_file = compressor.compress(file = name, algorithm = compression_algorithm)
-            temp_array = ArrayND(original_image = name, compressed_image_path = comp_image_path + compressed_file)
+            compressed_file = compressor.compress(file = orig_image_path + name, algorithm = compression_algorithm)
+            temp_array = ArrayND(original_image = orig_image_path + name, compressed_image_path = comp_image_path + compressed_file)
             loss_model.update_array_list(temp_array)
-            loss_model.write_info(temp_array)
+            loss_model.write_info(temp_array, \
+            os.path.getsize(comp_image_path + compressed_file))
       
 except Exception as err:
     exception_type = type(err).__name__
     print(err)
     print("Magna is now Exiting.")
+finally:
+    loss_model.close()
 
 print(loss_model.image_arrays)
\ No newline at end of file
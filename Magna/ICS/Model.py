@@ -1,8 +1,432 @@
+import csv
+import math
 import matplotlib.pyplot as plt
 import numpy as np
 from astropy.io import fits
 from scipy import signal
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columns of a LossModel report, in order.
+REPORT_FIELDS = ("image", "factor", "original_min", "original_max", \
+"original_mean", "original_std", "compressed_min", "compressed_max", \
+"compressed_mean", "compressed_std", "residual_rms", "psnr", \
+"compressed_size")
+
+# Value stored for an empty cell (e.g. a compressed_size that was not given)
+# in npz reports, whose columns cannot hold None.
+MISSING = -1
+
+# Formats of ReportWriter. tsv is the format of the original text reports.
+REPORT_FORMATS = ("tsv", "csv", "npz", "parquet")
+
+# Default rows per write of each format. Text reports write every row, so no
+# row is lost if the report is never closed; npz reports are rewritten and
+# parquet reports get a row group on every write, so they are batched.
+BUFFER_ROWS = {"tsv": 1, "csv": 1, "npz": 256, "parquet": 256}
+
+# Number of pixels read at a time by fused_statistics, small enough for a
+# chunk and its float copies to stay in the CPU cache.
+CHUNK = 1 << 16
+
+# Distortions predicted by FidelityModel: the relative FLUX_AUTO and the
+# absolute ELLIPTICITY difference between a compressed and original source.
+TARGETS = ("flux", "ellipticity")
+
+# Inputs of FidelityModel, in the order of its feature vectors.
+INPUTS = ("factor", "median", "noise", "fwhm", "brightness")
+
+# Pairs of inputs multiplied in the degree 2 features of FidelityModel.
+PAIRS = np.triu_indices(len(INPUTS))
+
+# SE_Comparison parameter index of FLUX_AUTO and ELLIPTICITY.
+FLUX_INDEX = 1
+ELLIPTICITY_INDEX = 7
+
+
+def frame_statistics(image):
+    """
+    Returns the median and noise (the standard deviation estimated from the
+    median absolute deviation, which ignores the sources) of a frame.
+
+    @type image: Numpy Array
+    @rtype: Tuple[Float, Float]
+    """
+    median = np.median(image)
+    return float(median), float(1.4826 * np.median(np.abs(image - median)))
+
+
+class FidelityModel:
+    """
+    A surrogate model predicting the distortion a compression algorithm
+    causes to the sources of a frame, without compressing it or running
+    Source Extractor.
+
+    The model is trained on the trials of SE_Comparison runs. For each
+    algorithm it fits a ridge regression of the flux and ellipticity
+    distortion of every trial on the degree 2 polynomial features of INPUTS
+    (compression factor, median and noise of the frame, FWHM and brightness
+    of the source), which gives the bias, and a second one on the squared
+    residuals, which gives the scatter.
+
+    Predictions only take a few small NumPy products, and a trained model
+    is saved as a .npz file of its weights.
+    """
+    def __init__(self, alpha=1e-3):
+        """
+        Initializes a new, untrained, FidelityModel object.
+
+        @type self: FidelityModel
+        @type alpha: Float (Ridge regularization)
+        @rtype: None
+        """
+        self.alpha = alpha
+        # Algorithm to the list of (inputs, distortions) of its trials.
+        self.trials = {}
+        # Algorithm to (mean, scale, bias weights, scatter weights).
+        self.weights = {}
+
+    def add_trials(self, algorithm, inputs, og_flux, cs_flux, og_ellipticity, \
+    cs_ellipticity):
+        """
+        Adds trials of an algorithm to the training set. inputs are the
+        INPUTS of the trials, either one per trial or one for every trial.
+
+        @type self: FidelityModel
+        @type algorithm: String
+        @type inputs: Numpy Array (Shape (len(INPUTS),) or (trials, len(INPUTS)))
+        @type og_flux: Numpy Array
+        @type cs_flux: Numpy Array
+        @type og_ellipticity: Numpy Array
+        @type cs_ellipticity: Numpy Array
+        @rtype: None
+        """
+        og_flux = np.asarray(og_flux, dtype=float)
+        # Trials without original flux are left out below.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            distortions = np.column_stack([ \
+            (np.asarray(cs_flux, dtype=float) - og_flux) / og_flux, \
+            np.asarray(cs_ellipticity, dtype=float) - \
+            np.asarray(og_ellipticity, dtype=float)])
+        inputs = np.broadcast_to(np.asarray(inputs, dtype=float), \
+        (len(distortions), len(INPUTS)))
+        keep = (og_flux > 0) & np.all(np.isfinite(distortions), axis=1)
+        self.trials.setdefault(algorithm, []).append((inputs[keep], \
+        distortions[keep]))
+
+    def add_comparison(self, comparison, median, noise, fwhm, brightness):
+        """
+        Adds the trials of a single source SE_Comparison run (after
+        get_parameter), made with the given frame median and noise and
+        source FWHM and brightness.
+
+        @type self: FidelityModel
+        @type comparison: SE_Comparison
+        @type median: Float
+        @type noise: Float
+        @type fwhm: Float
+        @type brightness: Float
+        @rtype: None
+        """
+        self.add_trials(comparison.compression, [comparison.comp_f, median, \
+        noise, fwhm, brightness], comparison.og_dict[FLUX_INDEX], \
+        comparison.comp_dict[FLUX_INDEX], \
+        comparison.og_dict[ELLIPTICITY_INDEX], \
+        comparison.comp_dict[ELLIPTICITY_INDEX])
+
+    def features(self, algorithm, inputs):
+        """
+        Returns the degree 2 polynomial features of the standardized inputs.
+
+        @type self: FidelityModel
+        @type algorithm: String
+        @type inputs: Numpy Array (Shape (n, len(INPUTS)))
+        @rtype: Numpy Array
+        """
+        mean, scale = self.weights[algorithm][:2]
+        x = (inputs - mean) / scale
+        return np.hstack([np.ones((len(x), 1)), x, x[:, PAIRS[0]] * \
+        x[:, PAIRS[1]]])
+
+    def ridge(self, features, targets):
+        """
+        Returns the ridge regression weights of the targets on the features.
+        The constant feature is not regularized.
+
+        @type self: FidelityModel
+        @type features: Numpy Array
+        @type targets: Numpy Array
+        @rtype: Numpy Array
+        """
+        penalty = self.alpha * len(features) * np.eye(features.shape[1])
+        penalty[0, 0] = 0
+        return np.linalg.solve(features.T @ features + penalty, \
+        features.T @ targets)
+
+    def fit(self):
+        """
+        Trains the model of every algorithm with trials.
+
+        @type self: FidelityModel
+        @rtype: None
+        """
+        if not self.trials:
+            raise ValueError("No trials to train the model on.")
+        for algorithm, trials in self.trials.items():
+            inputs = np.vstack([trial[0] for trial in trials])
+            distortions = np.vstack([trial[1] for trial in trials])
+            if len(inputs) == 0:
+                continue
+            scale = inputs.std(axis=0)
+            scale[scale == 0] = 1
+            self.weights[algorithm] = (inputs.mean(axis=0), scale, None, None)
+            features = self.features(algorithm, inputs)
+            bias = self.ridge(features, distortions)
+            scatter = self.ridge(features, (distortions - features @ bias) ** 2)
+            self.weights[algorithm] = (inputs.mean(axis=0), scale, bias, scatter)
+
+    def predict(self, algorithm, factor, median, noise, fwhm, brightness):
+        """
+        Returns the predicted flux_bias, flux_scatter, ellipticity_bias and
+        ellipticity_scatter of the algorithm. The inputs may be numbers or
+        arrays (one prediction per element).
+
+        @type self: FidelityModel
+        @type algorithm: String
+        @type factor: Float or Numpy Array
+        @type median: Float or Numpy Array
+        @type noise: Float or Numpy Array
+        @type fwhm: Float or Numpy Array
+        @type brightness: Float or Numpy Array
+        @rtype: Dictionary
+        """
+        if algorithm not in self.weights:
+            raise ValueError("The model was not trained for " + algorithm)
+        values = (factor, median, noise, fwhm, brightness)
+        single = all(np.ndim(value) == 0 for value in values)
+        if single:
+            inputs = np.array([values], dtype=float)
+        else:
+            inputs = np.column_stack(np.broadcast_arrays(*values)).astype(float)
+        features = self.features(algorithm, inputs)
+        bias = features @ self.weights[algorithm][2]
+        scatter = np.sqrt(np.maximum(features @ self.weights[algorithm][3], 0))
+        if single:
+            bias, scatter = bias[0].tolist(), scatter[0].tolist()
+        else:
+            bias, scatter = bias.T, scatter.T
+        prediction = {}
+        for k, target in enumerate(TARGETS):
+            prediction[target + "_bias"] = bias[k]
+            prediction[target + "_scatter"] = scatter[k]
+        return prediction
+
+    def save(self, file):
+        """
+        Saves the weights of the trained model to a .npz file.
+
+        @type self: FidelityModel
+        @type file: String or File
+        @rtype: None
+        """
+        arrays = {"alpha": self.alpha, "algorithms": np.array(list(self.weights))}
+        for algorithm, weights in self.weights.items():
+            for name, array in zip(("mean", "scale", "bias", "scatter"), weights):
+                arrays[algorithm + "_" + name] = array
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        """
+        Loads a model saved by FidelityModel.save.
+
+        @type file: String or File
+        @rtype: FidelityModel
+        """
+        with np.load(file) as weights:
+            model = cls(weights["alpha"].item())
+            for algorithm in weights["algorithms"].tolist():
+                model.weights[algorithm] = tuple(weights[algorithm + "_" + \
+                name] for name in ("mean", "scale", "bias", "scatter"))
+        return model
+
+
+def fused_statistics(original, compressed, chunk=CHUNK):
+    """
+    Returns the min, max, mean and std of the original and compressed images
+    and the RMS of their residual and PSNR (in dB, over the range of the
+    original image), in a single pass over both images.
+
+    The images are read chunk pixels at a time, and the mean and std of the
+    chunks are merged with Chan's parallel form of Welford's algorithm, so
+    only a chunk at a time is ever converted to float.
+
+    @type original: Numpy Array
+    @type compressed: Numpy Array (Same size as original)
+    @type chunk: Int
+    @rtype: Dictionary
+    """
+    original = np.asarray(original).reshape(-1)
+    compressed = np.asarray(compressed).reshape(-1)
+    if original.size != compressed.size:
+        raise ValueError("The original and compressed images differ in size.")
+    if original.size == 0:
+        raise ValueError("The images are empty.")
+    # Count, min, max, mean and sum of squared deviations of each image.
+    moments = {"original": [0, math.inf, -math.inf, 0.0, 0.0], \
+    "compressed": [0, math.inf, -math.inf, 0.0, 0.0]}
+    squares = 0.0
+    for start in range(0, original.size, chunk):
+        pieces = {"original": original[start:start + chunk].astype(float), \
+        "compressed": compressed[start:start + chunk].astype(float)}
+        for name, values in pieces.items():
+            count, low, high, mean, m2 = moments[name]
+            n = len(values)
+            chunk_mean = values.mean()
+            deviations = values - chunk_mean
+            chunk_m2 = np.dot(deviations, deviations)
+            delta = chunk_mean - mean
+            total = count + n
+            moments[name] = [total, min(low, values.min()), \
+            max(high, values.max()), mean + delta * n / total, \
+            m2 + chunk_m2 + delta * delta * count * n / total]
+        residual = pieces["original"] - pieces["compressed"]
+        squares += np.dot(residual, residual)
+
+    statistics = {}
+    for name, (count, low, high, mean, m2) in moments.items():
+        statistics[name + "_min"] = low
+        statistics[name + "_max"] = high
+        statistics[name + "_mean"] = mean
+        statistics[name + "_std"] = math.sqrt(m2 / count)
+    rms = math.sqrt(squares / original.size)
+    peak = statistics["original_max"] - statistics["original_min"]
+    statistics["residual_rms"] = rms
+    statistics["psnr"] = 20 * math.log10(peak / rms) if rms > 0 and peak > 0 \
+    else math.inf
+    return statistics
+
+
+class ReportWriter:
+    """
+    Appends rows (dictionaries keyed by REPORT_FIELDS) to a report file that
+    stays open, writing them in batches of buffer_rows (BUFFER_ROWS of the
+    format by default). Cells holding None
+    are left empty (MISSING in npz reports).
+
+        tsv:     The text format of the original reports, one row per line
+                 after a "# " header of REPORT_FIELDS.
+        csv:     A csv table with a header.
+        npz:     A .npz file with one array per column. npz files cannot be
+                 appended to, so the whole file is rewritten on every flush.
+        parquet: A parquet table with one row group per flush (needs
+                 pyarrow).
+    """
+    def __init__(self, file, file_format=None, buffer_rows=None):
+        """
+        Initializes a new ReportWriter object. The format defaults to the
+        extension of file, or tsv.
+
+        @type self: ReportWriter
+        @type file: String
+        @type file_format: String or None (One of REPORT_FORMATS)
+        @type buffer_rows: Int or None (BUFFER_ROWS of the format if None)
+        @rtype: None
+        """
+        if file_format is None:
+            extension = file.rsplit(".", 1)[-1].lower()
+            file_format = extension if extension in REPORT_FORMATS else "tsv"
+        if file_format not in REPORT_FORMATS:
+            raise ValueError("file_format must be one of " + \
+            ", ".join(REPORT_FORMATS))
+        if file_format == "parquet" and pyarrow is None:
+            raise ImportError("Writing parquet reports needs pyarrow.")
+        self.file = file
+        self.file_format = file_format
+        self.buffer_rows = BUFFER_ROWS[file_format] if buffer_rows is None \
+        else buffer_rows
+        self.rows = []
+        self.columns = {field: [] for field in REPORT_FIELDS}
+        self.stream = None
+        self.writer = None
+
+    def write(self, row):
+        """
+        Adds a row to the report, flushing the buffered rows once there are
+        buffer_rows of them.
+
+        @type self: ReportWriter
+        @type row: Dictionary
+        @rtype: None
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows to the report file.
+
+        @type self: ReportWriter
+        @rtype: None
+        """
+        if not self.rows and self.file_format != "npz":
+            return
+        if self.file_format == "tsv":
+            if self.stream is None:
+                self.stream = open(self.file, "a")
+                if self.stream.tell() == 0:
+                    self.stream.write("# " + "\t ".join(REPORT_FIELDS))
+            self.stream.write("".join("\n" + "\t ".join("" if row[field] \
+            is None else str(row[field]) for field in REPORT_FIELDS) \
+            for row in self.rows))
+            self.stream.flush()
+        elif self.file_format == "csv":
+            if self.stream is None:
+                self.stream = open(self.file, "a", newline="")
+                self.writer = csv.DictWriter(self.stream, REPORT_FIELDS)
+                if self.stream.tell() == 0:
+                    self.writer.writeheader()
+            self.writer.writerows(self.rows)
+            self.stream.flush()
+        elif self.file_format == "npz":
+            for field in REPORT_FIELDS:
+                self.columns[field].extend(MISSING if row[field] is None \
+                else row[field] for row in self.rows)
+            np.savez(self.file, **{field: np.array(values) \
+            for field, values in self.columns.items()})
+        else:
+            if self.writer is None:
+                # compressed_size may be empty in the first rows, so its type
+                # is set rather than inferred.
+                schema = pyarrow.Table.from_pylist(self.rows).schema
+                schema = schema.set(schema.get_field_index("compressed_size"), \
+                pyarrow.field("compressed_size", pyarrow.int64()))
+                self.writer = pyarrow.parquet.ParquetWriter(self.file, schema)
+            self.writer.write_table(pyarrow.Table.from_pylist(self.rows, \
+            schema=self.writer.schema))
+        self.rows = []
+
+    def close(self):
+        """
+        Flushes the buffered rows and closes the report file.
+
+        @type self: ReportWriter
+        @rtype: None
+        """
+        self.flush()
+        if self.file_format == "parquet" and self.writer is not None:
+            self.writer.close()
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = None
+        self.writer = None
+
+
 class LossModel:
     """
     The modelling class which will be used to compare the original
@@ -13,26 +437,65 @@ class LossModel:
         (2) Power Spectrum Analysis
         (3) Image Reduction
     """
-    def __init__(self, text_report):
+    def __init__(self, text_report, file_format=None, buffer_rows=None):
         """
+        Initializes a new LossModel object which writes its report to
+        text_report through a ReportWriter.
+
+        @type self: LossModel
+        @type text_report: String
+        @type file_format: String or None (One of REPORT_FORMATS)
+        @type buffer_rows: Int or None (Rows written to the report at a time,
+        see BUFFER_ROWS)
+        @rtype: None
         """
         self.text_file = text_report
         self.image_arrays = []
+        self.report = ReportWriter(text_report, file_format, buffer_rows)
+
+    def write_info(self, image_array, compressed_size=None):
+        """
+        Adds the statistics of the original and compressed data of the image
+        array (see fused_statistics) and the size of its compressed file to
+        the report. The compressed_size column is left empty if the size is
+        not given.
+
+        Rows of npz and parquet reports are buffered, call close (or flush)
+        once every image is done.
 
-    def write_info(self, image_array):
+        @type self: LossModel
+        @type image_array: ImageArrayND
+        @type compressed_size: Int or None (Size of the compressed file in
+        bytes, e.g. os.path.getsize of it or the length of the compressed
+        bytes)
+        @rtype: Dictionary (The row written)
         """
+        row = {"image": image_array.image_name, \
+        "factor": image_array.compression_factor}
+        row.update(fused_statistics(image_array.original_data, \
+        image_array.compressed_data))
+        row["compressed_size"] = None if compressed_size is None else \
+        int(compressed_size)
+        self.report.write(row)
+        return row
+
+    def flush(self):
+        """
+        Writes the buffered rows to the report.
+
+        @type self: LossModel
+        @rtype: None
+        """
+        self.report.flush()
+
+    def close(self):
+        """
+        Writes the buffered rows to the report and closes it.
+
+        @type self: LossModel
+        @rtype: None
         """
-        file = open(self.text_file, 'a')
-        file.write('\n' + image_array.image_name + "\t " + str(image_array.compression_factor) \
-                                          + "\t " + str(np.min(image_array.original_data)) \
-                                          + "\t " + str(np.max(image_array.original_data)) \
-                                          + "\t " + str(np.mean(image_array.original_data)) \
-                                          + "\t " + str(np.std(image_array.original_data)) \
-                                          + "\t " + str(np.min(image_array.compressed_data)) \
-                                          + "\t " + str(np.max(image_array.compressed_data)) \
-                                          + "\t " + str(np.mean(image_array.compressed_data)) \
-                                          + "\t " + str(np.std(image_array.compressed_data)))
-        file.close()
+        self.report.close()
 
     def update_array_list(self, array):
         """
@@ -0,0 +1,177 @@
+import math
+import numpy as np
+import pytest
+
+from Model import FidelityModel, LossModel, ReportWriter, \
+fused_statistics, frame_statistics, ELLIPTICITY_INDEX, FLUX_INDEX, \
+MISSING, REPORT_FIELDS
+
+
+class Frame:
+    def __init__(self, name, original, compressed):
+        self.image_name = name
+        self.compression_factor = 4
+        self.original_data = original
+        self.compressed_data = compressed
+
+
+def frames():
+    rng = np.random.default_rng(0)
+    original = rng.integers(0, 60000, size=(300, 310)).astype(np.uint16)
+    return original, (original // 4 * 4).astype(np.uint16)
+
+
+def test_fused_statistics_matches_numpy():
+    original, compressed = frames()
+    statistics = fused_statistics(original, compressed, chunk=1000)
+    for name, data in (("original", original), ("compressed", compressed)):
+        assert statistics[name + "_min"] == data.min()
+        assert statistics[name + "_max"] == data.max()
+        assert statistics[name + "_mean"] == pytest.approx(data.mean(), \
+        rel=1e-12)
+        assert statistics[name + "_std"] == pytest.approx(data.std(), \
+        rel=1e-12)
+    residual = original.astype(float) - compressed
+    rms = np.sqrt(np.mean(residual ** 2))
+    assert statistics["residual_rms"] == pytest.approx(rms, rel=1e-12)
+    peak = float(original.max()) - float(original.min())
+    assert statistics["psnr"] == pytest.approx(20 * math.log10(peak / rms))
+
+
+def test_fused_statistics_identical_images():
+    original, compressed = frames()
+    statistics = fused_statistics(original, original)
+    assert statistics["residual_rms"] == 0
+    assert statistics["psnr"] == math.inf
+
+
+def test_fused_statistics_rejects_different_sizes():
+    with pytest.raises(ValueError):
+        fused_statistics(np.zeros(4), np.zeros(5))
+
+
+@pytest.mark.parametrize("file_format", ["tsv", "csv", "npz"])
+def test_report_rows(tmp_path, file_format):
+    original, compressed = frames()
+    report = str(tmp_path / ("report." + file_format))
+    model = LossModel(report, buffer_rows=2)
+    for i in range(3):
+        model.write_info(Frame("im" + str(i), original, compressed), 1000 + i)
+    model.close()
+    if file_format == "npz":
+        with np.load(report) as columns:
+            assert list(columns["compressed_size"]) == [1000, 1001, 1002]
+            assert list(columns["image"]) == ["im0", "im1", "im2"]
+    else:
+        lines = open(report).read().strip().splitlines()
+        rows = lines[1:]
+        assert len(rows) == 3
+        separator = "," if file_format == "csv" else "\t "
+        assert lines[0].lstrip("# ").split(separator) == list(REPORT_FIELDS)
+        assert rows[2].split(separator)[0] == "im2"
+        assert rows[2].split(separator)[-1] == "1002"
+        assert len(rows[0].split(separator)) == len(REPORT_FIELDS)
+
+
+@pytest.mark.parametrize("file_format", ["tsv", "csv"])
+def test_text_reports_write_every_row(tmp_path, file_format):
+    original, compressed = frames()
+    report = str(tmp_path / ("report." + file_format))
+    model = LossModel(report)
+    model.write_info(Frame("im0", original, compressed), 1000)
+    # Not closed: the row must already be in the file.
+    assert "im0" in open(report).read()
+    model.close()
+
+
+@pytest.mark.parametrize("file_format", ["tsv", "csv", "npz"])
+def test_report_without_compressed_size(tmp_path, file_format):
+    original, compressed = frames()
+    report = str(tmp_path / ("report." + file_format))
+    model = LossModel(report)
+    row = model.write_info(Frame("im0", original, compressed))
+    model.close()
+    assert row["compressed_size"] is None
+    if file_format == "npz":
+        with np.load(report) as columns:
+            assert list(columns["compressed_size"]) == [MISSING]
+    else:
+        last = open(report).read().splitlines()[-1]
+        separator = "," if file_format == "csv" else "\t "
+        assert last.split(separator)[-1] == ""
+        assert len(last.split(separator)) == len(REPORT_FIELDS)
+
+
+def test_report_writer_rejects_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        ReportWriter(str(tmp_path / "report.txt"), "xlsx")
+
+
+def synthetic_model(trials=4000, seed=0):
+    # Flux bias grows with the factor and its scatter with the noise, and the
+    # ellipticity is distorted by a fixed amount.
+    rng = np.random.default_rng(seed)
+    factor = rng.uniform(0, 8, trials)
+    noise = rng.uniform(10, 40, trials)
+    og_flux = rng.uniform(1000, 5000, trials)
+    cs_flux = og_flux * (1 + 0.01 * factor + 0.001 * noise * \
+    rng.standard_normal(trials))
+    og_ellipticity = rng.uniform(0, 0.5, trials)
+    model = FidelityModel()
+    model.add_trials("hcomp", np.column_stack([factor, \
+    np.full(trials, 1000), noise, np.full(trials, 5), \
+    np.full(trials, 200)]), og_flux, cs_flux, og_ellipticity, \
+    og_ellipticity + 0.02)
+    model.fit()
+    return model
+
+
+def test_fidelity_model_learns_the_distortion():
+    model = synthetic_model()
+    prediction = model.predict("hcomp", 4, 1000, 20, 5, 200)
+    assert prediction["flux_bias"] == pytest.approx(0.04, abs=2e-3)
+    assert prediction["flux_scatter"] == pytest.approx(0.02, abs=2e-3)
+    assert prediction["ellipticity_bias"] == pytest.approx(0.02, abs=1e-6)
+    assert prediction["ellipticity_scatter"] < 1e-3
+
+    batch = model.predict("hcomp", np.array([1, 4, 7]), 1000, 20, 5, 200)
+    assert batch["flux_bias"].shape == (3,)
+    assert batch["flux_bias"][1] == pytest.approx(prediction["flux_bias"])
+    assert np.all(np.diff(batch["flux_bias"]) > 0)
+    with pytest.raises(ValueError):
+        model.predict("bs", 4, 1000, 20, 5, 200)
+
+
+def test_fidelity_model_save_and_load(tmp_path):
+    model = synthetic_model(500)
+    model.save(str(tmp_path / "model.npz"))
+    loaded = FidelityModel.load(str(tmp_path / "model.npz"))
+    assert loaded.alpha == model.alpha
+    assert loaded.predict("hcomp", 3, 1000, 25, 5, 200) == \
+    model.predict("hcomp", 3, 1000, 25, 5, 200)
+
+
+def test_fidelity_model_add_comparison():
+    class Comparison:
+        compression = "bs"
+        comp_f = 3
+        og_dict = {FLUX_INDEX: [100.0, 200.0, 0.0], \
+        ELLIPTICITY_INDEX: [0.1, 0.2, 0.3]}
+        comp_dict = {FLUX_INDEX: [110.0, 220.0, 5.0], \
+        ELLIPTICITY_INDEX: [0.1, 0.25, 0.3]}
+    model = FidelityModel()
+    with pytest.raises(ValueError):
+        model.fit()
+    model.add_comparison(Comparison(), 1000, 29, 5, 200)
+    inputs, distortions = model.trials["bs"][0]
+    # The trial with no original flux is left out.
+    np.testing.assert_allclose(distortions, [[0.1, 0], [0.1, 0.05]])
+    np.testing.assert_array_equal(inputs, [[3, 1000, 29, 5, 200]] * 2)
+
+
+def test_frame_statistics():
+    image = np.random.default_rng(1).normal(500, 20, size=(300, 300))
+    image[100:110, 100:110] += 10000
+    median, noise = frame_statistics(image)
+    assert median == pytest.approx(500, abs=1)
+    assert noise == pytest.approx(20, rel=0.02)
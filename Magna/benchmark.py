@@ -0,0 +1,200 @@
+import argparse
+import csv
+import sys
+import time
+import tracemalloc
+import numpy as np
+from astropy.io import fits
+
+from image_compression import ImageCompression, as_integer_image, \
+quantize_bits, tile_compress, tile_decompress
+from fake_stars import FakeStars
+
+# Every tile compression algorithm supported by Astropy. BZIP2 is not one of
+# them, so it cannot be benchmarked here.
+TILE_ALGORITHMS = ['RICE_1', 'GZIP_1', 'GZIP_2', 'PLIO_1', 'HCOMPRESS_1']
+
+# Default lossy factors swept for each mode.
+HCOMP_SCALES = [0, 1, 2, 4, 8, 16]
+QUANTIZE_LEVELS = [16, 8, 4, 2, 1]
+SHAVE_BITS = [1, 2, 3, 4, 5]
+# Lossless algorithms applied to the bit shaved images.
+SHAVE_ALGORITHMS = ['RICE_1', 'GZIP_2']
+MASK_FACTORS = [1, 2, 4, 8]
+
+FIELDS = ['image', 'mode', 'algorithm', 'factor', 'raw_bytes', \
+'compressed_bytes', 'ratio', 'encode_mbs', 'decode_mbs', 'peak_mb']
+
+
+def measure(encode, decode, raw_bytes, repeat=1, trace_memory=True):
+    """
+    Times the encode and decode functions and returns the compressed size,
+    the encode and decode speeds (in MB/s of raw image) and the peak memory
+    (in MB) allocated while encoding and decoding.
+
+    The best time of repeat runs is used. The peak memory is measured on a
+    seperate run with tracemalloc, which sees every allocation made through
+    Python and NumPy but not the ones made inside cfitsio.
+
+    @type encode: Function (returns the compressed bytes)
+    @type decode: Function (takes the compressed bytes)
+    @type raw_bytes: Int (Size of the uncompressed image)
+    @type repeat: Int
+    @type trace_memory: Boolean
+    @rtype: Tuple
+    """
+    encode_time = decode_time = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        compressed = encode()
+        encode_time = min(encode_time, time.perf_counter() - start)
+        start = time.perf_counter()
+        decode(compressed)
+        decode_time = min(decode_time, time.perf_counter() - start)
+
+    peak = float('nan')
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            decode(encode())
+            peak = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+
+    mb = raw_bytes / 1e6
+    return len(compressed), mb / encode_time, mb / decode_time, peak
+
+
+def benchmark_image(data, name, hcomp_scales=HCOMP_SCALES, \
+quantize_levels=QUANTIZE_LEVELS, shave_bits=SHAVE_BITS, repeat=1, \
+trace_memory=True):
+    """
+    Benchmarks every tile compression algorithm and the bit shaving mode on
+    one image and returns a list of rows (dictionaries keyed by FIELDS).
+
+    HCOMPRESS_1 is swept over hcomp_scales. RICE_1, GZIP_1 and GZIP_2 are
+    swept over quantize_levels for float images and are lossless for integer
+    images. PLIO_1 is only run on non-negative integer images. Bit shaved
+    images are losslessly compressed with each of SHAVE_ALGORITHMS.
+
+    @type data: Numpy Array
+    @type name: String (Name of the image in the table)
+    @type hcomp_scales: List[Number]
+    @type quantize_levels: List[Number]
+    @type shave_bits: List[Int]
+    @type repeat: Int
+    @type trace_memory: Boolean
+    @rtype: List[Dictionary]
+    """
+    data = as_integer_image(data)
+    integer = data.dtype.kind in 'ui'
+    raw_bytes = data.nbytes
+    rows = []
+
+    def add(mode, algorithm, factor, encode):
+        size, encode_mbs, decode_mbs, peak = measure(encode, tile_decompress, \
+        raw_bytes, repeat, trace_memory)
+        rows.append({'image': name, 'mode': mode, 'algorithm': algorithm, \
+        'factor': factor, 'raw_bytes': raw_bytes, 'compressed_bytes': size, \
+        'ratio': raw_bytes / size, 'encode_mbs': encode_mbs, \
+        'decode_mbs': decode_mbs, 'peak_mb': peak})
+
+    for algorithm in TILE_ALGORITHMS:
+        if algorithm == 'HCOMPRESS_1':
+            for scale in hcomp_scales:
+                add('tile', algorithm, scale, lambda: tile_compress(data, \
+                algorithm, hcomp_scale=scale, hcomp_smooth=1))
+        elif algorithm == 'PLIO_1':
+            if integer and data.min() >= 0 and data.max() < 2**24:
+                add('tile', algorithm, '', lambda: tile_compress(data, \
+                algorithm))
+        elif integer:
+            add('tile', algorithm, '', lambda: tile_compress(data, algorithm))
+        else:
+            for level in quantize_levels:
+                add('tile', algorithm, level, lambda: tile_compress(data, \
+                algorithm, quantize_level=level))
+
+    for algorithm in SHAVE_ALGORITHMS:
+        for bits in shave_bits:
+            add('bs', algorithm, bits, lambda: tile_compress( \
+            quantize_bits(data.copy(), bits), algorithm))
+    return rows
+
+
+def benchmark_masking(image_file, cat, factors=MASK_FACTORS):
+    """
+    Benchmarks the masking mode of ImageCompression on a real fits image with
+    its SExtractor catalog. The compressed size is the H compressed image plus
+    the seperate source file. Masking does not decode anything, so the decode
+    speed is left blank.
+
+    @type image_file: String (Path of the fits image)
+    @type cat: String (Path of the test.cat file)
+    @type factors: List[Number]
+    @rtype: List[Dictionary]
+    """
+    rows = []
+    for factor in factors:
+        sbit = ImageCompression(image_file=image_file, cat=cat)
+        raw_bytes = sbit.original_image.nbytes
+        tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            sbit.masking(factor, save=False)
+            encode_time = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+        size = sbit.compressed_size + sbit.payload_size
+        rows.append({'image': image_file, 'mode': 'masking', \
+        'algorithm': 'HCOMPRESS_1', 'factor': factor, 'raw_bytes': raw_bytes, \
+        'compressed_bytes': size, 'ratio': raw_bytes / size, \
+        'encode_mbs': raw_bytes / 1e6 / encode_time, 'decode_mbs': '', \
+        'peak_mb': peak})
+    return rows
+
+
+def write_table(rows, file):
+    """
+    Writes the benchmark rows as a CSV table. file may be a path or an open
+    text file.
+
+    @type rows: List[Dictionary]
+    @type file: String or File
+    @rtype: None
+    """
+    if isinstance(file, str):
+        with open(file, 'w', newline='') as f:
+            write_table(rows, f)
+        return
+    writer = csv.DictWriter(file, fieldnames=FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the compression" \
+    " ratio and speed of every compression mode.")
+    parser.add_argument('images', nargs='*', help="fits images to benchmark")
+    parser.add_argument('--cat', help="SExtractor catalog of the images " \
+    "(enables the masking mode, one image only)")
+    parser.add_argument('--fake', type=int, default=1, help="number of " \
+    "FakeStars images to benchmark")
+    parser.add_argument('--size', type=int, nargs=2, default=[4400, 6650])
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('-o', '--output', help="CSV file (default: stdout)")
+    args = parser.parse_args()
+
+    rows = []
+    for i in range(args.fake):
+        fs = FakeStars("fakestar" + str(i), args.size[0], args.size[1])
+        fs.create_image(signal=150, btness=[1200, 1000, 800, 200])
+        fs.cap_pixel_value()
+        rows += benchmark_image(np.round(fs.return_image()), fs.name, \
+        repeat=args.repeat)
+    for image in args.images:
+        rows += benchmark_image(fits.getdata(image), image, repeat=args.repeat)
+        if args.cat:
+            rows += benchmark_masking(image, args.cat)
+    write_table(rows, args.output or sys.stdout)
@@ -0,0 +1,185 @@
+import os
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
+from astropy.io import fits
+from scipy.spatial import cKDTree
+
+# Number of parsed catalogs kept in memory.
+CACHE_SIZE = 64
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def _ascii_names(path):
+    """
+    Returns the column names of an ASCII_HEAD catalog, or None if the
+    catalog has no header. Vector parameters (e.g. FLUX_APER with several
+    apertures) are named FLUX_APER_1, FLUX_APER_2, ...
+
+    @type path: String
+    @rtype: List[String] or None
+    """
+    header = []
+    with open(path) as cat:
+        for line in cat:
+            if not line.startswith("#"):
+                break
+            fields = line[1:].split()
+            if len(fields) >= 2 and fields[0].isdigit():
+                header.append((int(fields[0]), fields[1]))
+    if not header:
+        return None
+    names = []
+    for i, (number, name) in enumerate(header):
+        following = header[i + 1][0] if i + 1 < len(header) else None
+        width = 1 if following is None else following - number
+        if width == 1:
+            names.append(name)
+        else:
+            names += [name + "_" + str(j + 1) for j in range(width)]
+    return names
+
+
+def _parse(path):
+    """
+    Parses a SExtractor catalog (ASCII, ASCII_HEAD or FITS_LDAC) into a 2D
+    float array and a record array viewing the same data.
+
+    @type path: String
+    @rtype: Tuple[Numpy Array, Numpy Record Array]
+    """
+    with open(path, "rb") as cat:
+        is_fits = cat.read(6) == b"SIMPLE"
+
+    if is_fits:
+        with fits.open(path) as hdu_list:
+            table = hdu_list["LDAC_OBJECTS"] if "LDAC_OBJECTS" in hdu_list \
+            else hdu_list[-1]
+            records = np.array(table.data)
+        scalar = [name for name in records.dtype.names \
+        if records.dtype[name].shape == ()]
+        data = np.column_stack([records[name].astype(float) \
+        for name in scalar]) if len(records) else np.zeros((0, len(scalar)))
+        records = records.view(np.recarray)
+    else:
+        data = np.loadtxt(path, comments="#", ndmin=2)
+        names = _ascii_names(path)
+        if names is None or len(names) != data.shape[1]:
+            names = ["COL" + str(i + 1) for i in range(data.shape[1])]
+        data = np.ascontiguousarray(data)
+        records = data.view([(name, float) for name in names]) \
+        .reshape(len(data)).view(np.recarray)
+
+    data.flags.writeable = False
+    records.flags.writeable = False
+    return data, records
+
+
+def _load(path):
+    """
+    Returns the parsed catalog at path, parsing it only if it is not cached
+    or if the file changed since it was parsed. A file counts as changed if
+    its inode, modification or change time, size or CRC32 checksum differs,
+    so a catalog rewritten in place with the same size and modification
+    time is parsed again.
+
+    @type path: String
+    @rtype: Tuple[Numpy Array, Numpy Record Array]
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with open(path, "rb") as cat:
+        checksum = zlib.crc32(cat.read())
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size, \
+    checksum)
+    with _lock:
+        cached = _cache.get(path)
+        if cached is not None and cached[0] == key:
+            _cache.move_to_end(path)
+            return cached[1]
+    parsed = _parse(path)
+    with _lock:
+        _cache[path] = (key, parsed)
+        _cache.move_to_end(path)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return parsed
+
+
+def read_catalog(path):
+    """
+    Returns the SExtractor catalog at path as a (read only) record array,
+    whose columns can be read by name, e.g. read_catalog("test.cat").FLUX_AUTO
+
+    Every catalog is only parsed once as long as the file does not change.
+
+    @type path: String (ASCII, ASCII_HEAD or FITS_LDAC catalog)
+    @rtype: Numpy Record Array
+    """
+    return _load(path)[1]
+
+
+def catalog_data(path):
+    """
+    Returns the SExtractor catalog at path as a (read only) 2D float array of
+    shape (number of sources, number of columns), like np.loadtxt(path,
+    ndmin=2) would.
+
+    Every catalog is only parsed once as long as the file does not change.
+
+    @type path: String (ASCII, ASCII_HEAD or FITS_LDAC catalog)
+    @rtype: Numpy Array
+    """
+    return _load(path)[0]
+
+
+def clear_cache():
+    """
+    Forgets every parsed catalog.
+
+    @rtype: None
+    """
+    with _lock:
+        _cache.clear()
+
+
+def match_catalogs(og_xy, cs_xy, radius=1.5):
+    """
+    Matches the sources of two catalogs by position, one to one.
+
+    Every pair of sources closer than radius is a candidate and the pairs
+    are taken from the closest to the furthest, skipping any source that was
+    already matched, so each source is matched at most once and to its
+    closest available partner.
+
+    Returns the indexes of the matched sources in each catalog (in order of
+    og_idx) and their separations.
+
+    @type og_xy: Numpy Array (Shape (N, 2), e.g. X_IMAGE and Y_IMAGE)
+    @type cs_xy: Numpy Array (Shape (M, 2))
+    @type radius: Float (Match radius in pixels)
+    @rtype: Tuple[Numpy Array, Numpy Array, Numpy Array]
+    """
+    og_xy = np.asarray(og_xy, dtype=float).reshape(-1, 2)
+    cs_xy = np.asarray(cs_xy, dtype=float).reshape(-1, 2)
+    if len(og_xy) == 0 or len(cs_xy) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, np.zeros(0)
+
+    pairs = cKDTree(og_xy).sparse_distance_matrix(cKDTree(cs_xy), radius, \
+    output_type="ndarray")
+    pairs = pairs[np.argsort(pairs["v"], kind="stable")]
+
+    og_used = np.zeros(len(og_xy), dtype=bool)
+    cs_used = np.zeros(len(cs_xy), dtype=bool)
+    matched = np.zeros(len(pairs), dtype=bool)
+    for k, (i, j) in enumerate(zip(pairs["i"].tolist(), pairs["j"].tolist())):
+        if not og_used[i] and not cs_used[j]:
+            og_used[i] = cs_used[j] = matched[k] = True
+
+    pairs = pairs[matched]
+    pairs = pairs[np.argsort(pairs["i"], kind="stable")]
+    return pairs["i"].astype(int), pairs["j"].astype(int), pairs["v"]
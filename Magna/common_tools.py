@@ -1,7 +1,11 @@
 from matplotlib import pyplot as plt
 import numpy as np, sys, os
 from astropy import units as u
-import math
+import math, threading
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
 from scipy.optimize import curve_fit
 plt.rcParams.update({'font.size': 14})
 from astropy.io import fits
@@ -35,17 +39,103 @@ def get_times(path):
         times.append(get_time(i))
     return times
 
+# Default memory cap (in bytes) of the BiasLibrary cache
+BIAS_CACHE = 2**31
+
+class BiasLibrary:
+    """The bias frames of a directory, indexed by the time they were taken.
+    
+    The times are parsed and sorted once, the nearest biases to an image are
+    found with a binary search, and the bias arrays (and the means of groups
+    of biases) are kept in an LRU cache of at most cache_bytes bytes, so that
+    every bias is read from disk once."""
+    
+    def __init__(self,bias_imgs,bpath="",cache_bytes=BIAS_CACHE):
+        names = [i for i in bias_imgs if is_fits(i)]
+        pairs = sorted((get_time(i), n, i) for n, i in enumerate(names))
+        self.times = [t for t, n, i in pairs]
+        self.names = [i for t, n, i in pairs]
+        self.bpath = bpath
+        self.cache_bytes = cache_bytes
+        self.cache_size = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def nearest(self,name,num=1):
+        """Get the num biases closest in time to the image, closest first"""
+        time = get_time(name)
+        hi = bisect_left(self.times, time)
+        lo = hi - 1
+        res = []
+        while len(res) < num and (lo >= 0 or hi < len(self.times)):
+            if hi >= len(self.times) or (lo >= 0 and time - self.times[lo] <= self.times[hi] - time):
+                res.append(self.names[lo])
+                lo -= 1
+            else:
+                res.append(self.names[hi])
+                hi += 1
+        return res
+    
+    def _cached(self,key,load):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        arr = load()
+        arr.flags.writeable = False
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = arr
+                self.cache_size += arr.nbytes
+            while self.cache_size > self.cache_bytes and len(self._cache) > 1:
+                old = self._cache.popitem(last=False)[1]
+                self.cache_size -= old.nbytes
+        return arr
+    
+    def get(self,name):
+        """Get the data of a bias (read only)"""
+        return self._cached(name, lambda: np.asarray(fits.getdata(self.bpath + name), dtype=np.float64))
+    
+    def mean(self,names):
+        """Get the mean of a group of biases (read only)"""
+        names = tuple(names)
+        if len(names) == 1:
+            return self.get(names[0])
+        return self._cached(names, lambda: sum(self.get(i) for i in names)/len(names))
+    
+    def nearest_mean(self,name,num=2):
+        """Get the mean of the num biases closest in time to the image"""
+        return self.mean(self.nearest(name,num))
+    
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.cache_size = 0
+
+@lru_cache(maxsize=8)
+def _names_library(bias_imgs):
+    """Get a BiasLibrary of a tuple of bias images, only used to find the
+    nearest biases, so only their names and times are kept"""
+    return BiasLibrary(bias_imgs)
+
+def as_bias_library(bias_imgs):
+    """Get a BiasLibrary of the bias images (or the BiasLibrary itself). The
+    library of a list of bias images is built once per distinct list, so
+    repeated get_corresponding_bias and get_sorted_bias calls do not sort the
+    bias times again"""
+    if isinstance(bias_imgs, BiasLibrary):
+        return bias_imgs
+    return _names_library(tuple(bias_imgs))
+
 # implement a function that gets you bias closest in time to that image!
 def get_corresponding_bias(name,bias_imgs):
-    bias_times = np.vectorize(get_time)(bias_imgs)
-    time = get_time(name)
-    btime = min(bias_times, key= lambda x:abs(x-time))
-    
-    for i in bias_imgs:
-        if get_time(i) == btime and is_fits(i):
-            return i
-        
-    return "Not Found!"
+    res = as_bias_library(bias_imgs).nearest(name)
+    if not res:
+        return "Not Found!"
+    return res[0]
 
 def indices_array_generic(m,n):
     r0 = np.arange(m) # Or r0,r1 = np.ogrid[:m,:n], out[:,:,0] = r0
@@ -55,92 +145,99 @@ def indices_array_generic(m,n):
     out[:,:,1] = r1
     return out
 
-def get_distance(x,y):
-    cent_x = 4453/2 + 0.5
-    cent_y = 6665/2 +0.5
+# Shape of a full SuperBIT frame
+FRAME_SHAPE = (4453,6665)
+
+def frame_center(shape=FRAME_SHAPE):
+    """Get the center of a frame, in the pixel coordinates used by get_distance"""
+    return (shape[0]/2 + 0.5, shape[1]/2 + 0.5)
+
+def get_distance(x,y,center=None,shape=FRAME_SHAPE):
+    """Get the distance of the pixels (x,y) from the center of the frame"""
+    if center is None:
+        center = frame_center(shape)
+    cent_x, cent_y = center
     
     return np.sqrt((x-cent_x)**2+(y-cent_y)**2)
 
-def image_vs_distance(path,name,bin_size,pc=50,bias_path = None):
-    """Vectorized optimized version of the previous function"""
-    loop_len = int(math.ceil(get_distance(4453-(pc-1),6665-(pc-1))/bin_size))
-    loops = []
+@lru_cache(maxsize=1)
+def radial_bins(shape,bin_size,center=None,pc=0):
+    """Get the pixels of a frame grouped by distance from the center.
     
-    for i in range(loop_len):
-        loops.append([])
-        
-    def vdist(idx):
-        return get_distance(idx[:,:,0],idx[:,:,1])
+    Pixel (x,y) with a distance d goes in bin ceil(d/bin_size) - 1 (the center
+    pixel goes in bin 0), and the pc pixels closest to the edges are left out.
+    Returns order, the flat indexes of the pixels sorted by bin, and the
+    starts and counts of every bin in order. Only the bins of the latest
+    (shape, bin_size, center, pc) are kept, with int32 indexes when they fit,
+    since they take 4 bytes per pixel of a full frame."""
+    x, y = np.ogrid[pc:shape[0]-pc, pc:shape[1]-pc]
+    bins = np.ceil(get_distance(x,y,center,shape)/bin_size).astype(np.int32) - 1
+    np.maximum(bins, 0, out=bins)
+    bins = bins.ravel()
     
-    idx = indices_array_generic(4453,6665)
-    dist = vdist(idx)
+    # Flat indexes of the kept pixels in the full frame
+    index = np.int32 if shape[0]*shape[1] < 2**31 else np.intp
+    rows = np.arange(pc, shape[0]-pc, dtype=index)
+    cols = np.arange(pc, shape[1]-pc, dtype=index)
+    flat = (rows[:,None]*shape[1] + cols).ravel()
     
-    def process(count,dist):
-        index = int(math.ceil(dist/bin_size)) - 1
-        loops[index].append(count)
-        
-    vprocess = np.vectorize(process)
-        
+    order = flat[np.argsort(bins, kind="stable")]
+    del flat
+    counts = np.bincount(bins)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    for arr in (order, starts, counts):
+        arr.flags.writeable = False
+    return order, starts, counts
+
+def radial_profile(img,bin_size=5,pc=50,center=None):
+    """Get the mean, median, standard deviation and number of pixels of every
+    radial bin of the image (see radial_bins). Empty bins are nan."""
+    img = np.asarray(img)
+    # radial_bins is cached, so its arguments must be hashable
+    if center is not None:
+        center = tuple(float(c) for c in center)
+    order, starts, counts = radial_bins(tuple(img.shape),bin_size,center,pc)
+    values = img.ravel()[order]
+    
+    full = counts > 0
+    means = np.full(len(counts), np.nan)
+    stds = np.full(len(counts), np.nan)
+    medians = np.full(len(counts), np.nan)
+    
+    sums = np.add.reduceat(values, starts[full], dtype=np.float64)
+    means[full] = sums/counts[full]
+    dev = values - np.repeat(means[full], counts[full])
+    dev *= dev
+    stds[full] = np.sqrt(np.add.reduceat(dev, starts[full])/counts[full])
+    del dev
+    
+    for i in np.flatnonzero(full):
+        medians[i] = np.median(values[starts[i]:starts[i]+counts[i]])
+    
+    return means, medians, stds, counts
+
+def image_vs_distance(path,name,bin_size,pc=50,bias_path = None):
+    """Get the mean and median of every radial bin of a flat (bias subtracted
+    with the closest bias in time if bias_path is given)"""
     with fits.open(path + name) as flat:
+        sub = flat[0].data
         if bias_path is not None:
-            with fits.open(bias_path + get_corresponding_bias(name,bias_path)) as bias:
+            bias_imgs = [i for i in os.listdir(bias_path) if is_fits(i)]
+            with fits.open(bias_path + get_corresponding_bias(name,bias_imgs)) as bias:
                 sub = flat[0].data - bias[0].data
-                vprocess(sub[pc:(4453-pc),pc:(6665-pc)],dist[pc:(4453-pc),pc:(6665-pc)])
-        else:
-            vprocess(flat[0].data[pc:(4453-pc),pc:(6665-pc)],dist[pc:(4453-pc),pc:(6665-pc)])
-    
-    means = []
-    medians = []
-    for i in range(len(loops)):
-        means.append(np.mean(loops[i]))
-        medians.append(np.median(loops[i]))
+        means, medians, stds, counts = radial_profile(sub,bin_size,pc)
     
     return means, medians
 
 
 def image_vs_distance2(img, pc=50, bin_size=5):
-    loop_len = int(math.ceil(get_distance(4453-(pc-1),6665-(pc-1))/bin_size))
-    loops = []
-
-    for i in range(loop_len):
-        loops.append([])
-
-    def vdist(idx):
-        return get_distance(idx[:,:,0],idx[:,:,1])
-
-    idx = indices_array_generic(4453,6665)
-    dist = vdist(idx)
-
-    def process(count,dist):
-        index = int(math.ceil(dist/bin_size)) - 1
-        loops[index].append(count)
-
-    vprocess = np.vectorize(process)
-
-    vprocess(img[pc:(4453-pc),pc:(6665-pc)],dist[pc:(4453-pc),pc:(6665-pc)])
-
-    means = []
-    medians = []
-    stds = []
-    for i in range(len(loops)):
-        means.append(np.mean(loops[i]))
-        medians.append(np.median(loops[i]))
-        stds.append(np.std(loops[i]))
-
+    means, medians, stds, counts = radial_profile(img,bin_size,pc)
+    
     return means, medians, stds
 
 
 def get_sorted_bias(name,bias_imgs,num=1):
-    res = []
-    bias_times = np.vectorize(get_time)(bias_imgs)
-    time = get_time(name)
-    btime = sorted(bias_times, key= lambda x:abs(x-time))
-    
-    for n in np.arange(num):
-        for i in bias_imgs:
-                if get_time(i) == btime[n] and is_fits(i):
-                    res.append(i)
-    return res
+    return as_bias_library(bias_imgs).nearest(name,num)
 
 
 def apply_filters(imgs,filters):
@@ -150,9 +247,65 @@ def apply_filters(imgs,filters):
     return imgs
 
 
-def master_mean(imgs,filters,path,sbias=False,bimgs=None,bpath=None,mbias=None,imsize=(4453,6665)):
+def sum_strip(frames,r0,r1,bias=None,mbias=None):
+    """Get the sum of rows r0 to r1 of the frames, minus the mean of their
+    biases (bias is a list of lists of bias images, one list per frame) and
+    minus mbias (the rows r0 to r1 of a master bias) for every frame. The
+    operations are done in the same order as master_mean, so the strips of a
+    parallel master_mean match the serial one exactly."""
+    sum_arr = None
+    bias_strips = {}
+    for i, frame in enumerate(frames):
+        strip = read_strip(frame,r0,r1)
+        if sum_arr is None:
+            sum_arr = np.zeros(strip.shape)
+        sum_arr += strip
+        
+        if bias is not None:
+            group = tuple(bias[i])
+            if group not in bias_strips:
+                bias_strips[group] = sum(read_strip(b,r0,r1) for b in group)/len(group)
+            sum_arr -= bias_strips[group]
+            
+        if mbias is not None:
+            sum_arr -= mbias
+    return sum_arr
+
+def _sum_strip(args):
+    return sum_strip(*args)
+
+def master_mean(imgs,filters,path,sbias=False,bimgs=None,bpath=None,mbias=None,imsize=(4453,6665),workers=None,rows=None):
+    """Get the mean of the frames (bias subtracted with the mean of the two
+    biases closest in time if sbias, and with mbias if given).
+    
+    With workers > 1 the image is split in strips of rows rows which are summed
+    by a pool of workers reading the frames through memory maps. The result
+    is the same as the serial one for unscaled and unsigned integer frames."""
     
     fimgs = apply_filters(imgs,filters)
+    if sbias:
+        library = bimgs if isinstance(bimgs, BiasLibrary) else BiasLibrary(bimgs,bpath)
+    
+    if workers is not None and workers > 1:
+        frames = [path + img for img in fimgs]
+        bias = None
+        if sbias:
+            bias = [[library.bpath + b for b in library.nearest(img,2)] for img in fimgs]
+        nrows, ncols = frame_shape(frames[0])
+        if rows is None:
+            rows = max(1, int(math.ceil(nrows/(4*workers))))
+        
+        tasks = []
+        for r0 in range(0, nrows, rows):
+            r1 = min(r0 + rows, nrows)
+            tasks.append((frames, r0, r1, bias, None if mbias is None else mbias[r0:r1]))
+        
+        sum_arr = np.empty((nrows, ncols))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for (frames, r0, r1, b, m), strip in zip(tasks, pool.map(_sum_strip, tasks)):
+                sum_arr[r0:r1] = strip
+        return sum_arr/len(fimgs)
+    
     sum_arr = np.zeros(imsize)
     
     for img in fimgs:
@@ -160,8 +313,7 @@ def master_mean(imgs,filters,path,sbias=False,bimgs=None,bpath=None,mbias=None,i
             sum_arr += hdul[0].data
             
         if sbias:
-            sbias = get_sorted_bias(img,bimgs,2)
-            sum_arr -= (fits.getdata(bpath + sbias[0]) + fits.getdata(bpath + sbias[1]))/2
+            sum_arr -= library.nearest_mean(img,2)
             
         if mbias is not None:
             sum_arr -= mbias
@@ -170,42 +322,119 @@ def master_mean(imgs,filters,path,sbias=False,bimgs=None,bpath=None,mbias=None,i
     return mean_arr
 
 
-def master_estimator(imgs,filters,path,width=10,sbias=False,bimgs=None,bpath=None,mbias=None):
+# Default memory budget (in bytes) of the streaming stackers
+STACK_BUDGET = 2**30
+
+# Combine modes of stack_frames
+STACK_METHODS = ("mean", "median", "sigclip")
+
+def frame_shape(path):
+    """Get the shape of a fits image from its header, without reading it"""
+    header = fits.getheader(path)
+    return (header["NAXIS2"], header["NAXIS1"])
+
+def read_strip(path,r0,r1):
+    """Read rows r0 to r1 of a fits image (through a memory map) as float64.
+    The BZERO/BSCALE/BLANK scaling is applied to the strip only, since Astropy
+    would read the whole image to scale it."""
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        raw = hdul[0].data[r0:r1]
+        strip = raw.astype(np.float64)
+        if "BLANK" in header:
+            strip[raw == header["BLANK"]] = np.nan
+        del raw
+    if header.get("BSCALE", 1) != 1:
+        strip *= header["BSCALE"]
+    if header.get("BZERO", 0) != 0:
+        strip += header["BZERO"]
+    return strip
+
+def strip_rows(nframes,ncols,budget=STACK_BUDGET,copies=3):
+    """Get the number of rows per strip so that nframes strips (and the copies
+    made while combining them) fit in budget bytes"""
+    return max(1, int(budget // (nframes*ncols*8*copies)))
+
+def iter_strips(frames,bias=None,mbias=None,budget=STACK_BUDGET,copies=3):
+    """Read the frames strip by strip and yield (r0, r1, cube) where cube holds
+    rows r0 to r1 of every frame, stacked on axis 0.
     
-    mean_arr = []
-    median_arr = []
-    fimgs = apply_filters(imgs,filters)
+    bias is a list of lists of bias images (one list per frame) whose mean is
+    subtracted from each frame and mbias is a master bias subtracted from every
+    frame."""
+    nrows, ncols = frame_shape(frames[0])
+    rows = strip_rows(len(frames),ncols,budget,copies)
+    
+    for r0 in range(0, nrows, rows):
+        r1 = min(r0 + rows, nrows)
+        cube = np.empty((len(frames), r1-r0, ncols))
+        # Mean bias strips, read once per strip for all the frames sharing them
+        bias_strips = {}
+        for i, frame in enumerate(frames):
+            cube[i] = read_strip(frame,r0,r1)
+            if bias is not None:
+                group = tuple(bias[i])
+                if group not in bias_strips:
+                    bias_strips[group] = sum(read_strip(b,r0,r1) for b in group)/len(group)
+                cube[i] -= bias_strips[group]
+            if mbias is not None:
+                cube[i] -= mbias[r0:r1]
+        yield r0, r1, cube
+
+def combine(cube,method="median",sigma=3,iterations=5):
+    """Combine a stack of frames on axis 0 with the mean, the median or the
+    mean after an iterative sigma clip around the median"""
+    if method == "mean":
+        return np.mean(cube,axis=0)
+    if method == "median":
+        return np.median(cube,axis=0)
+    if method != "sigclip":
+        raise ValueError("method must be one of " + ", ".join(STACK_METHODS))
+    
+    cube = cube.copy()
+    for i in range(iterations):
+        center = np.nanmedian(cube,axis=0)
+        spread = np.nanstd(cube,axis=0)
+        clip = np.abs(cube - center) > sigma*spread
+        if not clip.any():
+            break
+        cube[clip] = np.nan
+    return np.nanmean(cube,axis=0)
+
+def stack_frames(frames,method="median",bias=None,mbias=None,sigma=3,iterations=5,budget=STACK_BUDGET):
+    """Combine fits frames into a master frame, strip by strip, so that no more
+    than about budget bytes of image data are in memory at once. See
+    iter_strips for bias and mbias and combine for method."""
+    res = np.empty(frame_shape(frames[0]))
+    copies = 5 if method == "sigclip" else 3
+    for r0, r1, cube in iter_strips(frames,bias,mbias,budget,copies):
+        res[r0:r1] = combine(cube,method,sigma,iterations)
+    return res
 
-    for i in range(int(math.floor(len(fimgs)/width))):
-        ims = []
-        for img in fimgs[width*i:width*(i+1)]:
-            with fits.open(path + img) as hdul:
-                if sbias:
-                    sum_arr = np.zeros((4453,6665))
-                    sbias = get_sorted_bias(img,bimgs,2)
-                    sum_arr += hdul[0].data
-                    sum_arr -= (fits.getdata(bpath + sbias[0]) + fits.getdata(bpath + sbias[1]))/2
-                    ims.append(sum_arr)
-                    del sum_arr
-                    
-                elif mbias is not None:
-                    sum_arr = np.zeros((4453,6665))
-                    sum_arr += hdul[0].data
-                    sum_arr -= mbias
-                    ims.append(sum_arr)
-                    del sum_arr
-                    
-                else:
-                    ims.append(hdul[0].data)
-
-        ims = np.array(ims)
-        median_arr.append(np.median(ims,axis=0))
-        mean_arr.append(np.mean(ims,axis=0))
-        del ims
-
-    std_arr = np.std(np.array(mean_arr),axis=0)
-    median_arr = np.median(np.array(median_arr),axis=0)
 
+def master_estimator(imgs,filters,path,width=10,sbias=False,bimgs=None,bpath=None,mbias=None,budget=STACK_BUDGET):
+    """Get the median of the medians and the standard deviation of the means
+    of every group of width frames, strip by strip (see stack_frames)"""
+    fimgs = apply_filters(imgs,filters)
+    groups = int(math.floor(len(fimgs)/width))
+    fimgs = fimgs[:groups*width]
+    frames = [path + img for img in fimgs]
+    
+    bias = None
+    if sbias:
+        library = bimgs if isinstance(bimgs, BiasLibrary) else BiasLibrary(bimgs,bpath)
+        bias = [[library.bpath + b for b in library.nearest(img,2)] for img in fimgs]
+    
+    shape = frame_shape(frames[0])
+    median_arr = np.empty(shape)
+    std_arr = np.empty(shape)
+    if bias is not None:
+        mbias = None
+    for r0, r1, cube in iter_strips(frames,bias,mbias,budget):
+        cube = cube.reshape((groups, width) + cube.shape[1:])
+        median_arr[r0:r1] = np.median(np.median(cube,axis=1),axis=0)
+        std_arr[r0:r1] = np.std(np.mean(cube,axis=1),axis=0)
+    
     return median_arr, std_arr
 
 
@@ -0,0 +1,312 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+from astropy.io import fits
+from scipy import ndimage
+
+try:
+    import sep
+except ImportError:
+    sep = None
+
+# The 10 catalog columns every extractor returns, in this order. These are the
+# parameters of default.param.
+COLUMNS = ["FLUX_AUTO", "X_IMAGE", "Y_IMAGE", "A_IMAGE", "B_IMAGE", \
+"FLUX_RADIUS", "ELLIPTICITY", "ELONGATION", "THETA_IMAGE", "NUMBER"]
+
+# Files Source Extractor needs in the directory it is run from.
+SEX_CONFIG = ["default.sex", "default.param", "default.conv", "default.nnw"]
+
+# The 3x3 "all-ground" convolution mask of default.conv.
+DEFAULT_CONV = np.array([[1, 2, 1], [2, 4, 2], [1, 2, 1]], dtype=float)
+
+
+def columns(catalog):
+    """
+    Returns the columns of a catalog returned by an extractor, in the format
+    of SE_Comparison.cat_reader.
+
+    @type catalog: Numpy Array (Shape (number of sources, 10))
+    @rtype: List[Numpy Array]
+    """
+    return list(np.asarray(catalog).T)
+
+
+def default_extractor():
+    """
+    Returns the in-process extractor to use: SepExtractor if the sep library
+    is installed and MomentExtractor otherwise.
+
+    @rtype: SepExtractor or MomentExtractor
+    """
+    if sep is not None:
+        return SepExtractor()
+    return MomentExtractor()
+
+
+class SExtractor:
+    """
+    Extracts sources by running the Source Extractor program on a fits file.
+
+    Every extractor has an extract method which takes an image array and
+    returns a catalog of shape (number of sources, 10) with the columns
+    listed in COLUMNS.
+    """
+    def __init__(self, config_dir, binary="sextractor", scratch=None):
+        """
+        Initializes a new SExtractor object.
+
+        @type self: SExtractor
+        @type config_dir: String (Directory holding the SEX_CONFIG files)
+        @type binary: String (Name of the Source Extractor program)
+        @type scratch: String or None (Directory for temporary files)
+        @rtype: None
+        """
+        self.config_dir = os.path.abspath(config_dir)
+        self.binary = binary
+        self.scratch = scratch
+
+    def extract_file(self, image_name, workdir):
+        """
+        Runs Source Extractor on a fits image inside workdir, which must hold
+        the SEX_CONFIG files, and returns its catalog.
+
+        @type self: SExtractor
+        @type image_name: String (Name of the fits image inside workdir)
+        @type workdir: String
+        @rtype: Numpy Array
+        """
+        subprocess.run([self.binary, image_name, "-c", "default.sex"], \
+        cwd=workdir, check=True, stdout=subprocess.DEVNULL, \
+        stderr=subprocess.DEVNULL)
+        return np.loadtxt(os.path.join(workdir, "test.cat"), ndmin=2)
+
+    def extract(self, image):
+        """
+        Writes the image to a temporary directory, runs Source Extractor on it
+        and returns its catalog.
+
+        @type self: SExtractor
+        @type image: Numpy Array
+        @rtype: Numpy Array
+        """
+        workdir = tempfile.mkdtemp(prefix="sextractor_", dir=self.scratch)
+        try:
+            for name in SEX_CONFIG:
+                shutil.copy(os.path.join(self.config_dir, name), workdir)
+            fits.PrimaryHDU(data=image).writeto(os.path.join(workdir, \
+            "image.fits"))
+            return self.extract_file("image.fits", workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+class MomentExtractor:
+    """
+    Extracts sources in-process with NumPy and SciPy, following the steps of
+    Source Extractor with the settings of default.sex:
+
+        1) Estimate the background and its RMS with a sigma clip.
+        2) Filter the image with the default.conv mask and threshold it at
+           thresh times the background RMS.
+        3) Find the connected regions of at least minarea pixels.
+        4) Measure the position, shape and orientation of every region from
+           its first and second moments.
+        5) Measure the flux in a Kron elliptical aperture and the radius
+           holding flux_frac of that flux.
+
+    The measurements are close to, but not the same as, Source Extractor's
+    (there is no deblending and the background is a single value).
+    """
+    def __init__(self, thresh=1.5, minarea=3, kron_fact=2.5, min_radius=3.5, \
+    flux_frac=0.5, conv=DEFAULT_CONV):
+        """
+        Initializes a new MomentExtractor object. The defaults are the ones
+        of default.sex.
+
+        @type self: MomentExtractor
+        @type thresh: Float (Detection threshold in background RMS)
+        @type minarea: Int (Minimum number of pixels of a source)
+        @type kron_fact: Float (Kron factor of FLUX_AUTO)
+        @type min_radius: Float (Minimum Kron radius of FLUX_AUTO)
+        @type flux_frac: Float (Fraction of light of FLUX_RADIUS)
+        @type conv: Numpy Array or None (Detection filter)
+        @rtype: None
+        """
+        self.thresh = thresh
+        self.minarea = minarea
+        self.kron_fact = kron_fact
+        self.min_radius = min_radius
+        self.flux_frac = flux_frac
+        self.conv = conv
+
+    def background(self, image, sigma=3, iterations=5):
+        """
+        Returns the background level and RMS of the image, estimated with a
+        sigma clip.
+
+        @type self: MomentExtractor
+        @type image: Numpy Array
+        @type sigma: Float
+        @type iterations: Int
+        @rtype: Tuple[Float, Float]
+        """
+        values = image.ravel()
+        for i in range(iterations):
+            median = np.median(values)
+            rms = np.std(values)
+            clipped = values[np.abs(values - median) < sigma * rms]
+            if len(clipped) == len(values) or len(clipped) == 0:
+                break
+            values = clipped
+        return float(np.median(values)), float(np.std(values))
+
+    def extract(self, image):
+        """
+        Extracts the sources of the image and returns their catalog.
+
+        @type self: MomentExtractor
+        @type image: Numpy Array
+        @rtype: Numpy Array
+        """
+        back, rms = self.background(np.asarray(image, dtype=float))
+        data = np.asarray(image, dtype=float) - back
+        detect = data
+        if self.conv is not None:
+            detect = ndimage.convolve(data, self.conv / self.conv.sum(), \
+            mode="nearest")
+        labels, count = ndimage.label(detect > self.thresh * rms, \
+        structure=np.ones((3, 3)))
+        if count == 0:
+            return np.zeros((0, len(COLUMNS)))
+
+        # First and second moments of every region at once, weighted by the
+        # positive pixel values.
+        pixels = np.flatnonzero(labels)
+        label = labels.ravel()[pixels]
+        y, x = np.divmod(pixels, data.shape[1])
+        weight = np.clip(data.ravel()[pixels], 0, None)
+        area = np.bincount(label, minlength=count + 1)[1:]
+        total = np.bincount(label, weight, count + 1)[1:]
+        keep = (area >= self.minarea) & (total > 0)
+        total[~keep] = 1
+
+        def moment(values):
+            return np.bincount(label, weight * values, count + 1)[1:] / total
+
+        x_mean = moment(x)
+        y_mean = moment(y)
+        x2 = moment(x * x) - x_mean ** 2
+        y2 = moment(y * y) - y_mean ** 2
+        xy = moment(x * y) - x_mean * y_mean
+        x_mean, y_mean, x2, y2, xy = [value[keep] for value in \
+        (x_mean, y_mean, x2, y2, xy)]
+        # Source Extractor's fix for single pixel (or line) sources
+        singular = x2 * y2 - xy ** 2 < 1 / 144
+        x2[singular] += 1 / 12
+        y2[singular] += 1 / 12
+
+        half_sum = (x2 + y2) / 2
+        half_diff = np.sqrt(((x2 - y2) / 2) ** 2 + xy ** 2)
+        a = np.sqrt(half_sum + half_diff)
+        b = np.sqrt(np.clip(half_sum - half_diff, 0, None))
+        theta = 0.5 * np.arctan2(2 * xy, x2 - y2)
+
+        catalog = []
+        for i in range(len(a)):
+            flux, radius = self.aperture(data, x_mean[i], y_mean[i], a[i], \
+            b[i], theta[i])
+            catalog.append([flux, x_mean[i] + 1, y_mean[i] + 1, a[i], b[i], \
+            radius, 1 - b[i] / a[i], a[i] / max(b[i], 1e-12), \
+            np.degrees(theta[i]), len(catalog) + 1])
+        return np.array(catalog).reshape(-1, len(COLUMNS))
+
+    def aperture(self, data, x, y, a, b, theta):
+        """
+        Returns the flux in the Kron aperture of a source (FLUX_AUTO) and the
+        radius of the circle holding flux_frac of that flux (FLUX_RADIUS).
+
+        @type self: MomentExtractor
+        @type data: Numpy Array (Background subtracted image)
+        @type x: Float (Centre of the source, starting at 0)
+        @type y: Float
+        @type a: Float (Major and minor axis)
+        @type b: Float
+        @type theta: Float (Angle of the major axis, in radians)
+        @rtype: Tuple[Float, Float]
+        """
+        b = max(b, 1e-3)
+        cos, sin = np.cos(theta), np.sin(theta)
+        half = int(np.ceil(max(6, self.kron_fact * 6, self.min_radius) * a)) + 1
+        y0, y1 = max(0, int(y) - half), min(data.shape[0], int(y) + half + 1)
+        x0, x1 = max(0, int(x) - half), min(data.shape[1], int(x) + half + 1)
+        cutout = data[y0:y1, x0:x1]
+        dy, dx = np.mgrid[y0:y1, x0:x1]
+        dx = dx - x
+        dy = dy - y
+        # Elliptical radius, 1 on the ellipse of axes a and b
+        r = np.sqrt(((dx * cos + dy * sin) / a) ** 2 + \
+        ((dy * cos - dx * sin) / b) ** 2)
+
+        inside = r <= 6
+        weight = np.clip(cutout[inside], 0, None)
+        kron = np.sum(r[inside] * weight) / max(np.sum(weight), 1e-12)
+        aperture = r <= max(self.kron_fact * kron, self.min_radius)
+        flux = float(np.sum(cutout[aperture]))
+
+        circle = np.hypot(dx, dy)[aperture]
+        order = np.argsort(circle)
+        light = np.cumsum(cutout[aperture][order])
+        radius = float(np.interp(self.flux_frac * flux, light, circle[order]))
+        return flux, radius
+
+
+class SepExtractor:
+    """
+    Extracts sources in-process with the sep library (Source Extractor as a
+    Python library), with the settings of default.sex.
+    """
+    def __init__(self, thresh=1.5, minarea=3, kron_fact=2.5, min_radius=3.5, \
+    flux_frac=0.5, conv=DEFAULT_CONV):
+        """
+        Initializes a new SepExtractor object. See MomentExtractor.
+
+        @type self: SepExtractor
+        @rtype: None
+        """
+        if sep is None:
+            raise ImportError("SepExtractor requires the sep library.")
+        self.thresh = thresh
+        self.minarea = minarea
+        self.kron_fact = kron_fact
+        self.min_radius = min_radius
+        self.flux_frac = flux_frac
+        self.conv = conv
+
+    def extract(self, image):
+        """
+        Extracts the sources of the image and returns their catalog.
+
+        @type self: SepExtractor
+        @type image: Numpy Array
+        @rtype: Numpy Array
+        """
+        data = np.ascontiguousarray(image, dtype=float)
+        back = sep.Background(data)
+        data = data - back
+        objects = sep.extract(data, self.thresh, err=back.globalrms, \
+        minarea=self.minarea, filter_kernel=self.conv)
+        if len(objects) == 0:
+            return np.zeros((0, len(COLUMNS)))
+        x, y = objects['x'], objects['y']
+        a, b, theta = objects['a'], objects['b'], objects['theta']
+
+        kron, flag = sep.kron_radius(data, x, y, a, b, theta, 6.0)
+        flux, error, flag = sep.sum_ellipse(data, x, y, a, b, theta, \
+        np.maximum(self.kron_fact * kron, self.min_radius), subpix=1)
+        radius, flag = sep.flux_radius(data, x, y, 6.0 * a, self.flux_frac, \
+        normflux=flux, subpix=5)
+        return np.column_stack([flux, x + 1, y + 1, a, b, radius, 1 - b / a, \
+        a / b, np.degrees(theta), np.arange(1, len(objects) + 1)])
@@ -3,7 +3,38 @@ import matplotlib.pyplot as plt
 from astropy.io import fits
 from astropy.utils.data import download_file
 import os
-import random
+from functools import lru_cache
+
+from psf import DEFAULT_PSF
+from noise import draw_noise
+
+# Length and brightness of a cosmic ray streak, which fades by COSMIC_FADE per
+# pixel.
+COSMIC_LENGTH = 40
+COSMIC_BRIGHTNESS = 8000
+COSMIC_FADE = 8000/500
+
+
+@lru_cache(maxsize=64)
+def gaussian_kernel(size, xfwhm, yfwhm, btness):
+    """
+    Returns the (read only) square gaussian kernel of FakeStars.create_2d_gaussian
+    centered on the middle pixel. Kernels are computed once per parameters.
+
+    @type size: Int
+    @type xfwhm: Float
+    @type yfwhm: Float
+    @type btness: Float
+    @rtype: Numpy Array
+    """
+    x = np.arange(0, size, 1, float)
+    y = x[:,np.newaxis]
+    x0 = y0 = size // 2
+    kernel = btness * np.exp(-4*np.log(2) * ((x-x0)**2 / xfwhm**2 + \
+                                             (y-y0)**2 / yfwhm**2))
+    kernel.flags.writeable = False
+    return kernel
+
 
 class FakeStars():
     """
@@ -19,17 +50,25 @@ class FakeStars():
     windows but I encounter some errors.
     """
     
-    def __init__(self, image_name, x_len, y_len):
+    def __init__(self, image_name, x_len, y_len, seed=None, psf=None):
         """
         Initializes a new FakeStar object which represents either a fake space 
         image or a fake singular point source.
+
+        Every random value is drawn from self.rng, a numpy Generator made from
+        seed, so the same seed always gives the same image. Single sources are
+        rendered by psf (see PSFLibrary), DEFAULT_PSF by default.
         
         @type self: FakeStars
         @type image_name: String (The name of the image)
         @type x_len: Int (Width of Image)
         @type y_len: Int (Height of Image)
+        @type seed: Int, SeedSequence, Generator or None
+        @type psf: PSFLibrary or None
         @rtype: None
         """
+        self.rng = np.random.default_rng(seed)
+        self.psf = DEFAULT_PSF if psf is None else psf
         self.name = image_name
         self.width = x_len
         self.height = y_len
@@ -47,10 +86,8 @@ class FakeStars():
         @type self: FakeStars
         @rtype: Numpy Array
         """
-        num_samples = self.width * self.height
-        white_noise = np.round(np.random.normal(mean, std, size=num_samples))
-        white_noise = white_noise.reshape(self.width, self.height)
-        return white_noise
+        return draw_noise(self.rng, (self.width, self.height), mean=mean, \
+        std=std)
 
     def generate_background(self, mean=1250, std=0):
         """
@@ -64,7 +101,7 @@ class FakeStars():
         @rtype: Numpy Array
         """
         num_samples = self.width * self.height
-        background = np.round(np.random.normal(mean, std, size = num_samples))
+        background = np.round(self.rng.normal(mean, std, size = num_samples))
         return background
                         
  
@@ -82,16 +119,9 @@ class FakeStars():
         @type center: Tuple (Coordinates of center of star)
         @type btness: Int (Brightest point of star)
         """
-        x = np.arange(0, size, 1, float)
-        y = x[:,np.newaxis]
-    
         if center is None:
-            x0 = y0 = size // 2
-        else:
-            x0 = center[0]
-            y0 = center[1]
-        return btness * np.exp(-4*np.log(2) * ((x-x0)**2 / xfwhm**2 + \
-                                               (y-y0)**2 / yfwhm**2))
+            return gaussian_kernel(size, xfwhm, yfwhm, btness).copy()
+        return self.psf.kernel(size, xfwhm, yfwhm, center, btness)
                                                
     def create_point_stars(self, num_stars):
         """
@@ -105,11 +135,11 @@ class FakeStars():
         @type num_stars: Integer
         @rtype: Numpy Array
         """
-        for i in range(num_stars):
-            point_star = random.randint(6000, 60000)
-            x_pos = random.randint(0, self.width-1) 
-            y_pos = random.randint(0, self.height-1)  
-            self._image_array[x_pos][y_pos] += point_star
+        point_star = self.rng.integers(6000, 60000, size=num_stars, \
+        endpoint=True)
+        x_pos = self.rng.integers(0, self.width, size=num_stars)
+        y_pos = self.rng.integers(0, self.height, size=num_stars)
+        np.add.at(self._image_array, (x_pos, y_pos), point_star)
         
     def create_stars(self, generator=100, sz=20, xf=10, yf=10, amp=200):
         """
@@ -124,12 +154,16 @@ class FakeStars():
         @type amp: Int (The Amplitude of the gaussian- how bright a star is)
         @rtype: None
         """
-        while generator != 0:
-            x = random.randint(100, self.width - 100)
-            y = random.randint(100, self.height - 100)
-            source = self.create_2d_gaussian(size=sz, xfwhm=xf, yfwhm=yf, btness=amp)
-            self._image_array[x:x+sz, y:y+sz] += source
-            generator -= 1
+        x = self.rng.integers(100, self.width - 100, size=generator, \
+        endpoint=True)
+        y = self.rng.integers(100, self.height - 100, size=generator, \
+        endpoint=True)
+        source = gaussian_kernel(sz, xf, yf, amp)
+        # Adding the kernel slice by slice is faster than one np.add.at over
+        # every pixel of every star, since the stars are large.
+        for i, j in zip(x.tolist(), y.tolist()):
+            stamp = self._image_array[i:i+sz, j:j+sz]
+            stamp += source[:stamp.shape[0], :stamp.shape[1]]
         
     def create_cosmic_rays(self, amount):
         """
@@ -140,34 +174,20 @@ class FakeStars():
         @type amount: Int (Number of sources)
         @rtype: None
         """
-        while amount != 0:
-            size = 40
-            chance = random.randint(0,1)
-            rotation = random.randint(0, 2)
-            x_pos = random.randint(0, self.width - 1) 
-            y_pos = random.randint(0, self.height - 1)  
-            brightness = 8000
-            while size != 0:
-                if rotation == 0:
-                    if x_pos >= 4400 or y_pos >= 6650:
-                        break
-                    self._image_array[x_pos][y_pos] += brightness
-                    x_pos += 1
-                    y_pos -= 1
-                elif rotation == 1:
-                    if x_pos >= 4400 or y_pos >= 6650:
-                        break
-                    self._image_array[x_pos][y_pos] += brightness
-                    x_pos += 1
-                    y_pos += 1
-                else:
-                    if x_pos >= 4400 or y_pos >= 6650:
-                        break
-                    self._image_array[x_pos][y_pos] += brightness
-                    x_pos += 1
-                size -=1
-                brightness -= 8000/500
-            amount -= 1
+        # Each streak goes down (and left, right or straight) from a random
+        # pixel and stops at the edge of the image.
+        x_pos = self.rng.integers(0, self.width, size=amount)
+        y_pos = self.rng.integers(0, self.height, size=amount)
+        rotation = self.rng.integers(0, 3, size=amount)
+        step = np.array([-1, 1, 0])[rotation]
+        k = np.arange(COSMIC_LENGTH)
+        x = x_pos[:, None] + k
+        y = y_pos[:, None] + step[:, None] * k
+        brightness = np.broadcast_to(COSMIC_BRIGHTNESS - COSMIC_FADE * k, \
+        x.shape)
+        inside = (x < self.width) & (y >= 0) & (y < self.height)
+        np.add.at(self._image_array, (x[inside], y[inside]), \
+        brightness[inside])
             
     def create_single_source(self, bt=250, xf=10, yf=10, rand_pos=False, std=29, sz=100):
         """
@@ -187,14 +207,13 @@ class FakeStars():
         """
         x = y = sz // 2
         if rand_pos:
-            x += random.uniform(-0.5, 0.5)
-            y += random.uniform(-0.5, 0.5)
-        star = self.create_2d_gaussian(size=sz, xfwhm=xf, yfwhm=yf, center=(x, y), btness=bt)
-        num_samples = sz*sz
-        white_noise = np.round(np.random.normal(29, std, size=num_samples))
-        white_noise = np.reshape(white_noise, (sz, sz))
+            x += self.rng.uniform(-0.5, 0.5)
+            y += self.rng.uniform(-0.5, 0.5)
+        white_noise = draw_noise(self.rng, (sz, sz), mean=29, std=std)
         self.noise = white_noise
-        self._image_array = star + white_noise
+        # Only the pixels near the source are computed (see PSFLibrary).
+        self._image_array = white_noise.copy()
+        self.psf.render(self._image_array, (x, y), xf, yf, bt)
         
     def create_image(self, signal=1, btness= 400):
         """
@@ -213,25 +232,28 @@ class FakeStars():
         self.create_point_stars(signal*100)
         if type(btness) == list:
             for amp in btness:
-                if random.randint(0, 25) == 1:
+                if self.rng.integers(0, 25, endpoint=True) == 1:
                     self.create_stars(generator=signal * 5, sz=50*2, xf=5, yf=2, amp=amp)
                 else:
                     self.create_stars(generator=signal * 5, sz=50*2, xf=amp/40, yf=amp/40, amp=amp)
         else:
-            self.create_stars(generator=signal*5, sz=30, xf=amp/40, yf=amp/40, bt=btness)
+            self.create_stars(generator=signal*5, sz=30, xf=btness/40, yf=btness/40, amp=btness)
         self.create_cosmic_rays(signal*3)
         self._image_array += self.noise
         
-    def new_noise(self):
+    def new_noise(self, std=29, mean=0):
         """
         Creates a new generated white noise background with the same sources
         in the same position.
+
+        The new noise is drawn into the old noise array, so no new frame is
+        allocated.
         
         @type self: Fake_stars
         @rytpe: None
         """
         self._image_array -= self.noise
-        self.noise = self.generate_white_noise()
+        draw_noise(self.rng, mean=mean, std=std, out=self.noise)
         self._image_array += self.noise
         
     def cap_pixel_value(self, bit_limit=64):
@@ -241,10 +263,7 @@ class FakeStars():
         @type self: Fake_Stars
         @rtype: None
         """
-        x, y = np.where(self._image_array > 65535)
-        if type(x) == np.ndarray and len(x) > 0:
-            for i in range(len(x)):
-                self._image_array[x[i]][y[i]] = 65535
+        np.minimum(self._image_array, 65535, out=self._image_array)
         
     def show_image(self, together=True):
         """
@@ -284,19 +303,22 @@ class FakeStars():
             plt.colorbar()
         plt.show()
 
-    def create_fits_image(self):
+    def create_fits_image(self, out_dir="", file_name=None):
         """
-        Creates a fake fits image and saves it onto the current working directory.
-        
-        Use os.chdir() to change to the desired save location
+        Creates a fake fits image and saves it into out_dir (by default, the
+        current working directory) as file_name, <name>large.fits by default.
         
-        clobber: bool, optional- if True, overwrite any existing file.
+        Any existing file is overwritten.
         
         @type self: FakeStars
+        @type out_dir: String
+        @type file_name: String or None
         @rtype: None
         """
+        if file_name is None:
+            file_name = self.name + "large.fits"
         hdu = fits.PrimaryHDU(data=self._image_array)
-        hdu.writeto(self.name + "large.fits", overwrite=True)
+        hdu.writeto(os.path.join(out_dir, file_name), overwrite=True)
         
     def show_statistics(self):
         """
@@ -328,7 +350,7 @@ class FakeStars():
 ## (Example)
 
 if __name__ == '__main__':
-    os.chdir("/Users/a16472/desktop/")
+    OUT_DIR = "/Users/a16472/desktop/"
 
     fakestar1 = FakeStars("fakestar1", 4400, 6650)
     fakestar1.create_image(signal = 150, btness=[1200, 1000, 800, 200])
@@ -337,7 +359,7 @@ if __name__ == '__main__':
     # fakestar1.create_single_source(bt=250, xf=2, yf=2, sz=100)
 
     fakestar1.cap_pixel_value()
-    fakestar1.create_fits_image()
+    fakestar1.create_fits_image(OUT_DIR)
     fakestar1.show_image(together=False)
 
     fakestar1.new_noise()
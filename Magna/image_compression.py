@@ -1,16 +1,803 @@
+import io
 import os
-import fitsio
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import numpy as np
 from astropy.io import fits
 import math
 
+from catalog import catalog_data
+
 
 OG_SOURCE = "/home/james/Desktop/sbit_compress_py/original"
 COMP_SOURCE = "/home/james/Desktop/sbit_compress_py/compressed"
 DS9 = "/home/james/Desktop/sbit_compress_py/ds9"
 MAIN = "/home/james/Desktop/sbit_compress_py/"
 
+# Default shape of the tiles of compress_tiled, in (rows, columns).
+TILE_SHAPE = (512, 512)
+# Default (algorithm, parameters) of the tiles holding sources and of the
+# other tiles in plan_tiles. Tiles with sources are kept lossless (for float
+# images only if their pixels are whole numbers, see compress_tile).
+RICH_TILES = ('HCOMPRESS_1', {'hcomp_scale': 0})
+POOR_TILES = ('HCOMPRESS_1', {'hcomp_scale': 4, 'hcomp_smooth': 1})
+
+# Header keywords describing the layout of the data, which are set by the
+# writer of a fits file rather than copied from the original header.
+STRUCTURAL_KEYS = ("SIMPLE", "BITPIX", "NAXIS", "EXTEND", "BZERO", "BSCALE", \
+"PCOUNT", "GCOUNT")
+
+
+def write_fits(file, data, header=None):
+    """
+    Writes the image with the header (a dictionary of keywords) to a fits
+    file. file may be a path, written with fitsio, or a writable file
+    object, written with Astropy. fitsio is only imported here, and paths are
+    written with Astropy too if it is not installed.
+
+    @type file: String or File
+    @type data: Numpy Array
+    @type header: Dictionary or None
+    @rtype: None
+    """
+    if isinstance(file, str):
+        try:
+            import fitsio
+        except ImportError:
+            fitsio = None
+        if fitsio is not None:
+            fitsio.write(file, data, header=header, clobber=True)
+            return
+    hdu = fits.PrimaryHDU(data=data)
+    for key, value in (header or {}).items():
+        if key and not key.startswith(STRUCTURAL_KEYS) \
+        and key not in ("COMMENT", "HISTORY"):
+            hdu.header[key] = value
+    hdu.writeto(file, overwrite=isinstance(file, str))
+
+
+def quantize_bits(image, bits, threshold=None):
+    """
+    Shaves the bottom bits off every pixel of the image IN PLACE and returns
+    the image. Pixel values are quantized relative to the minimum of the
+    image, which is what subtracting the median and adding the negative of
+    the minimum achieves in the bit shaving algorithm.
+
+    Integer images (uint16, int32, ...) are shaved using integer shifts only,
+    so no float copies of the frame are made. Each pixel is rounded to the
+    nearest multiple of 2**bits (halves round to even, like np.round) and
+    values which would round past the largest value of the dtype are rounded
+    down instead. Float images are rounded with np.round, as before, so both
+    paths shave a frame the same way.
+
+    If threshold is given, every pixel above the threshold is restored to its
+    original value once the image has been shaved (the sources).
+
+    @type image: Numpy Array (Modified in place)
+    @type bits: Int (Number of bits dropped)
+    @type threshold: Number or None (Restore pixels above this value)
+    @rtype: Numpy Array
+    """
+    bits = int(bits)
+    if image.dtype.kind in "ui":
+        width = image.dtype.itemsize * 8
+    else:
+        width = np.finfo(image.dtype).nmant + 1
+    if bits <= 0 or bits >= width:
+        raise ValueError("Cannot shave " + str(bits) + " bits off a " + \
+        str(image.dtype) + " image.")
+
+    if threshold is not None:
+        sources = image > threshold
+        values = image[sources]
+
+    offset = image.min()
+    if image.dtype.kind in "ui":
+        # Work on an unsigned view so image - offset never overflows.
+        shaved = image.view(image.dtype.str.replace("i", "u"))
+        offset = int(offset)
+        cap = (int(np.iinfo(image.dtype).max) - offset) >> bits
+        offset = shaved.dtype.type(offset % (1 << width))
+
+        shaved -= offset
+        # Round half to even, as np.round does: round up if the remainder is
+        # above half, or is half and the quotient is odd.
+        half = 1 << (bits - 1)
+        remainder = shaved & ((1 << bits) - 1)
+        shaved >>= bits
+        up = remainder > half
+        up |= (remainder == half) & (shaved & 1).astype(bool)
+        del remainder
+        shaved += up
+        del up
+        np.minimum(shaved, cap, out=shaved)
+        shaved <<= bits
+        shaved += offset
+    else:
+        scale = 2.0 ** bits
+        image -= offset
+        image /= scale
+        np.round(image, out=image)
+        image *= scale
+        image += offset
+
+    if threshold is not None:
+        image[sources] = values
+    return image
+
+
+def as_integer_image(data):
+    """
+    Returns the data as an int32 array if every pixel is a whole number that
+    fits in 32 bits (as for fits images loaded through np.round), so the
+    lossless algorithms are run on integer data. Otherwise the data is
+    returned unchanged.
+
+    @type data: Numpy Array
+    @rtype: Numpy Array
+    """
+    if data.dtype.kind == 'f' and np.all(np.isfinite(data)) \
+    and data.min() >= -2**31 and data.max() < 2**31 \
+    and np.array_equal(data, np.round(data)):
+        return data.astype(np.int32)
+    return data
+
+
+def map_image(path):
+    """
+    Returns the data, header and integer offset of the primary image of a
+    fits file, without keeping the file open.
+
+    The data is memory mapped (it stays mapped after the file is closed, until
+    the array is deleted), so pages are only read as they are used. Unsigned
+    images (e.g. SuperBIT's 16 bit frames) are stored as signed integers with
+    a BZERO of the sign bit, and are mapped as those raw signed integers: the
+    offset returned is then BZERO, to be added with offset_image once a copy
+    is made, and 0 otherwise. Images with any other scaling (BSCALE other than
+    1, another BZERO, or BLANK) cannot be mapped and are read by Astropy in
+    their scaled dtype.
+
+    @type path: String
+    @rtype: Tuple[Numpy Array, Header, Int]
+    """
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) \
+    as hdu_list:
+        data, header = hdu_list[0].data, hdu_list[0].header
+        bzero = header.get("BZERO", 0)
+        if data is not None and "BLANK" not in header \
+        and header.get("BSCALE", 1) == 1 and (bzero == 0 \
+        or (data.dtype.kind == 'i' and bzero == 2**(8 * data.itemsize - 1))):
+            return data, header, int(bzero)
+    with fits.open(path, memmap=False) as hdu_list:
+        return hdu_list[0].data, hdu_list[0].header, 0
+
+
+def offset_image(raw, bzero):
+    """
+    Returns a copy of the raw signed integers of an image mapped by map_image
+    with bzero (the sign bit) added, in the unsigned dtype of the same size,
+    as Astropy would scale them.
+
+    @type raw: Numpy Array
+    @type bzero: Int
+    @rtype: Numpy Array
+    """
+    dtype = np.dtype("u" + str(raw.itemsize))
+    image = raw.astype(dtype)
+    image += dtype.type(bzero)
+    return image
+
+
+def read_image(path):
+    """
+    Returns the data and header of the primary image of a fits file, without
+    keeping the file open.
+
+    The data is memory mapped when it can be used as it is stored (see
+    map_image). Unsigned images are read into a copy in their unsigned dtype
+    (uint16 for unsigned 16 bit images).
+
+    @type path: String
+    @rtype: Tuple[Numpy Array, Header]
+    """
+    data, header, bzero = map_image(path)
+    if bzero:
+        data = offset_image(data, bzero)
+    return data, header
+
+
+def tile_compress(data, compression_type='HCOMPRESS_1', header=None, **kwargs):
+    """
+    Compresses the data with one of Astropy's tile compression algorithms
+    entirely in memory and returns the bytes of the compressed fits file.
+
+    Any other keyword (hcomp_scale, hcomp_smooth, quantize_level, ...) is
+    passed on to fits.CompImageHDU.
+
+    @type data: Numpy Array
+    @type compression_type: String (HCOMPRESS_1, RICE_1, GZIP_1, ...)
+    @type header: fits.Header or None
+    @rtype: Bytes
+    """
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, header=header, \
+    compression_type=compression_type, **kwargs)]).writeto(buffer)
+    return buffer.getvalue()
+
+
+def tile_decompress(compressed):
+    """
+    Decompresses the bytes returned by tile_compress back into an array.
+
+    @type compressed: Bytes
+    @rtype: Numpy Array
+    """
+    with fits.open(io.BytesIO(compressed)) as hdu_list:
+        return hdu_list[1].data
+
+
+def tile_grid(shape, tile_shape=TILE_SHAPE):
+    """
+    Splits an image of the given shape into tiles and returns their bounds
+    (y0, y1, x0, x1), row by row. The tiles on the bottom and right edges
+    may be smaller.
+
+    @type shape: Tuple[Int, Int]
+    @type tile_shape: Tuple[Int, Int] (Rows and columns of a tile)
+    @rtype: List[Tuple[Int, Int, Int, Int]]
+    """
+    return [(y0, min(y0 + tile_shape[0], shape[0]), \
+    x0, min(x0 + tile_shape[1], shape[1])) \
+    for y0 in range(0, shape[0], tile_shape[0]) \
+    for x0 in range(0, shape[1], tile_shape[1])]
+
+
+def plan_tiles(shape, cat=None, tile_shape=TILE_SHAPE, rich=RICH_TILES, \
+poor=POOR_TILES, min_sources=1):
+    """
+    Returns the compression plan of compress_tiled: one dictionary per tile
+    with its bounds, algorithm, parameters and number of sources.
+
+    Tiles holding at least min_sources sources of the catalog (by X_IMAGE
+    and Y_IMAGE) are compressed with rich, the others with poor. The tiles
+    are ordered from the most to the least sources, so the star rich tiles
+    come first in the compressed file.
+
+    Any parameter of fits.CompImageHDU can be given, plus 'bits' to bit
+    shave the tile (see quantize_bits) before it is compressed.
+
+    @type shape: Tuple[Int, Int]
+    @type cat: Numpy Array or None (SExtractor catalog)
+    @type tile_shape: Tuple[Int, Int]
+    @type rich: Tuple[String, Dictionary]
+    @type poor: Tuple[String, Dictionary]
+    @type min_sources: Int
+    @rtype: List[Dictionary]
+    """
+    tiles = tile_grid(shape, tile_shape)
+    counts = np.zeros(len(tiles), dtype=int)
+    if cat is not None and len(cat):
+        # SExtractor positions start at 1
+        row = np.floor(np.asarray(cat)[:, 2] - 1).astype(int) // tile_shape[0]
+        col = np.floor(np.asarray(cat)[:, 1] - 1).astype(int) // tile_shape[1]
+        cols = -(-shape[1] // tile_shape[1])
+        inside = (row >= 0) & (col >= 0) & (row * tile_shape[0] < shape[0]) \
+        & (col < cols)
+        counts = np.bincount(row[inside] * cols + col[inside], \
+        minlength=len(tiles))
+    plan = []
+    for bounds, count in zip(tiles, counts.tolist()):
+        algorithm, params = rich if count >= min_sources else poor
+        plan.append({'bounds': bounds, 'algorithm': algorithm, \
+        'params': dict(params), 'sources': count})
+    plan.sort(key=lambda tile: -tile['sources'])
+    return plan
+
+
+def compress_tile(task):
+    """
+    Compresses one tile of compress_tiled and returns the bytes of its
+    compressed image extension. This is a module level function so it can be
+    sent to worker processes.
+
+    task is the tuple (data, algorithm, params, cards), where cards are the
+    header keywords of the extension.
+
+    Float tiles holding whole numbers (e.g. np.round-ed frames) are
+    compressed as int32 (see as_integer_image), since Astropy quantizes float
+    data and lossless parameters would not round trip exactly otherwise.
+
+    @type task: Tuple
+    @rtype: Bytes
+    """
+    data, algorithm, params, cards = task
+    params = dict(params)
+    bits = params.pop('bits', None)
+    data = as_integer_image(data)
+    if bits:
+        data = quantize_bits(np.array(data), bits)
+    compressed = tile_compress(data, algorithm, header=fits.Header(cards), \
+    **params)
+    with fits.open(io.BytesIO(compressed)) as hdu_list:
+        start = hdu_list[1].fileinfo()['hdrLoc']
+    return compressed[start:]
+
+
+def compress_tiled(image, plan, workers=None, header=None):
+    """
+    Compresses every tile of the plan (see plan_tiles) on its own, in
+    parallel over workers processes, and returns the bytes of a multi
+    extension fits file holding one compressed image extension per tile, in
+    the order of the plan.
+
+    Each extension records the position of its tile (TILEY, TILEX) and its
+    number of sources (SOURCES), and the primary header the shape of the
+    image (IMAGEY, IMAGEX) and the keywords of header, so the file can be
+    decoded tile by tile with decompress_tiled.
+
+    @type image: Numpy Array
+    @type plan: List[Dictionary]
+    @type workers: Int or None (Number of processes, 1 or None for serial)
+    @type header: Dictionary or None
+    @rtype: Bytes
+    """
+    tasks = []
+    for tile in plan:
+        y0, y1, x0, x1 = tile['bounds']
+        tasks.append((image[y0:y1, x0:x1], tile['algorithm'], tile['params'], \
+        [('TILEY', y0, 'First row of the tile'), \
+        ('TILEX', x0, 'First column of the tile'), \
+        ('SOURCES', tile['sources'], 'Number of sources in the tile')]))
+    if workers is not None and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            extensions = list(pool.map(compress_tile, tasks))
+    else:
+        extensions = [compress_tile(task) for task in tasks]
+
+    primary = fits.PrimaryHDU()
+    for key, value in (header or {}).items():
+        if key and not key.startswith(STRUCTURAL_KEYS) \
+        and key not in ('COMMENT', 'HISTORY'):
+            primary.header[key] = value
+    primary.header['EXTEND'] = True
+    primary.header['IMAGEY'] = (image.shape[0], 'Rows of the tiled image')
+    primary.header['IMAGEX'] = (image.shape[1], 'Columns of the tiled image')
+    primary.header['NTILES'] = (len(plan), 'Number of tile extensions')
+    buffer = io.BytesIO()
+    primary.writeto(buffer)
+    return buffer.getvalue() + b''.join(extensions)
+
+
+def _open_tiled(file):
+    """
+    Opens a file written by compress_tiled, given as bytes, a path or a file
+    object.
+
+    @type file: Bytes, String or File
+    @rtype: HDUList
+    """
+    if isinstance(file, bytes):
+        file = io.BytesIO(file)
+    return fits.open(file)
+
+
+def read_tiles(file):
+    """
+    Returns the bounds (y0, y1, x0, x1) and number of sources of every tile
+    of a file written by compress_tiled, in the order they are stored,
+    without decompressing anything.
+
+    @type file: Bytes, String or File
+    @rtype: List[Dictionary]
+    """
+    with _open_tiled(file) as hdu_list:
+        tiles = []
+        for hdu in hdu_list[1:]:
+            y0, x0 = hdu.header['TILEY'], hdu.header['TILEX']
+            tiles.append({'bounds': (y0, y0 + hdu.shape[0], x0, \
+            x0 + hdu.shape[1]), 'sources': hdu.header['SOURCES']})
+        return tiles
+
+
+def decompress_tiled(file, region=None):
+    """
+    Decompresses a file written by compress_tiled. Only the tiles overlapping
+    region (y0, y1, x0, x1), by default the whole image, are decompressed,
+    and the region is returned.
+
+    @type file: Bytes, String or File
+    @type region: Tuple[Int, Int, Int, Int] or None
+    @rtype: Numpy Array
+    """
+    with _open_tiled(file) as hdu_list:
+        if region is None:
+            region = (0, hdu_list[0].header['IMAGEY'], \
+            0, hdu_list[0].header['IMAGEX'])
+        ry0, ry1, rx0, rx1 = region
+        result = None
+        for hdu in hdu_list[1:]:
+            y0, x0 = hdu.header['TILEY'], hdu.header['TILEX']
+            y1, x1 = y0 + hdu.shape[0], x0 + hdu.shape[1]
+            if y1 <= ry0 or y0 >= ry1 or x1 <= rx0 or x0 >= rx1:
+                continue
+            data = hdu.data
+            if result is None:
+                result = np.zeros((ry1 - ry0, rx1 - rx0), dtype=data.dtype)
+            elif result.dtype != data.dtype:
+                result = result.astype(np.result_type(result, data))
+            oy0, oy1 = max(y0, ry0), min(y1, ry1)
+            ox0, ox1 = max(x0, rx0), min(x1, rx1)
+            result[oy0 - ry0:oy1 - ry0, ox0 - rx0:ox1 - rx0] = \
+            data[oy0 - y0:oy1 - y0, ox0 - x0:ox1 - x0]
+        if result is None:
+            result = np.zeros((ry1 - ry0, rx1 - rx0))
+        return result
+
+
+def cookie_bounds(cat, shape):
+    """
+    Returns the bounds of the square cookie cut around every source of the
+    catalog (see ImageCompression.square_cookie) as arrays left_x, right_x,
+    up_y, down_y, and the size class of every source (1 for small, 2 for
+    medium and 3 for big sources).
+
+    The bounds are those of the slices
+    image[up_y:down_y, left_x:right_x], made non negative and clipped to the
+    image, so they select exactly the same pixels.
+
+    @type cat: Numpy Array (SExtractor catalog)
+    @type shape: Tuple[Int, Int] (Shape of the image)
+    @rtype: Tuple[Numpy Array, Numpy Array, Numpy Array, Numpy Array, Numpy Array]
+    """
+    cat = np.atleast_2d(np.asarray(cat, dtype=float))
+    x, y, a_size, b_size = cat[:, 1], cat[:, 2], cat[:, 3], cat[:, 4]
+    small = (a_size <= 1.2) & (b_size <= 0.950)
+    medium = ~small & (a_size > 10)
+    size_class = np.where(small, 1, np.where(medium, 2, 3))
+    square_size = np.where(small, 3, np.where(medium, 65, 10))
+
+    def bounds(center, high):
+        low = np.where(center - square_size < 0, 0, \
+        np.where(center + square_size > high, \
+        np.floor(center - square_size - (center + square_size - high)), \
+        np.round(center - square_size)))
+        upper = np.where(center - square_size < 0, \
+        np.floor(center + square_size - (center - square_size)), \
+        np.where(center + square_size > high, high, \
+        np.round(center + square_size)))
+        low = low.astype(int)
+        upper = upper.astype(int)
+        # Negative starts count from the end of the image, as in a slice.
+        low = np.where(low < 0, np.maximum(low + high, 0), low)
+        upper = np.minimum(np.where(upper < 0, upper + high, upper), high)
+        return low, np.maximum(upper, low)
+
+    left_x, right_x = bounds(x, shape[1])
+    up_y, down_y = bounds(y, shape[0])
+    return left_x, right_x, up_y, down_y, size_class
+
+
+def cookie_mask(bounds, shape):
+    """
+    Returns the mask of every pixel inside at least one of the cookies
+    (left_x, right_x, up_y, down_y as returned by cookie_bounds).
+
+    The boxes are added to a difference array whose cumulative sums count
+    the boxes covering every pixel, so the mask costs the same for any number
+    of sources.
+
+    @type bounds: Tuple[Numpy Array, Numpy Array, Numpy Array, Numpy Array]
+    @type shape: Tuple[Int, Int]
+    @rtype: Numpy Array (Boolean)
+    """
+    left_x, right_x, up_y, down_y = bounds[:4]
+    count = np.zeros((shape[0] + 1, shape[1] + 1), dtype=np.int32)
+    np.add.at(count, (up_y, left_x), 1)
+    np.add.at(count, (up_y, right_x), -1)
+    np.add.at(count, (down_y, left_x), -1)
+    np.add.at(count, (down_y, right_x), 1)
+    np.cumsum(count, axis=0, out=count)
+    np.cumsum(count, axis=1, out=count)
+    return count[:shape[0], :shape[1]] > 0
+
+
+class SourceFlags:
+    """
+    A compact store of the flagged (source) pixels of an image.
+
+    The positions of the flagged pixels are kept as a bitmask packed 8 pixels
+    to a byte and their values are kept in row-major order, so the flags of a
+    full SuperBIT frame take ~3.7 MB plus 2 bytes per flagged pixel instead
+    of one Python tuple per pixel.
+
+    The flags can be saved as a sidecar file (a compressed .npz) and sent
+    beside the lossy compressed frame.
+    """
+    def __init__(self, shape, packed, values, threshold=None):
+        """
+        Initializes a new SourceFlags object. Use SourceFlags.from_image to
+        flag the pixels of an image.
+
+        @type self: SourceFlags
+        @type shape: Tuple (Shape of the flagged image)
+        @type packed: Numpy Array (np.packbits of the flattened mask)
+        @type values: Numpy Array (Values of the flagged pixels)
+        @type threshold: Number or None (Threshold used to flag the pixels)
+        @rtype: None
+        """
+        self.shape = tuple(int(n) for n in shape)
+        self.packed = packed
+        self.values = values
+        self.threshold = threshold
+
+    @classmethod
+    def from_image(cls, image, threshold=255):
+        """
+        Flags every pixel of the image above the threshold.
+
+        @type image: Numpy Array
+        @type threshold: Number
+        @rtype: SourceFlags
+        """
+        return cls.from_mask(image, image > threshold, threshold)
+
+    @classmethod
+    def from_mask(cls, image, mask, threshold=None):
+        """
+        Flags every pixel of the image where mask is True.
+
+        @type image: Numpy Array
+        @type mask: Numpy Array (Boolean, same shape as image)
+        @type threshold: Number or None
+        @rtype: SourceFlags
+        """
+        return cls(image.shape, np.packbits(mask, axis=None), image[mask], \
+        threshold)
+
+    @property
+    def mask(self):
+        """
+        The boolean mask of the flagged pixels.
+
+        @type self: SourceFlags
+        @rtype: Numpy Array
+        """
+        size = int(np.prod(self.shape))
+        return np.unpackbits(self.packed, count=size).view(bool) \
+        .reshape(self.shape)
+
+    @property
+    def nbytes(self):
+        """
+        Number of bytes used to store the flags in memory.
+
+        @type self: SourceFlags
+        @rtype: Int
+        """
+        return self.packed.nbytes + self.values.nbytes
+
+    def __len__(self):
+        """
+        Number of flagged pixels.
+
+        @type self: SourceFlags
+        @rtype: Int
+        """
+        return len(self.values)
+
+    def restore(self, image):
+        """
+        Restores the flagged pixel values back into the given image.
+
+        @type self: SourceFlags
+        @type image: Numpy Array (Modified in place)
+        @rtype: Numpy Array
+        """
+        image[self.mask] = self.values
+        return image
+
+    def save(self, file):
+        """
+        Saves the flags as a compressed .npz sidecar. file may be a path or a
+        writable file-like object.
+
+        @type self: SourceFlags
+        @type file: String or File
+        @rtype: None
+        """
+        threshold = np.nan if self.threshold is None else self.threshold
+        np.savez_compressed(file, shape=np.array(self.shape), \
+        packed=self.packed, values=self.values, threshold=threshold)
+
+    @classmethod
+    def load(cls, file):
+        """
+        Loads flags saved by SourceFlags.save.
+
+        @type file: String or File
+        @rtype: SourceFlags
+        """
+        with np.load(file) as sidecar:
+            threshold = sidecar["threshold"].item()
+            if threshold != threshold: # NaN, no threshold was used
+                threshold = None
+            return cls(sidecar["shape"], sidecar["packed"], \
+            sidecar["values"], threshold)
+
+
+class SourcePayload:
+    """
+    The pixels of the source regions cut out of an image by masking, stored
+    as the bounds of the regions and the values of the pixels inside them.
+
+    The regions are rectangles (left_x, right_x, up_y, down_y as returned by
+    cookie_bounds) and the values of the pixels covered by at least one of
+    them are kept once, in row-major order, in the smallest integer dtype
+    that holds them. The payload is serialized as a fits file with both
+    arrays RICE compressed (GZIP for non integer values), which is what is
+    sent beside the lossy compressed background.
+    """
+    def __init__(self, shape, bounds, values, dtype=None):
+        """
+        Initializes a new SourcePayload object. Use SourcePayload.from_image
+        to cut the regions out of an image.
+
+        @type self: SourcePayload
+        @type shape: Tuple (Shape of the image)
+        @type bounds: Numpy Array (One row of left_x, right_x, up_y, down_y
+        per region)
+        @type values: Numpy Array (Values of the pixels in the regions)
+        @type dtype: Numpy dtype or None (dtype of the image, that of values
+        by default)
+        @rtype: None
+        """
+        self.shape = tuple(int(n) for n in shape)
+        self.bounds = np.asarray(bounds, dtype=np.int32).reshape(-1, 4)
+        self.values = values
+        self.dtype = np.dtype(values.dtype if dtype is None else dtype)
+
+    @classmethod
+    def from_image(cls, image, bounds):
+        """
+        Cuts the regions (see cookie_bounds) out of the image.
+
+        @type image: Numpy Array
+        @type bounds: Tuple[Numpy Array, Numpy Array, Numpy Array, Numpy Array]
+        @rtype: SourcePayload
+        """
+        bounds = np.stack(bounds[:4], axis=1)
+        # Empty regions hold no pixels.
+        bounds = bounds[(bounds[:, 0] < bounds[:, 1]) & \
+        (bounds[:, 2] < bounds[:, 3])]
+        values = image[cookie_mask(bounds.T, image.shape)]
+        return cls(image.shape, bounds, smallest_int(values), image.dtype)
+
+    @property
+    def mask(self):
+        """
+        The boolean mask of the pixels in the regions.
+
+        @type self: SourcePayload
+        @rtype: Numpy Array
+        """
+        return cookie_mask(self.bounds.T, self.shape)
+
+    @property
+    def nbytes(self):
+        """
+        Number of bytes used to store the payload in memory.
+
+        @type self: SourcePayload
+        @rtype: Int
+        """
+        return self.bounds.nbytes + self.values.nbytes
+
+    def __len__(self):
+        """
+        Number of pixels in the regions.
+
+        @type self: SourcePayload
+        @rtype: Int
+        """
+        return len(self.values)
+
+    def restore(self, image):
+        """
+        Puts the pixel values of the regions back into the given image.
+
+        @type self: SourcePayload
+        @type image: Numpy Array (Modified in place)
+        @rtype: Numpy Array
+        """
+        image[self.mask] = self.values
+        return image
+
+    def to_bytes(self):
+        """
+        Returns the payload as the bytes of a fits file, whose first
+        extension holds the bounds and second the values. Both are
+        compressed losslessly.
+
+        @type self: SourcePayload
+        @rtype: Bytes
+        """
+        header = fits.Header()
+        header["IMWIDTH"] = (self.shape[1], "Width of the image")
+        header["IMHEIGHT"] = (self.shape[0], "Height of the image")
+        header["ORIGTYPE"] = (self.dtype.str, "dtype of the image")
+        values_type = "RICE_1" if self.values.dtype.kind in "ui" else "GZIP_2"
+        buffer = io.BytesIO()
+        fits.HDUList([fits.PrimaryHDU(header=header), \
+        fits.CompImageHDU(self.bounds if len(self.bounds) else None, \
+        compression_type="RICE_1"), \
+        fits.CompImageHDU(self.values if len(self.values) else None, \
+        compression_type=values_type, \
+        quantize_level=0)]).writeto(buffer)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, payload):
+        """
+        Reads a payload written by SourcePayload.to_bytes.
+
+        @type payload: Bytes
+        @rtype: SourcePayload
+        """
+        with fits.open(io.BytesIO(payload)) as hdu_list:
+            header = hdu_list[0].header
+            bounds = hdu_list[1].data
+            values = hdu_list[2].data
+            return cls((header["IMHEIGHT"], header["IMWIDTH"]), \
+            np.zeros((0, 4)) if bounds is None else bounds, \
+            np.zeros(0, dtype=np.uint8) if values is None else values, \
+            header["ORIGTYPE"])
+
+    def save(self, file):
+        """
+        Saves the payload to a fits file (see SourcePayload.to_bytes).
+
+        @type self: SourcePayload
+        @type file: String
+        @rtype: None
+        """
+        with open(file, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, file):
+        """
+        Loads a payload saved by SourcePayload.save.
+
+        @type file: String
+        @rtype: SourcePayload
+        """
+        with open(file, "rb") as f:
+            return cls.from_bytes(f.read())
+
+
+def smallest_int(values):
+    """
+    Returns the values in the smallest of uint8, int16, uint16 and int32
+    that holds them exactly, or unchanged if they are not all integers or do
+    not fit.
+
+    @type values: Numpy Array
+    @rtype: Numpy Array
+    """
+    if len(values) == 0:
+        return values.astype(np.uint8)
+    if values.dtype.kind == "f" and not np.all(np.mod(values, 1) == 0):
+        return values
+    if values.dtype.kind not in "uif":
+        return values
+    low, high = values.min(), values.max()
+    for dtype in (np.uint8, np.int16, np.uint16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+    return values
+
+
 class ImageCompression:
     """
     SuperBit_Compression is a class object that compresses an image using 
@@ -18,7 +805,7 @@ class ImageCompression:
     either lossless or lossy depending on the quantization factor.
 
     """
-    def __init__(self, image_file, cat="", crop=False):
+    def __init__(self, image_file, cat="", crop=False, out_dir=COMP_SOURCE):
         """
         A SuperBit compression object which is used to compress an fits image 
         file. NOTE- the image must be a fits file in order for this program to
@@ -55,82 +842,251 @@ class ImageCompression:
         ###################################################################################################
     
         If the parameters are not set as such, this program will fail to run.
+
+        The image and the catalog may also be given directly as Numpy Arrays
+        (the catalog as returned by an extractor, see extractor.py), in which
+        case nothing is read from disk.
+
+        The compressed images are written to out_dir, named after the image
+        (see write). Paths are never relative to a changed working directory,
+        so several ImageCompression objects can be used from seperate
+        threads.
     
         @type self: SuperBit_compression object
-        @type image_file: String (Name of fits image)
-        @type cat: String (Name of test.cat file from SExtractor)
+        @type image_file: String (Path of fits image) or Numpy Array
+        @type cat: String (Path of test.cat file from SExtractor) or Numpy Array
+        @type out_dir: String (Directory of the compressed images)
         @rtype: None
         """
         self.bit_reduction = 4 # 4 is set to default unless specified otherwise
-        self.hdu_list = fits.open(image_file)
-        self.image_name = image_file
-        self.original_image = np.round(self.hdu_list[0].data) #convert image to int values.
+        # Raw mapped integers of an unsigned image and their BZERO offset,
+        # only added once a copy is made (see map_image and original_image).
+        self._raw_image = None
+        self.bzero = 0
+        if isinstance(image_file, np.ndarray):
+            hdu = fits.PrimaryHDU(data=image_file)
+            self.image_name = "image.fits"
+            self._original_image = hdu.data
+            self.header = hdu.header
+        else:
+            image, self.header, self.bzero = map_image(image_file)
+            if self.bzero:
+                self._raw_image, self._original_image = image, None
+            else:
+                self._original_image = image
+            self.image_name = os.path.basename(image_file)
+        self.out_dir = out_dir
+        # Convert float images to int values. Integer images are kept as they
+        # are, without a copy.
+        if self._raw_image is None and self.original_image.dtype.kind == 'f':
+            self.original_image = np.round(self.original_image)
         
         if crop: # crop the edges of image
-            self.original_image = self.crop()
+            if self._raw_image is None:
+                self.original_image = self.crop()
+            else:
+                self._raw_image = self.crop(self._raw_image)
         
         # Create a dictionary for header
-        self.header = self.hdu_list[0].header
         keys = list(self.header.keys())
         dict = {}
         for key in keys:
             dict[key] = self.header[key]
         self.header = dict
         
-        self.flags = []
+        self.flags = None
         self.cookies = None
-        
-        # Median of the original image
-        self.median = np.median(self.original_image)
+        self.compressed_size = None
+        self.payload_size = None
+        self._median = None
         
         # Text Files contraing Sextractor Info On different Images
-        self.SExtract_data = np.loadtxt(cat, comments="#")
+        if isinstance(cat, np.ndarray):
+            self.SExtract_data = np.atleast_2d(cat)
+        else:
+            self.SExtract_data = catalog_data(cat)
         
-        # Compressed Image
-        self.compressed_image = self.original_image.copy()
-        # H-Compress Image
-        self.h_compress = self.original_image.copy()
-        # Masked Image
-        self.masked_image  = self.original_image.copy()
+        # Working copies of the original image, only made when first used
+        # (see working_copy).
+        self._compressed_image = None
+        self._h_compress = None
+        self._masked_image = None
         
         # Number of sources for Big, Medium, Small size.
         self.c1 = self.c2 = self.c3 = 0
 
-    def flag_stars(self):
+    @property
+    def original_image(self):
         """
-        Locates all the position of pixel values of that take up 2 bytes of memory
-        and obtains their coordinates.
-        
+        Original image. An unsigned image is kept as its mapped raw integers
+        until it is first used, then offset by BZERO into a copy.
+
+        @type self: SuperBit_compression
+        @rtype: Numpy Array
+        """
+        if self._original_image is None:
+            self._original_image = offset_image(self._raw_image, self.bzero)
+            self._raw_image = None
+        return self._original_image
+
+    @original_image.setter
+    def original_image(self, image):
+        self._original_image = image
+        self._raw_image = None
+
+    def working_copy(self):
+        """
+        Returns a copy of the original image to be compressed in place. The
+        copy of an unsigned image still kept raw is offset straight from the
+        mapped integers, without a copy of the original image.
+
+        @type self: SuperBit_compression
+        @rtype: Numpy Array
+        """
+        if self._original_image is None:
+            return offset_image(self._raw_image, self.bzero)
+        return np.array(self.original_image)
+
+    @property
+    def median(self):
+        """
+        Median of the original image, computed when first used.
+
+        @type self: SuperBit_compression
+        @rtype: Number
+        """
+        if self._median is None:
+            self._median = np.median(self.original_image)
+        return self._median
+
+    @property
+    def compressed_image(self):
+        """
+        Bit Shaved Image, a copy of the original until bit_shaving is run.
+
+        @type self: SuperBit_compression
+        @rtype: Numpy Array
+        """
+        if self._compressed_image is None:
+            self._compressed_image = self.working_copy()
+        return self._compressed_image
+
+    @compressed_image.setter
+    def compressed_image(self, image):
+        self._compressed_image = image
+
+    @property
+    def h_compress(self):
+        """
+        H-Compress Image, a copy of the original until H_Compression is run.
+
+        @type self: SuperBit_compression
+        @rtype: Numpy Array
+        """
+        if self._h_compress is None:
+            self._h_compress = self.working_copy()
+        return self._h_compress
+
+    @h_compress.setter
+    def h_compress(self, image):
+        self._h_compress = image
+
+    @property
+    def masked_image(self):
+        """
+        Masked Image, a copy of the original.
+
+        @type self: SuperBit_compression
+        @rtype: Numpy Array
+        """
+        if self._masked_image is None:
+            self._masked_image = self.working_copy()
+        return self._masked_image
+
+    @masked_image.setter
+    def masked_image(self, image):
+        self._masked_image = image
+
+    def flag_stars(self, threshold=255):
+        """
+        Locates all the pixels above the threshold (by default, the pixel
+        values that take up 2 bytes of memory) and stores them as SourceFlags.
+
         @type self: SuperBIT_compression
-        @rtype: None
+        @type threshold: Number
+        @rtype: SourceFlags
         """
-        pos = np.where(self.original_image > 255)
-        flags = []
-        for i in range(len(pos[0])):
-            flags.append((self.original_image[pos[0][i]][pos[1][i]], pos[0][i], pos[1][i]))
-        self.flags = flags
-        
+        self.flags = SourceFlags.from_image(self.original_image, threshold)
+        return self.flags
+
     def restore_flags(self, image):
         """
-        Takes the stored coordinates of every 2 byte value pixel from the original
-        image and restores these values back into the given image.
-        
+        Restores the flagged pixel values from the original image back into
+        the given image. The pixels are flagged (see flag_stars) if they were
+        not yet.
+
+        @type self: SuperBit_Compression
+        @type image: Numpy Array
+        @rtype: Numpy Array
+        """
+        if self.flags is None:
+            self.flag_stars()
+        return self.flags.restore(image)
+
+    def save_flags(self, file):
+        """
+        Saves the flagged pixels as a sidecar file to be sent beside the
+        compressed image, flagging them first if they were not yet. See
+        SourceFlags.save.
+
         @type self: SuperBit_Compression
+        @type file: String or File
         @rtype: None
         """
-        for flag in self.flags:
-            image[flag[1]][flag[2]]=flag[0]
-        return image
+        if self.flags is None:
+            self.flag_stars()
+        self.flags.save(file)
+
+    def output_path(self, algorithm):
+        """
+        Returns the path the image compressed by algorithm is written to,
+        <out_dir>/<algorithm>_<image_name>.
+
+        @type self: SuperBit_Compression
+        @type algorithm: String ('hcomp' or 'bs')
+        @rtype: String
+        """
+        return os.path.join(self.out_dir, algorithm.lower() + "_" + \
+        self.image_name)
+
+    def write(self, algorithm, file=None):
+        """
+        Writes the image compressed by algorithm ('hcomp' for H-Transformation
+        and masking, 'bs' for Bit-Shaving) with the original header to file,
+        a path or a writable file object. By default it is written to
+        output_path(algorithm).
+
+        @type self: SuperBit_Compression
+        @type algorithm: String ('hcomp' or 'bs')
+        @type file: String, File or None
+        @rtype: None
+        """
+        image = self.h_compress if algorithm.lower() == "hcomp" \
+        else self.compressed_image
+        write_fits(self.output_path(algorithm) if file is None else file, \
+        image, self.header)
         
-    def crop(self):
+    def crop(self, image=None):
         """
-        Crops the image by shaving a width of 50 pixels from each side.
+        Crops the image (the original image by default) by shaving a width
+        of 50 pixels from each side.
         
-        @type matrix: Numpy Matrix
+        @type image: Numpy Matrix or None
         @rtype: Numpy Matrix
         """
-        return self.original_image[50:self.original_image.shape[0]-50, \
-        50:self.original_image.shape[1]-50]
+        if image is None:
+            image = self.original_image
+        return image[50:image.shape[0]-50, 50:image.shape[1]-50]
         
     def shown_region(self, x, y):
         """
@@ -179,260 +1135,182 @@ class ImageCompression:
         masking: Boolean
         @rtype: Tuple of ints
         """
-        y_max = self.original_image.shape[0]
-        x_max = self.original_image.shape[1]
-        # square_size = (a_size + b_size) * 4
-        
-        # SMALL SOURCE #
-        if a_size <= 1.2 and b_size <= 0.950:
-            self.c1 +=1
-            square_size = 3 # change this to 4
-        # MEDIUM SOURCE #
-        elif a_size > 10:
-            #change this later
-            square_size = 65
-            self.c2 += 1
-        # BIG SOURCE #
-        else:
-            #change this later
-            square_size = 10
-            self.c3 += 1
-        left_x = right_x = 0
-        up_y = down_y = 0
-        
-        if x - square_size < 0:
-            left_x = 0
-            right_x = int(x + square_size - (x - square_size))
-        elif x + square_size > x_max: 
-            left_x =  int(np.floor(x - (square_size) - (x + square_size - x_max))) 
-            right_x = x_max 
-        else:
-            left_x = int(round(x - square_size))
-            right_x = int(round(x + square_size))
-            
-        if y - square_size < 0:
-            up_y = 0
-            down_y = int(y + square_size - (y - square_size))
-        elif y + square_size > y_max:
-            up_y = int(np.floor(y - (square_size) - (y + square_size - y_max)))
-            down_y = y_max 
-        else:
-            up_y = int(round(y - square_size))
-            down_y = int(round(y + square_size))
+        bounds = cookie_bounds([[0, x, y, a_size, b_size]], \
+        self.original_image.shape)
+        left_x, right_x, up_y, down_y = [int(bound[0]) for bound in bounds[:4]]
         return(left_x, right_x, up_y, down_y)
         
     def cc_stars(self):
         """
-        Locates the star position and cuts a square region around it, 
-        maintaining all of its ORIGINAL pixels values.
+        Locates the star positions and computes the square regions around
+        them (see cookie_bounds) whose ORIGINAL pixel values are kept.
+
+        The union of the regions is stored in self.cookies as a mask, and the
+        number of small, medium and big sources in self.c1, self.c2 and
+        self.c3.
         
         @type self: SuperBit_Compression
         @rtype: Numpy Array 
         """
-        y_max = self.original_image.shape[0]
-        x_max = self.original_image.shape[1]
-        sext_data = self.SExtract_data
-        regions = []
-        
-        if len(sext_data) == 10:
-            star = sext_data
-            flux = star[0]
-            x = star[1]
-            y = star[2]
-            a_size = star[3]
-            b_size = star[4]
-            left_x, right_x, up_y, down_y = self.square_cookie(a_size, b_size, x, y)
-            region = self.original_image[up_y:down_y, left_x:right_x]
-            regions.append((region, x, y, a_size, b_size))
-            self.cookies = regions
-        else:
-            for star in sext_data:
-                flux = star[0]
-                x = star[1]
-                y = star[2]
-                a_size = star[3]
-                b_size = star[4]
-                left_x, right_x, up_y, down_y = self.square_cookie(a_size, b_size, x , y)
-                region = self.original_image[up_y:down_y, left_x:right_x]
-                regions.append((region, x, y, a_size, b_size))
-                self.cookies = regions
-        
-    def cc_restore_stars(self, algorithm):
+        bounds = cookie_bounds(self.SExtract_data, self.original_image.shape)
+        size_class = bounds[4]
+        self.c1 = int(np.sum(size_class == 1))
+        self.c2 = int(np.sum(size_class == 2))
+        self.c3 = int(np.sum(size_class == 3))
+        self.cookies = cookie_mask(bounds, self.original_image.shape)
+        return self.cookies
+        
+    def cc_restore_stars(self, algorithm, save=True):
         """
         Restores the cookie cut regions back to the compressed image with the
-        ORIGINAL pixel values. 
+        ORIGINAL pixel values, in one masked copy.
         
         @type self: SuperBit_Compression
-        @type image: Numpy Array
+        @type algorithm: String (algorithm type)
+        @type save: Boolean (Write the restored image to disk)
         @rtype: None
         """
-        regions = []
-        index = 0
-        y_max = self.original_image.shape[0]
-        x_max = self.original_image.shape[1]
-        for star in self.cookies:
-            cookie = star[0]
-            x = star[1]
-            y = star[2]
-            a_size = star[3]
-            b_size = star[4]
-            
-            left_x, right_x, up_y, down_y = self.square_cookie(a_size, b_size, x ,y)
-            
-            if algorithm.lower() == "hcomp":
-                self.h_compress[up_y:down_y, left_x:right_x] = cookie
-            elif algorithm.lower() == "bs":
-                self.compressed_image[up_y:down_y, left_x:right_x] = cookie
-            index += 1
-            
         if algorithm.lower() == "hcomp":
-            fitsio.write("hcomp_" + self.image_name, self.h_compress, \
-            header=self.header, clobber=True)
+            np.copyto(self.h_compress, self.original_image, casting="unsafe", \
+            where=self.cookies)
         elif algorithm.lower() == "bs":
-            fitsio.write("bs_" + self.image_name, self.compressed_image, \
-            header=self.header, clobber=True)
+            np.copyto(self.compressed_image, self.original_image, \
+            casting="unsafe", where=self.cookies)
+            
+        if save and algorithm.lower() in ("hcomp", "bs"):
+            self.write(algorithm)
         
-    def H_Compression(self, scale_value):
+    def H_Compression(self, scale_value, save=True):
         """
-        Uses Astropy package's H-Transform Algorithm to lossfully (or losslessly) 
+        Uses Astropy package's H-Transform Algorithm to lossfully (or losslessly)
         compress the background noise of the image.
-        
+
+        The image is compressed and decompressed in memory. The size of the
+        compressed fits file (in bytes) is stored in self.compressed_size and
+        the decompressed image is only written to out_dir if save is True.
+
         @type self: SuperBit_Compression
         @type scale_value: Int (Lossy Compression Factor)
+        @type save: Boolean (Write hcomp_<image_name> to disk)
         @rtype: Numpy Matrix
         """
-        self.flag_stars()
-        os.chdir(COMP_SOURCE)
-        fits.CompImageHDU(self.h_compress, compression_type='HCOMPRESS_1', \
-        hcomp_scale=scale_value, hcomp_smooth=1).writeto("HCOMPRESS.fits", overwrite=True)  
-        fits.CompImageHDU(self.h_compress, compression_type='HCOMPRESS_1', \
-        hcomp_scale=scale_value, hcomp_smooth=1).writeto("hcomp_" + self.image_name, overwrite=True)
-        self.h_compress = fits.getdata("hcomp_" + self.image_name)
-        fitsio.write("hcomp_" + self.image_name, self.h_compress, \
-        header=self.header, clobber=True)
+        # Until it is first compressed h_compress is the original image, so the
+        # original is compressed directly instead of a copy of it.
+        image = self.original_image if self._h_compress is None \
+        else self._h_compress
+        compressed = tile_compress(image, 'HCOMPRESS_1', \
+        hcomp_scale=scale_value, hcomp_smooth=1)
+        self.compressed_size = len(compressed)
+        self.h_compress = tile_decompress(compressed)
+        if save:
+            self.write("hcomp")
+        return self.h_compress
+
+    def tiled_compression(self, c_factor, tile_shape=TILE_SHAPE, workers=None, \
+    save=True):
+        """
+        Compresses the image tile by tile (see compress_tiled). Tiles holding
+        sources of the catalog are compressed losslessly and the other tiles
+        with a H-Transformation of scale c_factor, and the star rich tiles
+        are stored first.
+
+        The size of the compressed file (in bytes) is stored in
+        self.compressed_size, and the compressed file itself is written to
+        out_dir as tiled_<image_name> if save is True. The decompressed image
+        is stored in self.h_compress and returned.
+
+        @type self: SuperBit_Compression
+        @type c_factor: Int (Lossy Compression Factor of the empty tiles)
+        @type tile_shape: Tuple[Int, Int]
+        @type workers: Int or None (Number of processes)
+        @type save: Boolean (Write tiled_<image_name> to disk)
+        @rtype: Numpy Array
+        """
+        plan = plan_tiles(self.original_image.shape, self.SExtract_data, \
+        tile_shape, poor=('HCOMPRESS_1', {'hcomp_scale': c_factor, \
+        'hcomp_smooth': 1}))
+        compressed = compress_tiled(self.original_image, plan, workers, \
+        self.header)
+        self.compressed_size = len(compressed)
+        self.h_compress = decompress_tiled(compressed)
+        if save:
+            with open(self.output_path("tiled"), "wb") as f:
+                f.write(compressed)
+        return self.h_compress
 
-    def masking(self, c_factor):
+    def masking(self, c_factor, save=True):
         """
         Masking Algorithm which will be used to flag and preserve pixel values.
         by cutting these regions out and sending them as a seperate file. The 
         region of these sources will be set to 0 and remaining portion of the 
         image will be compressed using a H Transformation.
-        
+
+        The source regions are the cookies of cc_stars, cut out as a
+        SourcePayload (self.payload) and put back into the decompressed
+        image. The size of the serialized payload (in bytes) is stored in
+        self.payload_size and the size of the compressed background in
+        self.compressed_size.
+
         @type self: SuperBit Compression
         @type c_factor: Integer (Lossy Compression Factor)
+        @type save: Boolean (Write hcomp_<image_name> and the payload,
+        payload_<image_name>, to disk)
         @rtype: Numpy Matrix
         """
-        masked_image = self.original_image.copy()
-        
-        for star in self.SExtract_data:
-            x = star[1]
-            y = star[2]
-            a_size = star[3]
-            b_size = star[4]
-            left_x, right_x, up_y, down_y = self.square_cookie(a_size, b_size, \
-            x, y, masking = True)
-            masked_image[up_y:down_y, left_x:right_x] = 0        
-        
-        diff = self.original_image - masked_image
-        x_pos, y_pos = np.where(diff != 0)
-        sources = []
-        values = []
-        
-        for i in range(len(x_pos)):
-            sources.append((x_pos[i], y_pos[i], diff[x_pos[i]][y_pos[i]]))
-            values.append(diff[x_pos[i]][y_pos[i]])
-        sources = np.array(sources)
+        bounds = cookie_bounds(self.SExtract_data, self.original_image.shape)
+        self.payload = SourcePayload.from_image(self.original_image, bounds)
+        payload = self.payload.to_bytes()
+        self.payload_size = len(payload)
         
-        self.H_Compression(c_factor)
+        masked_image = self.working_copy()
+        masked_image[self.payload.mask] = 0
+        self.masked_image = self.h_compress = masked_image
+        self.H_Compression(c_factor, save=False)
+        self.payload.restore(self.h_compress)
+        if save:
+            self.write("hcomp")
+            with open(self.output_path("payload"), "wb") as f:
+                f.write(payload)
+        return self.h_compress
         
-        for source in sources:
-            self.h_compress[int(source[0])][int(source[1])] = source[2]
-        fitsio.write("hcomp_" + self.image_name, self.h_compress, \
-        header=self.header, clobber=True)        
-        
-    def bit_shaving(self, bits=4):
+    def bit_shaving(self, bits=4, restore=False, threshold=255, save=True):
         """
         The bit shaving algorithm to reduce the size of an image.
-        
+
             ALGORITHM IMPLEMENTATION
         -------------------------------
-        1) Subtract the Median of the image pixel values.
-        2) Add the negative of the minimum value.
-        3) Find all source (pixel value > 255)
-        4) Shave off bottom 1/2/3/4 bits of the image (divide by 2/4/8/16)
-        5) Round each number to the nearest integer, but mark any source with 254.
-        
-        @type image: Numpy Matrix
+        1) Subtract the minimum value of the image.
+        2) Shave off the bottom bits of the image (divide by 2**bits).
+        3) Round each number to the nearest integer and multiply back.
+        4) Add back the minimum value.
+
+        The image is shaved in place by quantize_bits, so any bit depth can
+        be used. If restore is True, every pixel above threshold (the
+        sources) is restored to its original value after shaving.
+
+        The shaved image is only written to out_dir if save is True.
+
+        @type self: SuperBit_Compression
         @type bits: Integer (Number of bits dropped)
-        @rtype: None
+        @type restore: Boolean (Restore sources above threshold)
+        @type threshold: Number (Pixel value of a source)
+        @type save: Boolean (Write bs_<image_name> to disk)
+        @rtype: Numpy Array
         """
-        self.bit_reduction = np.floor(bits)
-        
-        # Lossless (Source position acquistion)
-        self.flag_stars()
-        
+        self.bit_reduction = int(np.floor(bits))
+
         # Set Negatives to 0
         # Uncomment below to make this run.
         # self.locate_wrappers()
-        
-        # Lossless (Value subtractions)
-        median = np.median(self.compressed_image)
-        self.compressed_image = self.compressed_image - median
-        min = np.min(self.compressed_image) 
-        self.compressed_image += -min 
-            
-        if self.bit_reduction <= 0 or self.bit_reduction > 5:
-            print("Incomprehensible Bit shave")
-            exit()
-        elif self.bit_reduction == 5: # 5 Bit Drop
-            self.compressed_image = self.compressed_image / 32
-            flag = np.where(self.compressed_image ==   7.9375)
-            for i in range(len(flag[0])):
-                self.compressed_image[flag[0][i]][flag[1][i]] = 8
-            self.compressed_image = np.round(self.compressed_image)
-            self.compressed_image = self.compressed_image * 32
-        elif self.bit_reduction == 4: # 4 Bit Drop
-            self.compressed_image = self.compressed_image / 16
-            flag = np.where(self.compressed_image == 15.875)
-            for i in range(len(flag[0])):
-                self.compressed_image[flag[0][i]][flag[1][i]] = 16
-            self.compressed_image = np.round(self.compressed_image)
-            self.compressed_image = self.compressed_image * 16
-        elif self.bit_reduction == 3: # 3 Bit Drop
-            self.compressed_image = self.compressed_image / 8
-            flag = np.where(self.compressed_image == 31.75)
-            for i in range(len(flag[0])):
-                self.compressed_image[flag[0][i]][flag[1][i]] = 32
-            self.compressed_image = np.round(self.compressed_image)
-            self.compressed_image = self.compressed_image * 8
-        elif self.bit_reduction == 2: # 2 Bit drop
-            self.compressed_image = self.compressed_image / 4
-            flag = np.where(self.compressed_image == 63.75)
-            for i in range(len(flag[0])):
-                self.compressed_image[flag[0][i]][flag[1][i]] = 64
-            self.compressed_image = np.round(self.compressed_image)
-            self.compressed_image = self.compressed_image * 4
-        elif self.bit_reduction == 1: # 1 Bit drop
-            self.compressed_image = self.compressed_image / 2
-            flag = np.where(self.compressed_image == 127.75)
-            for i in range(len(flag[0])):
-                self.compressed_image[flag[0][i]][flag[1][i]] = 127
-            self.compressed_image = np.round(self.compressed_image)
-            self.compressed_image = self.compressed_image * 2
-        
-        # Restore original pixel values to the compressed image.
-        # Uncomment below to let this run.
-        # self.compressed_image = self.restore_flags(self.compressed_image)
-        
-        # Adding back Median and Min
-        self.compressed_image += min
-        self.compressed_image += median
-        
-        os.chdir(COMP_SOURCE)    
-        fitsio.write("bs_" + self.image_name, self.compressed_image, \
-        header=self.header, clobber=True)
+
+        quantize_bits(self.compressed_image, self.bit_reduction, \
+        threshold=threshold if restore else None)
+
+        if save:
+            self.write("bs")
+        return self.compressed_image
        
-    def compress_cc(self, algorithm, c_factor=0, cc=False):
+    def compress_cc(self, algorithm, c_factor=0, cc=False, save=True):
         """
         Runs the desired algorithm alongside a cookie cut of the source regions.
         
@@ -440,25 +1318,35 @@ class ImageCompression:
         ---------
             1) hcomp ->    for H-Transformation
             2) bs    ->    for Bit-Shaving
+            3) masking ->  for Masking
+            4) tiled ->    for Tiled H-Transformation (see tiled_compression)
+        
+        If save is False, nothing is written to disk and the compressed image
+        is only returned.
         
         @type self: SBit_Compression
         @type algorithm: String (algorithm type)
         @type c_factor: Int (Lossy factor)
         @type cc: Boolean (Indicate whether you want to use Region Snipping)
-        @rtype: None
+        @type save: Boolean (Write the compressed image to disk)
+        @rtype: Numpy Array
         """
         if algorithm == "hcomp":
             self.cc_stars()
-            self.H_Compression(c_factor)
+            self.H_Compression(c_factor, save=save)
             if cc:
-                self.cc_restore_stars("hcomp")
+                self.cc_restore_stars("hcomp", save=save)
+            return self.h_compress
         elif algorithm == "masking":
-            self.masking(c_factor)
+            return self.masking(c_factor, save=save)
+        elif algorithm == "tiled":
+            return self.tiled_compression(c_factor, save=save)
         elif algorithm == "bs":
             self.cc_stars()
-            self.bit_shaving(c_factor)
+            self.bit_shaving(c_factor, save=save)
             if cc:
-                self.cc_restore_stars("bs")
+                self.cc_restore_stars("bs", save=save)
+            return self.compressed_image
     
     def show_image(self, version="original", scaling=False):
         """
@@ -575,8 +1463,6 @@ class ImageCompression:
         @type algorithm: String (Type of Compression)
         @rtype: string
         """
-        os.chdir("/home/james/Desktop/sbit_compress_py/experiment/data")
-        
         def plothist(img, title="", bins=10000, sig=1, nfig=True, label="", report=True):
             """
             HELPER FUNCTION
@@ -625,8 +1511,8 @@ class ImageCompression:
 
 if __name__ == "__main__":              
     #
-    os.chdir(OG_SOURCE)
-    sbit = ImageCompression(image_file='new-image.fits', cat="test.cat", crop=False)
+    sbit = ImageCompression(image_file=os.path.join(OG_SOURCE, 'new-image.fits'), \
+    cat=os.path.join(OG_SOURCE, "test.cat"), crop=False)
     sbit.show_image(version="original", scaling=True)
     sbit.compress_cc(algorithm='hcomp', c_factor=2, cc=False)
     # sbit.run_statistics(True, 'hcomp')
@@ -1,15 +1,16 @@
-import os
+import os, sys
 
 SRC = "/home/james/Desktop/sbit_compress_py/src"
 OG_SOURCE = "/home/james/Desktop/sbit_compress_py/original"
 COMP_SOURCE = "/home/james/Desktop/sbit_compress_py/compressed"
 DS9 = "/home/james/Desktop/sbit_compress_py/ds9"
 MAIN = "/home/james/Desktop/sbit_compress_py/"
-os.chdir(SRC)
+sys.path.insert(0, SRC)
 
 from image_compression import *
 from fake_stars import *
 from se_experiment import *
+from optimizer import FactorOptimizer, CONSTRAINTS, training_set
 
 ## UPDATE PARAMETERS HERE
 # ------------------
@@ -86,6 +87,33 @@ BRIGHTNESS = [250, 2, 2]
 REGION_CUT = False
 
 
+# ---------
+# OPTIMIZE
+# ---------
+# This parameter determines whether COMPRESSION_VALUE is replaced by the most
+# aggressive factor of COMPRESSION_TYPE that still meets the FIDELITY
+# constraints on a training set of OPTIMIZE_SOURCES simulated sources.
+#
+# FIDELITY holds the largest allowed bias and scatter of FLUX_AUTO (relative)
+# and ELLIPTICITY, and the largest fraction of sources lost after compression.
+#
+# ----------------------------------------------------------------------------
+OPTIMIZE = False
+OPTIMIZE_SOURCES = 200
+FIDELITY = CONSTRAINTS
+
+
+## OPTIMIZATION
+if OPTIMIZE:
+    optimizer = FactorOptimizer(training_set(OPTIMIZE_SOURCES, sz=SIZE, \
+    bt=BRIGHTNESS), FIDELITY)
+    factor, metrics = optimizer.optimize(COMPRESSION_TYPE)
+    if factor is None:
+        raise RuntimeError("No " + COMPRESSION_TYPE + " factor meets FIDELITY.")
+    print("Optimal factor:", factor, metrics)
+    COMPRESSION_VALUE = factor
+
+
 ## SIMULATION
 simulation = SE_Comparison(factor=COMPRESSION_VALUE, comp_type=COMPRESSION_TYPE)
 simulation.run_ss_experiment(sources=SOURCES, cut=REGION_CUT, bt=BRIGHTNESS, sz=SIZE)
@@ -0,0 +1,147 @@
+import numpy as np
+
+# Noise models of draw_noise.
+MODELS = ("gaussian", "poisson", "read")
+
+
+def draw_noise(rng, shape=None, model="gaussian", mean=0, std=29, signal=0, \
+gain=1, read_noise=0, rounded=True, dtype=np.float64, out=None):
+    """
+    Draws one noise frame, to be added to a noiseless image.
+
+        gaussian: white noise of mean mean and standard deviation std.
+        poisson: shot noise of an image of signal (ADU) on a background of
+                 mean (ADU), with gain electrons per ADU. The noise holds the
+                 background but not the signal.
+        read: poisson noise plus gaussian read noise of read_noise ADU.
+
+    The noise is rounded to whole ADU if rounded. If out is given the noise is
+    written into it (its shape and dtype are used) and out is returned.
+    float32 and float64 gaussian frames are drawn straight into out.
+
+    @type rng: Numpy Generator
+    @type shape: Tuple or None (Only None if out is given)
+    @type model: String (One of MODELS)
+    @type mean: Float
+    @type std: Float
+    @type signal: Float or Numpy Array
+    @type gain: Float
+    @type read_noise: Float
+    @type rounded: Boolean
+    @type dtype: Numpy dtype (e.g. np.float32 or np.int16)
+    @type out: Numpy Array or None
+    @rtype: Numpy Array
+    """
+    if model not in MODELS:
+        raise ValueError("model must be one of " + ", ".join(MODELS))
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    direct = out.dtype in (np.float32, np.float64)
+    noise = out if direct else np.empty(out.shape, dtype=np.float32)
+
+    if model == "gaussian":
+        rng.standard_normal(out=noise, dtype=noise.dtype)
+        noise *= std
+        noise += mean
+    else:
+        level = np.asarray(signal, dtype=np.float64) + mean
+        noise[...] = rng.poisson(np.broadcast_to(level * gain, noise.shape))
+        noise /= gain
+        noise -= np.asarray(signal, dtype=noise.dtype)
+        if model == "read":
+            noise += read_noise * rng.standard_normal(noise.shape, \
+            dtype=noise.dtype)
+
+    if rounded:
+        np.rint(noise, out=noise)
+    if not direct:
+        out[...] = noise
+    return out
+
+
+class NoiseEngine:
+    """
+    Draws noise frames of one shape and model from its own random stream.
+
+    Engines for parallel workers should be made with spawn, which gives each
+    of them an independent stream from the same SeedSequence, so the results
+    do not depend on the number of workers.
+    """
+    def __init__(self, shape, model="gaussian", mean=0, std=29, signal=0, \
+    gain=1, read_noise=0, rounded=True, dtype=np.float64, seed=None):
+        """
+        Initializes a new NoiseEngine object. See draw_noise for the model
+        parameters.
+
+        @type self: NoiseEngine
+        @type shape: Tuple
+        @type seed: Int, SeedSequence or None
+        @rtype: None
+        """
+        self.shape = tuple(shape)
+        self.model = model
+        self.mean = mean
+        self.std = std
+        self.signal = signal
+        self.gain = gain
+        self.read_noise = read_noise
+        self.rounded = rounded
+        self.dtype = np.dtype(dtype)
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+    def spawn(self, n):
+        """
+        Returns n engines with the same parameters and independent streams.
+
+        @type self: NoiseEngine
+        @type n: Int
+        @rtype: List[NoiseEngine]
+        """
+        return [NoiseEngine(self.shape, self.model, self.mean, self.std, \
+        self.signal, self.gain, self.read_noise, self.rounded, self.dtype, \
+        child) for child in self.seed.spawn(n)]
+
+    def draw(self, out=None):
+        """
+        Returns a new noise frame, written into out if given.
+
+        @type self: NoiseEngine
+        @type out: Numpy Array or None
+        @rtype: Numpy Array
+        """
+        return draw_noise(self.rng, self.shape, self.model, self.mean, \
+        self.std, self.signal, self.gain, self.read_noise, self.rounded, \
+        self.dtype, out)
+
+    def stack(self, k, out=None):
+        """
+        Returns k noise frames stacked on axis 0, written into out if given.
+
+        @type self: NoiseEngine
+        @type k: Int
+        @type out: Numpy Array or None (Shape (k,) + shape)
+        @rtype: Numpy Array
+        """
+        if out is None:
+            out = np.empty((k,) + self.shape, dtype=self.dtype)
+        for i in range(k):
+            self.draw(out[i])
+        return out
+
+    def realizations(self, k, reuse=False):
+        """
+        Yields k noise frames one at a time. With reuse every frame is drawn
+        into the same buffer, so each frame must be used before the next one
+        is asked for.
+
+        @type self: NoiseEngine
+        @type k: Int
+        @type reuse: Boolean
+        @rtype: Generator
+        """
+        buffer = np.empty(self.shape, dtype=self.dtype) if reuse else None
+        for i in range(k):
+            yield self.draw(buffer)
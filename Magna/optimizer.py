@@ -0,0 +1,296 @@
+import math
+import numpy as np
+
+from image_compression import as_integer_image, tile_compress, \
+tile_decompress, ImageCompression
+from extractor import COLUMNS, default_extractor
+from catalog import match_catalogs
+from pipeline import scenes, IMAGE
+
+# Catalog columns the fidelity of a compression is measured on.
+FLUX_AUTO = COLUMNS.index("FLUX_AUTO")
+ELLIPTICITY = COLUMNS.index("ELLIPTICITY")
+
+# Default fidelity constraints of FactorOptimizer: the largest allowed
+# (absolute) value of each metric of FactorOptimizer.evaluate.
+#   flux_bias, flux_scatter: mean and std of (compressed - original) / original
+#                            FLUX_AUTO of the matched sources.
+#   ellipticity_bias, ellipticity_scatter: mean and std of
+#                            compressed - original ELLIPTICITY.
+#   lost: fraction of the original sources with no match after compression.
+CONSTRAINTS = {"flux_bias": 0.01, "flux_scatter": 0.05, \
+"ellipticity_bias": 0.01, "ellipticity_scatter": 0.05, "lost": 0.05}
+
+
+def compress_hcomp(image, scale):
+    """
+    Compresses the image with ImageCompression.H_Compression of scale
+    hcomp_scale and returns the decompressed image and the compressed size in
+    bytes, so the factor is tuned on the same transform that is shipped.
+
+    @type image: Numpy Array
+    @type scale: Float
+    @rtype: Tuple[Numpy Array, Int]
+    """
+    sbit = ImageCompression(image, cat=np.zeros((0, 10)))
+    decompressed = sbit.H_Compression(scale, save=False)
+    return decompressed, sbit.compressed_size
+
+
+def compress_rice(image, level):
+    """
+    Quantizes the image (as float32) with RICE_1 of quantize level level and
+    returns the decompressed image and the compressed size in bytes.
+
+    @type image: Numpy Array
+    @type level: Float (quantize_level, lower is more lossy)
+    @rtype: Tuple[Numpy Array, Int]
+    """
+    compressed = tile_compress(image.astype(np.float32), 'RICE_1', \
+    quantize_level=level)
+    return tile_decompress(compressed), len(compressed)
+
+
+def compress_bs(image, bits):
+    """
+    Shaves bits bits off the image with ImageCompression.bit_shaving and
+    returns the shaved image with its RICE_1 compressed size in bytes.
+
+    @type image: Numpy Array
+    @type bits: Int
+    @rtype: Tuple[Numpy Array, Int]
+    """
+    sbit = ImageCompression(image, cat=np.zeros((0, 10)))
+    shaved = sbit.bit_shaving(int(bits), save=False)
+    return shaved, len(tile_compress(as_integer_image(shaved), 'RICE_1'))
+
+
+# Every mode searched by FactorOptimizer:
+#   (compress function, safe factor, most aggressive factor, integer factor)
+# The factor is bisected between the safe and most aggressive ones, so the
+# safe factor may be the larger one (as for RICE quantize levels).
+MODES = {"hcomp": (compress_hcomp, 0, 64, False), \
+"rice": (compress_rice, 256, 0.25, False), \
+"bs": (compress_bs, 1, 12, True)}
+
+
+def training_set(count, sz=100, bt=[200, 5, 5], sd=29, rp=True, seed=None):
+    """
+    Returns count single source FakeStars images (see pipeline.scenes) to
+    optimize the compression factor on.
+
+    @type count: Int
+    @type sz: Int (Dimension of the images)
+    @type bt: List[ints] (Brightness, x FWHM and y FWHM of the source)
+    @type sd: Int (Standard deviation of the noise)
+    @type rp: Boolean (Random position)
+    @type seed: Int or None
+    @rtype: List[Numpy Array]
+    """
+    return [item[IMAGE] for item in scenes(count, sz, bt, sd, rp, seed)]
+
+
+class FactorOptimizer:
+    """
+    Finds the most aggressive compression factor of a mode (see MODES) whose
+    compressed images still pass fidelity constraints (see CONSTRAINTS) on a
+    set of images.
+
+    The constraints are assumed to get worse as the factor gets more
+    aggressive, so the factor is bisected between a safe and an aggressive
+    factor. Each factor is evaluated image by image and rejected as soon as
+    one of the constraints is broken by more than z standard errors, so
+    factors far past the limit only cost a few images.
+    """
+    def __init__(self, images, constraints=CONSTRAINTS, extractor=None, \
+    radius=1.5, min_sources=30, z=3):
+        """
+        Initializes a new FactorOptimizer object. images may be a single
+        frame, a list of frames or a training set (see training_set).
+
+        The sources of the original images are extracted once, here.
+
+        @type self: FactorOptimizer
+        @type images: Numpy Array or List[Numpy Array]
+        @type constraints: Dictionary (Metric name to its largest value)
+        @type extractor: Extractor or None (default_extractor if None)
+        @type radius: Float (Match radius in pixels)
+        @type min_sources: Int (Original sources needed to reject early)
+        @type z: Float (Standard errors needed to reject early)
+        @rtype: None
+        """
+        if isinstance(images, np.ndarray) and images.ndim == 2:
+            images = [images]
+        if len(images) == 0:
+            raise ValueError("At least one image is needed.")
+        unknown = set(constraints) - set(CONSTRAINTS)
+        if unknown:
+            raise ValueError("Unknown constraints: " + ", ".join(unknown))
+        self.images = images
+        self.constraints = constraints
+        self.extractor = default_extractor() if extractor is None \
+        else extractor
+        self.radius = radius
+        self.min_sources = min_sources
+        self.z = z
+        self.catalogs = [self.extractor.extract(image) for image in images]
+        # Metrics of every (mode, factor) evaluated so far.
+        self.history = {}
+
+    def metrics(self, og, cs, sources):
+        """
+        Returns the metrics of the matched original and compressed catalog
+        rows, out of sources original sources, and their standard errors.
+
+        @type self: FactorOptimizer
+        @type og: Numpy Array (Matched rows of the original catalogs)
+        @type cs: Numpy Array (Matched rows of the compressed catalogs)
+        @type sources: Int
+        @rtype: Tuple[Dictionary, Dictionary]
+        """
+        bright = og[:, FLUX_AUTO] > 0
+        flux = (cs[bright, FLUX_AUTO] - og[bright, FLUX_AUTO]) / \
+        og[bright, FLUX_AUTO]
+        ellipticity = cs[:, ELLIPTICITY] - og[:, ELLIPTICITY]
+        values = {"lost": 1 - len(og) / sources if sources else 0}
+        errors = {"lost": 0}
+        for name, diff in (("flux", flux), ("ellipticity", ellipticity)):
+            n = len(diff)
+            std = float(np.std(diff)) if n else 0
+            values[name + "_bias"] = float(np.mean(diff)) if n else 0
+            values[name + "_scatter"] = std
+            errors[name + "_bias"] = std / math.sqrt(n) if n else math.inf
+            errors[name + "_scatter"] = std / math.sqrt(2 * (n - 1)) \
+            if n > 1 else math.inf
+        return values, errors
+
+    def broken(self, values, errors=None):
+        """
+        Returns the names of the constraints broken by values, or only of
+        those broken by more than z standard errors if errors is given.
+
+        @type self: FactorOptimizer
+        @type values: Dictionary
+        @type errors: Dictionary or None
+        @rtype: List[String]
+        """
+        margin = lambda name: 0 if errors is None else self.z * errors[name]
+        return [name for name, limit in self.constraints.items() \
+        if abs(values[name]) - margin(name) > limit]
+
+    def evaluate(self, mode, factor):
+        """
+        Compresses every image with the mode and factor, extracts and matches
+        their sources and returns the metrics, with:
+
+            passed:  whether every constraint holds.
+            images:  number of images compressed (fewer if rejected early).
+            matched: number of matched sources.
+            ratio:   compression ratio of the images compressed.
+
+        @type self: FactorOptimizer
+        @type mode: String (One of MODES)
+        @type factor: Number
+        @rtype: Dictionary
+        """
+        key = (mode, factor)
+        if key in self.history:
+            return self.history[key]
+        compress = MODES[mode][0]
+        og_rows, cs_rows = [], []
+        sources = raw_bytes = size = 0
+        for i, (image, og_cat) in enumerate(zip(self.images, self.catalogs)):
+            decompressed, nbytes = compress(image, factor)
+            cs_cat = self.extractor.extract(decompressed)
+            og_idx, cs_idx, separations = match_catalogs(og_cat[:, 1:3], \
+            cs_cat[:, 1:3], self.radius)
+            og_rows.append(og_cat[og_idx])
+            cs_rows.append(cs_cat[cs_idx])
+            sources += len(og_cat)
+            raw_bytes += image.nbytes
+            size += nbytes
+            if sources >= self.min_sources and i + 1 < len(self.images):
+                values, errors = self.metrics(np.concatenate(og_rows), \
+                np.concatenate(cs_rows), sources)
+                if self.broken(values, errors):
+                    break
+        values, errors = self.metrics(np.concatenate(og_rows), \
+        np.concatenate(cs_rows), sources)
+        values["passed"] = sources > 0 and not self.broken(values)
+        values["images"] = len(og_rows)
+        values["matched"] = sum(len(rows) for rows in og_rows)
+        values["ratio"] = raw_bytes / size
+        self.history[key] = values
+        return values
+
+    def optimize(self, mode, safe=None, aggressive=None, tol=0.05, \
+    max_steps=12):
+        """
+        Returns the most aggressive factor of the mode which passes the
+        constraints, and its metrics (see evaluate), or (None, metrics of the
+        safe factor) if even the safe factor fails.
+
+        The factor is bisected between safe and aggressive (the bounds of
+        MODES by default) until they are within tol of each other (relative,
+        or 1 for integer factors) or after max_steps evaluations. Factors of
+        the same sign are bisected geometrically.
+
+        @type self: FactorOptimizer
+        @type mode: String (One of MODES)
+        @type safe: Number or None
+        @type aggressive: Number or None
+        @type tol: Float
+        @type max_steps: Int
+        @rtype: Tuple[Number, Dictionary]
+        """
+        if mode not in MODES:
+            raise ValueError("mode must be one of " + ", ".join(MODES))
+        default_safe, default_aggressive, integer = MODES[mode][1:]
+        safe = default_safe if safe is None else safe
+        aggressive = default_aggressive if aggressive is None else aggressive
+
+        best = self.evaluate(mode, safe)
+        if not best["passed"]:
+            return None, best
+        metrics = self.evaluate(mode, aggressive)
+        if metrics["passed"]:
+            return aggressive, metrics
+
+        for step in range(max_steps):
+            if integer:
+                if abs(aggressive - safe) <= 1:
+                    break
+                factor = (safe + aggressive) // 2
+            else:
+                if abs(aggressive - safe) <= tol * max(abs(safe), \
+                abs(aggressive)):
+                    break
+                if safe * aggressive > 0:
+                    factor = math.copysign(math.sqrt(safe * aggressive), safe)
+                else:
+                    factor = (safe + aggressive) / 2
+            metrics = self.evaluate(mode, factor)
+            if metrics["passed"]:
+                safe, best = factor, metrics
+            else:
+                aggressive = factor
+        return safe, best
+
+    def optimize_all(self, modes=tuple(MODES), **kwargs):
+        """
+        Runs optimize for every mode and returns a dictionary of mode to
+        (factor, metrics).
+
+        @type self: FactorOptimizer
+        @type modes: Tuple[String]
+        @rtype: Dictionary
+        """
+        return {mode: self.optimize(mode, **kwargs) for mode in modes}
+
+
+## (Example)
+
+if __name__ == '__main__':
+    optimizer = FactorOptimizer(training_set(200, seed=0))
+    for mode, (factor, metrics) in optimizer.optimize_all().items():
+        print(mode, factor, metrics)
@@ -0,0 +1,191 @@
+import os
+import queue
+import threading
+import numpy as np
+from astropy.io import fits
+
+from image_compression import ImageCompression
+from fake_stars import FakeStars
+from catalog import match_catalogs
+
+# Keys of the items passed between stages. Each stage adds its own keys:
+#   scenes:   index, seed, image
+#   extract:  og_cat (or cs_cat)
+#   compress: compressed, compressed_size
+#   match:    og_idx, cs_idx, separations
+IMAGE = "image"
+COMPRESSED = "compressed"
+OG_CAT = "og_cat"
+CS_CAT = "cs_cat"
+
+_DONE = object()
+
+
+def scenes(count, sz=100, bt=[200, 5, 5], sd=29, rp=False, seed=None):
+    """
+    Yields count single source scenes (see FakeStars.create_single_source),
+    each made from its own seed spawned from seed, so the scenes do not
+    depend on how the pipeline is run.
+
+    @type count: Int
+    @type sz: Int (Dimension of the scenes)
+    @type bt: List[ints] (Brightness, x FWHM and y FWHM of the source)
+    @type sd: Int (Standard deviation of the noise)
+    @type rp: Boolean (Random position)
+    @type seed: Int or None
+    @rtype: Generator[Dictionary]
+    """
+    for i, child in enumerate(np.random.SeedSequence(seed).spawn(count)):
+        fs = FakeStars("fakestar" + str(i), sz, sz, seed=child)
+        fs.create_single_source(bt=bt[0], std=sd, xf=bt[1], yf=bt[2], \
+        rand_pos=rp, sz=sz)
+        yield {"index": i, "seed": child, IMAGE: fs.return_image()}
+
+
+def extract(items, extractor, image=IMAGE, catalog=OG_CAT):
+    """
+    Extracts the sources of the image under key image of every item and
+    stores their catalog under key catalog.
+
+    @type items: Iterable[Dictionary]
+    @type extractor: SExtractor, MomentExtractor or SepExtractor
+    @type image: String
+    @type catalog: String
+    @rtype: Generator[Dictionary]
+    """
+    for item in items:
+        item[catalog] = extractor.extract(item[image])
+        yield item
+
+
+def compress(items, algorithm="hcomp", c_factor=0, cc=False):
+    """
+    Compresses the image of every item with ImageCompression.compress_cc and
+    stores the decompressed image under key compressed. The original catalog
+    (key og_cat) is used for the cookie cutting and masking.
+
+    @type items: Iterable[Dictionary]
+    @type algorithm: String ('hcomp', 'masking' or 'bs')
+    @type c_factor: Float
+    @type cc: Boolean (Cookie cut the sources)
+    @rtype: Generator[Dictionary]
+    """
+    for item in items:
+        cat = item.get(OG_CAT)
+        sbit = ImageCompression(image_file=item[IMAGE], \
+        cat=np.zeros((0, 10)) if cat is None else cat)
+        item[COMPRESSED] = sbit.compress_cc(algorithm=algorithm, \
+        c_factor=c_factor, cc=cc, save=False)
+        item["compressed_size"] = sbit.compressed_size
+        yield item
+
+
+def match(items, radius=1.5):
+    """
+    Matches the sources of the original and compressed catalogs of every item
+    (see match_catalogs).
+
+    @type items: Iterable[Dictionary]
+    @type radius: Float (Match radius in pixels)
+    @rtype: Generator[Dictionary]
+    """
+    for item in items:
+        item["og_idx"], item["cs_idx"], item["separations"] = \
+        match_catalogs(item[OG_CAT][:, 1:3], item[CS_CAT][:, 1:3], radius)
+        yield item
+
+
+def tap(items, directory, keys=(IMAGE, COMPRESSED)):
+    """
+    Writes the images of every item to fits files in directory, named
+    <key>_<index>.fits, and passes the items on unchanged. This is only meant
+    for debugging, the other stages never touch the disk.
+
+    @type items: Iterable[Dictionary]
+    @type directory: String
+    @type keys: Tuple[String]
+    @rtype: Generator[Dictionary]
+    """
+    os.makedirs(directory, exist_ok=True)
+    for item in items:
+        for key in keys:
+            if item.get(key) is not None:
+                fits.PrimaryHDU(data=item[key]).writeto(os.path.join( \
+                directory, "{}_{:05d}.fits".format(key, item["index"])), \
+                overwrite=True)
+        yield item
+
+
+def threaded(items, maxsize=4):
+    """
+    Runs the stages feeding items in a background thread, through a queue of
+    at most maxsize items, so they overlap with the stages after this one.
+    NumPy, cfitsio and the extractor programs release the GIL, so the
+    stages do run at the same time. Errors are raised in the consumer.
+
+    @type items: Iterable[Dictionary]
+    @type maxsize: Int
+    @rtype: Generator[Dictionary]
+    """
+    buffer = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                buffer.put((item, None))
+            buffer.put((_DONE, None))
+        except BaseException as error:
+            buffer.put((_DONE, error))
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        # Unblocks the producer if it is waiting on a full queue.
+        while worker.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def single_source_pipeline(count, extractor, algorithm="hcomp", c_factor=0, \
+cc=False, sz=100, bt=[200, 5, 5], sd=29, rp=False, seed=None, radius=1.5, \
+overlap=False, debug_dir=None):
+    """
+    Returns the generator of the single source simulation of
+    SE_Comparison.run_ss_experiment: scenes, extraction, compression,
+    extraction of the compressed image and matching.
+
+    With overlap every stage runs in its own thread. With debug_dir the
+    original and compressed images are also written there (see tap).
+
+    @type count: Int (Number of sources)
+    @type extractor: SExtractor, MomentExtractor or SepExtractor
+    @type algorithm: String ('hcomp', 'masking' or 'bs')
+    @type c_factor: Float
+    @type cc: Boolean (Cookie cut the sources)
+    @type radius: Float (Match radius in pixels)
+    @type overlap: Boolean
+    @type debug_dir: String or None
+    @rtype: Generator[Dictionary]
+    """
+    stage = lambda items: threaded(items) if overlap else items
+    items = stage(scenes(count, sz, bt, sd, rp, seed))
+    items = stage(extract(items, extractor))
+    items = stage(compress(items, algorithm, c_factor, cc))
+    items = stage(extract(items, extractor, COMPRESSED, CS_CAT))
+    if debug_dir is not None:
+        items = tap(items, debug_dir)
+    return match(items, radius)
@@ -0,0 +1,146 @@
+import math
+from functools import lru_cache
+import numpy as np
+from scipy.special import erf
+
+# Half width of the rendered PSF, in FWHM. The gaussian is below 1e-30 of its
+# peak there.
+SUPPORT = 5
+
+# Number of sub-pixel positions the centre of a source is rounded to.
+PHASES = 64
+
+
+class PSFLibrary:
+    """
+    Renders gaussian point spread functions of any FWHM and sub-pixel
+    position.
+
+    A 2D gaussian is the outer product of two 1D gaussians, so only the 1D
+    profiles are computed, over SUPPORT FWHM on each side of the centre. The
+    profiles are cached by (FWHM, sub-pixel phase), so rendering a source
+    costs one outer product of a few FWHM on a side, whatever the size of the
+    image.
+
+    The profiles are either sampled at the centre of each pixel (like
+    FakeStars.create_2d_gaussian) or integrated over each pixel.
+    """
+    def __init__(self, support=SUPPORT, phases=PHASES, integrate=False, \
+    cache_size=256):
+        """
+        Initializes a new PSFLibrary object.
+
+        With phases, the sub-pixel position of a source is rounded to the
+        nearest 1/phases of a pixel so the profiles can be reused. With
+        phases=None positions are exact and only repeated positions reuse
+        a profile.
+
+        @type self: PSFLibrary
+        @type support: Float (Half width of the profiles in FWHM)
+        @type phases: Int or None (Number of sub-pixel positions)
+        @type integrate: Boolean (Integrate the profiles over each pixel)
+        @type cache_size: Int (Number of cached profiles)
+        @rtype: None
+        """
+        self.support = support
+        self.phases = phases
+        self.integrate = integrate
+        self.profile_1d = lru_cache(maxsize=cache_size)(self._profile_1d)
+
+    def _profile_1d(self, fwhm, phase):
+        """
+        Returns the 1D gaussian profile (peak value 1) of pixels -half to half
+        around a centre phase pixels past pixel 0.
+
+        @type self: PSFLibrary
+        @type fwhm: Float
+        @type phase: Float (Between 0 and 1)
+        @rtype: Numpy Array
+        """
+        half = int(math.ceil(self.support * fwhm))
+        d = np.arange(-half, half + 1) - phase
+        if self.integrate:
+            # Mean of the profile over each pixel
+            scale = fwhm / (2 * math.sqrt(math.log(2)))
+            profile = (erf((d + 0.5) / scale) - erf((d - 0.5) / scale)) * \
+            (scale * math.sqrt(math.pi) / 2)
+        else:
+            profile = np.exp(-4 * np.log(2) * d ** 2 / fwhm ** 2)
+        profile.flags.writeable = False
+        return profile
+
+    def profile(self, fwhm, center):
+        """
+        Returns the index of the first pixel of the profile of a source with
+        its centre at position center, and the profile.
+
+        @type self: PSFLibrary
+        @type fwhm: Float
+        @type center: Float (Pixel coordinate)
+        @rtype: Tuple[Int, Numpy Array]
+        """
+        base = math.floor(center)
+        phase = center - base
+        if self.phases is not None:
+            phase = round(phase * self.phases)
+            if phase == self.phases:
+                base += 1
+                phase = 0
+            phase = phase / self.phases
+        half = int(math.ceil(self.support * fwhm))
+        return base - half, self.profile_1d(float(fwhm), phase)
+
+    def render(self, image, center, xfwhm, yfwhm, btness):
+        """
+        Adds a gaussian source to the image, in place. Only the pixels within
+        the support of the PSF are touched, and the parts outside of the image
+        are cut.
+
+        center is (x, y) where x is the column and y the row, as in
+        FakeStars.create_2d_gaussian.
+
+        @type self: PSFLibrary
+        @type image: Numpy Array
+        @type center: Tuple[Float, Float]
+        @type xfwhm: Float
+        @type yfwhm: Float
+        @type btness: Float (Brightest point of the source)
+        @rtype: None
+        """
+        c0, x_profile = self.profile(xfwhm, center[0])
+        r0, y_profile = self.profile(yfwhm, center[1])
+        c1 = c0 + len(x_profile)
+        r1 = r0 + len(y_profile)
+        x_profile = x_profile[max(0, -c0):len(x_profile) - \
+        max(0, c1 - image.shape[1])]
+        y_profile = y_profile[max(0, -r0):len(y_profile) - \
+        max(0, r1 - image.shape[0])]
+        if len(x_profile) == 0 or len(y_profile) == 0:
+            return
+        stamp = image[max(0, r0):min(r1, image.shape[0]), \
+        max(0, c0):min(c1, image.shape[1])]
+        stamp += btness * np.outer(y_profile, x_profile)
+
+    def kernel(self, size, xfwhm, yfwhm, center=None, btness=1):
+        """
+        Returns a size by size image of a single gaussian source. The centre
+        defaults to the middle pixel.
+
+        @type self: PSFLibrary
+        @type size: Int
+        @type xfwhm: Float
+        @type yfwhm: Float
+        @type center: Tuple[Float, Float] or None
+        @type btness: Float
+        @rtype: Numpy Array
+        """
+        if center is None:
+            center = (size // 2, size // 2)
+        image = np.zeros((size, size))
+        self.render(image, center, xfwhm, yfwhm, btness)
+        return image
+
+
+# Library shared by every FakeStars object, so the profiles are reused across
+# trials.
+DEFAULT_PSF = PSFLibrary()
@@ -2,17 +2,163 @@ import os
 import numpy as np
 import shutil
 import matplotlib.pyplot as plt
+from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-SRC = "../src"
-os.chdir(SRC)
+# This module lives in the src directory, next to the original and compressed
+# directories.
+SRC = os.path.dirname(os.path.abspath(__file__))
 from image_compression import *
 from fake_stars import *
+from extractor import SExtractor, columns
+from catalog import catalog_data, match_catalogs
+from pipeline import single_source_pipeline
 
-OG_SOURCE = "../original"
-COMP_SOURCE = "../compressed"
-DS9 = "../ds9"
+OG_SOURCE = os.path.normpath(os.path.join(SRC, "../original"))
+COMP_SOURCE = os.path.normpath(os.path.join(SRC, "../compressed"))
+DS9 = os.path.normpath(os.path.join(SRC, "../ds9"))
 MAIN = "/home/james/Desktop/sbit_compress_py/"
 
+
+def run_ss_trial(trial):
+    """
+    Runs one single source trial of SE_Comparison.run_ss_parallel and returns
+    the original and compressed catalog columns, or None if no source was
+    found in either image. This is a module level function so it can be sent
+    to worker processes.
+
+    trial is the tuple (seed, comp_type, factor, cut, bt, sd, rp, sz,
+    extractor).
+
+    @type trial: Tuple
+    @rtype: Tuple[List, List] or None
+    """
+    seed, alg, c_fact, cut, bt, sd, rp, sz, extractor = trial
+
+    fs = FakeStars("fakestar1", sz, sz, seed=seed)
+    fs.create_single_source(bt=bt[0], std=sd, xf=bt[1], yf=bt[2], \
+    rand_pos=rp, sz=sz)
+    og = extractor.extract(fs.return_image())
+
+    sbit = ImageCompression(image_file=fs.return_image(), cat=og)
+    image = sbit.compress_cc(algorithm=alg, c_factor=c_fact, cc=cut, \
+    save=False)
+    cs = extractor.extract(image)
+    if len(og) == 0 or len(cs) == 0:
+        return None
+    return columns(og), columns(cs)
+
+
+def split_mosaic(catalog, count, sz, guard):
+    """
+    Splits the catalog of a mosaic made by run_ss_mosaic into the catalog
+    columns of each of its count cells. Every source is given to the cell
+    (stamp plus half of the guard band around it) it lies in, and its X/Y
+    position is made relative to the stamp. Sources found outside of the
+    cells are dropped.
+
+    Returns a list holding the columns of each cell, or None for a cell where
+    no source was found.
+
+    @type catalog: Numpy Array (As returned by an extractor)
+    @type count: Int (Number of stamps in the mosaic)
+    @type sz: Int (Size of a stamp)
+    @type guard: Int (Width of the guard band between stamps)
+    @rtype: List
+    """
+    cols = int(np.ceil(np.sqrt(count)))
+    cell = sz + guard
+    catalog = columns(catalog)
+    # SExtractor positions start at 1
+    x = catalog[1] - 1 - guard / 2
+    y = catalog[2] - 1 - guard / 2
+    col = np.floor(x / cell).astype(int)
+    row = np.floor(y / cell).astype(int)
+    trial = np.where((col >= 0) & (col < cols) & (row >= 0), \
+    row * cols + col, -1)
+
+    cells = []
+    for i in range(count):
+        found = trial == i
+        if not np.any(found):
+            cells.append(None)
+            continue
+        cell_columns = [column[found] for column in catalog]
+        cell_columns[1] = cell_columns[1] - (guard + (i % cols) * cell)
+        cell_columns[2] = cell_columns[2] - (guard + (i // cols) * cell)
+        cells.append(cell_columns)
+    return cells
+
+
+def run_ss_mosaic(batch):
+    """
+    Runs a batch of single source trials of SE_Comparison.run_ss_batched.
+
+    The stamps of the batch are tiled onto one mosaic, seperated by guard
+    bands of noise, so the mosaic is only compressed once and the sources are
+    only extracted twice for the whole batch. The sources found are then
+    given back to their trial by the cell they lie in (see split_mosaic).
+
+    batch is the tuple (count, seed, comp_type, factor, cut, bt, sd, rp, sz,
+    guard, extractor). Returns the (original, compressed) catalog columns of
+    each trial, or None for a trial where no source was found in either
+    image.
+
+    @type batch: Tuple
+    @rtype: List
+    """
+    count, seed, alg, c_fact, cut, bt, sd, rp, sz, guard, extractor = batch
+    rng = np.random.default_rng(seed)
+
+    cols = int(np.ceil(np.sqrt(count)))
+    rows = int(np.ceil(count / cols))
+    cell = sz + guard
+    mosaic = np.round(rng.normal(29, sd, \
+    size=(rows * cell + guard, cols * cell + guard)))
+    fs = FakeStars("fakestar1", sz, sz, seed=rng)
+    for i in range(count):
+        fs.create_single_source(bt=bt[0], std=sd, xf=bt[1], yf=bt[2], \
+        rand_pos=rp, sz=sz)
+        y0 = guard + (i // cols) * cell
+        x0 = guard + (i % cols) * cell
+        mosaic[y0:y0 + sz, x0:x0 + sz] = fs.return_image()
+    og_cat = extractor.extract(mosaic)
+    og = split_mosaic(og_cat, count, sz, guard)
+
+    sbit = ImageCompression(image_file=mosaic, cat=og_cat)
+    image = sbit.compress_cc(algorithm=alg, c_factor=c_fact, cc=cut, \
+    save=False)
+    cs = split_mosaic(extractor.extract(image), count, sz, guard)
+    return [None if o is None or c is None else (o, c) \
+    for o, c in zip(og, cs)]
+
+
+def run_experiments(comparisons, sources, workers=None, **kwargs):
+    """
+    Runs run_ss_experiment(sources, **kwargs) of every SE_Comparison at the
+    same time on a pool of threads and returns the comparisons.
+
+    The file based path of run_ss_experiment shares the test.cat files of
+    OG_SOURCE and COMP_SOURCE, so comparisons without an extractor are given
+    the one of get_extractor, which runs Source Extractor in its own
+    temporary directory.
+
+    @type comparisons: List[SE_Comparison]
+    @type sources: Integer (Number of sources of each comparison)
+    @type workers: Int or None (Number of threads)
+    @rtype: List[SE_Comparison]
+    """
+    for comparison in comparisons:
+        if comparison.extractor is None:
+            comparison.extractor = comparison.get_extractor()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(comparison.run_ss_experiment, sources, **kwargs) \
+        for comparison in comparisons]
+        for future in futures:
+            future.result()
+    return comparisons
+
+
 class SE_Comparison:
     """
     A class module designed to help run analysis for compressed and original
@@ -33,7 +179,7 @@ class SE_Comparison:
     along with any necessary python packages. The directory of the files above
     must also be changed to the necessary location.
     """
-    def __init__(self, factor, comp_type):
+    def __init__(self, factor, comp_type, extractor=None):
         """
         Initializes a new SE_Comparison object which will be used to run 
         comparisons between compressed and original images.
@@ -51,14 +197,26 @@ class SE_Comparison:
             
             masking- H- Transformation using a smarter way to locate source 
             positions.
+
+        extractor is the source extractor to use (see extractor.py). If it is
+        None, the Source Extractor program is run on fits files written to
+        OG_SOURCE and COMP_SOURCE. Otherwise the images and catalogs are kept
+        in memory, e.g. with extractor.MomentExtractor() nothing is written
+        to disk and Source Extractor does not need to be installed.
                         
         @type self: SE_Comparison
         @type factor: Int (Compression factor)
         @type comp_type: String
+        @type extractor: Extractor or None
         @rtype: None
         """
         self.comp_f = factor
         self.compression = comp_type
+        self.extractor = extractor
+        
+        # Catalogs of the last image extracted in memory
+        self.og_cat = None
+        self.cs_cat = None
         
         # For Generated Fake Stars
         self.og_sources = []
@@ -67,6 +225,7 @@ class SE_Comparison:
         # For Actual Image
         self.im_og_sources = []
         self.im_cp_sources = []
+        self.im_separations = []
         
         self.og_dict = {}
         self.comp_dict = {}
@@ -81,7 +240,8 @@ class SE_Comparison:
                         9: "THETA ANGLE",
                         10: "NUMBER"}
         
-    def run_ss_experiment(self, sources, sd=29, cut=False, rp=False, bt=[200, 5, 5], sz=100):
+    def run_ss_experiment(self, sources, sd=29, cut=False, rp=False, bt=[200, 5, 5], sz=100, \
+    seed=None, overlap=False, debug_dir=None):
         """
         This method runs a quick simulation for the desired number of generated
         single sources and compresses the image using the desired algorithm.
@@ -98,6 +258,10 @@ class SE_Comparison:
         
         Sz is the dimension (height and width) of the fake image. By default, 
         the generated source will be in a 100 by 100 image grid.
+
+        With an extractor the sources go through single_source_pipeline
+        without touching the disk. overlap runs its stages in seperate
+        threads and debug_dir is where the images are written for debugging.
         
         @type self: SE_Comparison
         @type sources: Integer (Number of desired sources)
@@ -106,28 +270,153 @@ class SE_Comparison:
         @type cut: Boolean 
         @type bt: List[ints] (Source Parameters)
         @type sz: Dimension of the image (Height and Width)
+        @type seed: Int or None
+        @type overlap: Boolean
+        @type debug_dir: String or None
         @rtype: None
         """
         alg = self.compression
         c_fact = self.comp_f
+        if self.extractor is not None:
+            for item in single_source_pipeline(sources, self.extractor, alg, \
+            c_fact, cut, sz, bt, sd, rp, seed, overlap=overlap, \
+            debug_dir=debug_dir):
+                if len(item["og_cat"]) == 0 or len(item["cs_cat"]) == 0:
+                    raise RuntimeError("No source was found.")
+                self.og_sources.append(columns(item["og_cat"]))
+                self.comp_sources.append(columns(item["cs_cat"]))
+            self.get_parameter()
+            return
+        sextractor = SExtractor(OG_SOURCE)
         for i in range(sources):
-            os.chdir(OG_SOURCE)
             fs = FakeStars("fakestar1", 4400, 6650)
             fs.create_single_source(bt=bt[0], std=sd, xf=bt[1], yf=bt[2], rand_pos=rp, sz=sz)
-            fs.create_fits_image()
-            os.system("sextractor fakestar1.fits -c default.sex")
-            sbit = ImageCompression(image_file='fakestar1.fits', cat="test.cat")   
+            fs.create_fits_image(OG_SOURCE, "fakestar1.fits")
+            sextractor.extract_file("fakestar1.fits", OG_SOURCE)
+            sbit = ImageCompression(image_file=os.path.join(OG_SOURCE, 'fakestar1.fits'), \
+            cat=os.path.join(OG_SOURCE, "test.cat"), out_dir=COMP_SOURCE)
             sbit.compress_cc(algorithm=alg, c_factor=c_fact, cc=cut)
-            os.chdir(COMP_SOURCE)
-            if alg =='hcomp':
-                os.system("sextractor hcomp_fakestar1.fits -c default.sex")
-            elif alg == 'bs':
-                os.system("sextractor bs_fakestar1.fits -c default.sex")
+            if alg in ('hcomp', 'bs'):
+                sextractor.extract_file(alg + "_fakestar1.fits", COMP_SOURCE)
             og, cs = self.cat_reader([i for i in range(1, 11)]) 
             self.og_sources.append(og)
             self.comp_sources.append(cs)
         self.get_parameter()
         
+    def get_extractor(self):
+        """
+        Returns the extractor of this SE_Comparison, or one running the
+        Source Extractor program with the files of OG_SOURCE if none was
+        given.
+
+        @type self: SE_Comparison
+        @rtype: Extractor
+        """
+        if self.extractor is None:
+            return SExtractor(OG_SOURCE)
+        return self.extractor
+
+    def run_ss_parallel(self, sources, sd=29, cut=False, rp=False, bt=[200, 5, 5], \
+    sz=100, workers=None, seed=None):
+        """
+        Runs the same simulation as run_ss_experiment, but spreads the sources
+        over a pool of worker processes.
+
+        Each source is simulated with its own random seed spawned from seed,
+        so the results do not depend on the number of workers and are merged
+        in the order of the sources. The seed used is stored in self.seed to
+        reproduce a run. When Source Extractor is used, each source is
+        extracted in its own temporary directory.
+
+        Trials where no source was found in the original or compressed image
+        are left out, and their numbers are stored in self.missed (as in
+        run_ss_batched).
+
+        @type self: SE_Comparison
+        @type sources: Integer (Number of desired sources)
+        @type sd: Int (Standard deviation of noise)
+        @type cut: Boolean
+        @type rp: Boolean (Random Position)
+        @type bt: List[ints] (Source Parameters)
+        @type sz: Dimension of the image (Height and Width)
+        @type workers: Int or None (Number of processes, default all cores)
+        @type seed: Int or None
+        @rtype: None
+        """
+        seeds = np.random.SeedSequence(seed)
+        self.seed = seeds.entropy
+        extractor = self.get_extractor()
+        trials = [(int(child.generate_state(1)[0]), self.compression, \
+        self.comp_f, cut, bt, sd, rp, sz, extractor) \
+        for child in seeds.spawn(sources)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run_ss_trial, trials, chunksize= \
+            max(1, sources // (8 * (workers or os.cpu_count() or 1)))))
+        self.missed = []
+        for trial, found in enumerate(results):
+            if found is None:
+                self.missed.append(trial)
+            else:
+                self.og_sources.append(found[0])
+                self.comp_sources.append(found[1])
+        self.get_parameter()
+
+    def run_ss_batched(self, sources, batch=100, guard=20, sd=29, cut=False, \
+    rp=False, bt=[200, 5, 5], sz=100, workers=1, seed=None):
+        """
+        Runs the same simulation as run_ss_experiment, but tiles batch sources
+        onto one mosaic (see run_ss_mosaic) so the image is compressed once
+        and the sources are extracted twice per batch instead of per source.
+
+        guard is the width of the band of noise seperating the stamps. It
+        should be wide enough that the sources of neighbouring stamps do not
+        blend together.
+
+        Trials where no source was found in the original or compressed stamp
+        are left out, and their numbers are stored in self.missed.
+
+        If workers is more than 1, the batches are spread over a pool of
+        worker processes. The seed of each batch is spawned from seed (see
+        run_ss_parallel).
+
+        @type self: SE_Comparison
+        @type sources: Integer (Number of desired sources)
+        @type batch: Integer (Number of sources per mosaic)
+        @type guard: Integer (Width of the guard bands)
+        @type sd: Int (Standard deviation of noise)
+        @type cut: Boolean
+        @type rp: Boolean (Random Position)
+        @type bt: List[ints] (Source Parameters)
+        @type sz: Dimension of the stamps (Height and Width)
+        @type workers: Int or None (Number of processes)
+        @type seed: Int or None
+        @rtype: None
+        """
+        seeds = np.random.SeedSequence(seed)
+        self.seed = seeds.entropy
+        extractor = self.get_extractor()
+        counts = [min(batch, sources - i) for i in range(0, sources, batch)]
+        batches = [(count, int(child.generate_state(1)[0]), self.compression, \
+        self.comp_f, cut, bt, sd, rp, sz, guard, extractor) \
+        for count, child in zip(counts, seeds.spawn(len(counts)))]
+        if workers == 1:
+            results = [run_ss_mosaic(b) for b in batches]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(run_ss_mosaic, batches))
+
+        self.missed = []
+        trial = 0
+        for result in results:
+            for found in result:
+                if found is None:
+                    self.missed.append(trial)
+                else:
+                    self.og_sources.append(found[0])
+                    self.comp_sources.append(found[1])
+                trial += 1
+        self.get_parameter()
+
     def cat_reader(self, index):
         """
         This method returns the parameters obtained in SExtractor verbatim. 
@@ -147,15 +436,20 @@ class SE_Comparison:
         ##  10 DELTA_J2000            Declination of barycenter (J2000)                          [deg]   ##
         ###################################################################################################
         
+        If the last image was extracted in memory (see run_im_experiment), its
+        catalogs are used instead of the test.cat files.
+        
         @type self: SE_comparison
         @type index: List[indexes]
         @rtype: List
         """    
-        os.chdir(COMP_SOURCE)
-        csdata1 = np.loadtxt("test.cat").T
-    
-        os.chdir(OG_SOURCE)
-        osdata1 = np.loadtxt("test.cat").T
+        if self.og_cat is not None:
+            osdata1 = self.og_cat.T
+            csdata1 = self.cs_cat.T
+            return [osdata1[i-1] for i in index], [csdata1[i-1] for i in index]
+        
+        csdata1 = catalog_data(os.path.join(COMP_SOURCE, "test.cat")).T
+        osdata1 = catalog_data(os.path.join(OG_SOURCE, "test.cat")).T
         
         return [osdata1[i-1] for i in index], [csdata1[i-1] for i in index]
         
@@ -241,66 +535,53 @@ class SE_Comparison:
         """
         alg = self.compression
         c_fact = self.comp_f
-        os.chdir(OG_SOURCE)
-        os.system("sextractor cp_new-image.fits -c default.sex")
-        sbit = ImageCompression(image_file='cp_new-image.fits', cat="test.cat")   
+        if self.extractor is not None:
+            # The image is read once, and given to ImageCompression as is.
+            data = read_image(os.path.join(OG_SOURCE, im_name))[0]
+            self.og_cat = self.extractor.extract(data)
+            sbit = ImageCompression(image_file=data, cat=self.og_cat)
+            image = sbit.compress_cc(algorithm=alg, c_factor=c_fact, cc=cut, \
+            save=False)
+            self.cs_cat = self.extractor.extract(image)
+            return
+        self.og_cat = self.cs_cat = None
+        sextractor = SExtractor(OG_SOURCE)
+        sextractor.extract_file("cp_new-image.fits", OG_SOURCE)
+        sbit = ImageCompression(image_file=os.path.join(OG_SOURCE, 'cp_new-image.fits'), \
+        cat=os.path.join(OG_SOURCE, "test.cat"), out_dir=COMP_SOURCE)
         sbit.compress_cc(algorithm=alg, c_factor=c_fact, cc=cut)
-        os.chdir(COMP_SOURCE)
-        if alg =='hcomp':
-            os.system("sextractor hcomp_cp_new-image.fits -c default.sex")
-        elif alg == 'bs':
-            os.system("sextractor bs_cp_new-image.fits -c default.sex")
+        if alg in ('hcomp', 'bs'):
+            sextractor.extract_file(alg + "_cp_new-image.fits", COMP_SOURCE)
             
-    def image_comparison(self):
+    def image_comparison(self, radius=1.5):
         """
         This method is used to compare sources from  the original image to the 
         sources in the compressed version.
+
+        Sources are matched one to one by position (see match_catalogs), to
+        the closest source within radius pixels. The separations of the
+        matched sources are kept in self.im_separations.
         
         @type self: SE_comparison
+        @type radius: Float (Match radius in pixels)
         @rtype: None
         """
-        og, cs = self.cat_reader([2,3])
-        og = np.round(og)
-        cs = np.round(cs)        
-        
-        og_co = []
-        for i in range(len(og[0])):
-            og_co.append((og[0][i], og[1][i]))     
-               
-        cs_co = []
-        for i in range(len(cs[0])):
-            cs_co.append((cs[0][i], cs[1][i]))
-      
-        og_idx = []
-        cs_idx = []
-        for coord in og_co:
-            for j in range(-1, 1):
-                x = coord[0] + j
-                for k in range(-1, 1):
-                    y = coord[1] + k
-                    if (x, y) in cs_co:
-                        og_idx.append(og_co.index(coord))
-                        cs_idx.append(cs_co.index((x, y)))
-        
-        os.chdir(OG_SOURCE)
-        osdata1 = np.loadtxt("test.cat")
-        z1 = []
-        
-        os.chdir(COMP_SOURCE)
-        csdata1 = np.loadtxt("test.cat")
-        z2 = []
-        os.chdir(MAIN)
-
-        # Updates z1, z2 to refer to the same sources.
-        for i in og_idx:
-            z1.append(osdata1[i])
-        
-        for i in cs_idx:
-            z2.append(csdata1[i])
-
-        # Returns desired parameter from test.cat file
-        self.im_og_sources = np.array(z1).T
-        self.im_cp_sources = np.array(z2).T
+        if self.og_cat is not None:
+            osdata1 = self.og_cat
+            csdata1 = self.cs_cat
+        else:
+            osdata1 = catalog_data(os.path.join(OG_SOURCE, "test.cat"))
+            csdata1 = catalog_data(os.path.join(COMP_SOURCE, "test.cat"))
+
+        # X_IMAGE and Y_IMAGE are the 2nd and 3rd columns of the catalog.
+        og_idx, cs_idx, separations = match_catalogs(osdata1[:, 1:3], \
+        csdata1[:, 1:3], radius)
+
+        # Returns desired parameter from test.cat file, in the same order for
+        # both images.
+        self.im_og_sources = osdata1[og_idx].T
+        self.im_cp_sources = csdata1[cs_idx].T
+        self.im_separations = separations
                     
     def signal_to_noise(self, fwhm_lim, bt_lim, rp=False, cut=False):
         """
@@ -0,0 +1,58 @@
+import io
+import numpy as np
+
+from benchmark import benchmark_image, measure, write_table, FIELDS, \
+TILE_ALGORITHMS
+from image_compression import tile_compress, tile_decompress
+
+
+def test_measure_returns_the_compressed_size():
+    data = np.arange(64 * 64, dtype=np.int32).reshape(64, 64)
+    encode = lambda: tile_compress(data, 'RICE_1')
+    size, encode_mbs, decode_mbs, peak = measure(encode, tile_decompress, \
+    data.nbytes, repeat=2)
+    assert size == len(encode())
+    assert encode_mbs > 0 and decode_mbs > 0 and peak > 0
+    assert np.isnan(measure(encode, tile_decompress, data.nbytes, \
+    trace_memory=False)[3])
+
+
+def test_benchmark_image_rows():
+    rng = np.random.default_rng(0)
+    data = np.round(rng.normal(1000, 20, size=(200, 200)))
+    rows = benchmark_image(data, "noise", hcomp_scales=[0, 4], \
+    shave_bits=[2], trace_memory=False)
+    # Whole number float images are benchmarked as int32, so the lossless
+    # algorithms and PLIO_1 are run once each.
+    keys = [(row['mode'], row['algorithm'], row['factor']) for row in rows]
+    assert keys == [('tile', 'RICE_1', ''), ('tile', 'GZIP_1', ''), \
+    ('tile', 'GZIP_2', ''), ('tile', 'PLIO_1', ''), \
+    ('tile', 'HCOMPRESS_1', 0), ('tile', 'HCOMPRESS_1', 4), \
+    ('bs', 'RICE_1', 2), ('bs', 'GZIP_2', 2)]
+    for row in rows:
+        assert set(row) == set(FIELDS) and row['image'] == "noise"
+        assert row['raw_bytes'] == 200 * 200 * 4
+        assert row['ratio'] == row['raw_bytes'] / row['compressed_bytes']
+    ratio = {key: row['ratio'] for key, row in zip(keys, rows)}
+    assert ratio[('tile', 'HCOMPRESS_1', 4)] > \
+    ratio[('tile', 'HCOMPRESS_1', 0)]
+
+
+def test_benchmark_image_sweeps_float_images():
+    data = np.random.default_rng(1).normal(0, 1, size=(40, 40))
+    rows = benchmark_image(data, "float", hcomp_scales=[0], \
+    quantize_levels=[4, 1], shave_bits=[], trace_memory=False)
+    algorithms = [row['algorithm'] for row in rows]
+    assert 'PLIO_1' not in algorithms
+    assert algorithms.count('RICE_1') == 2
+    assert set(algorithms) == set(TILE_ALGORITHMS) - {'PLIO_1'}
+
+
+def test_write_table():
+    rows = benchmark_image(np.ones((16, 16)), "flat", hcomp_scales=[0], \
+    shave_bits=[1], trace_memory=False)
+    buffer = io.StringIO()
+    write_table(rows, buffer)
+    lines = buffer.getvalue().splitlines()
+    assert lines[0] == ",".join(FIELDS)
+    assert len(lines) == len(rows) + 1
@@ -0,0 +1,101 @@
+import os
+import numpy as np
+
+import catalog
+from catalog import catalog_data, clear_cache, match_catalogs, read_catalog
+
+CATALOG = """#   1 FLUX_AUTO              Flux within a Kron-like elliptical aperture [count]
+#   2 X_IMAGE                Object position along x [pixel]
+#   3 Y_IMAGE                Object position along y [pixel]
+#   4 FLUX_APER              Flux vector within fixed circular aperture(s) [count]
+#   6 FLUX_RADIUS            Fraction-of-light radii [pixel]
+1000.5 10.0 20.0 1.0 2.0 1.5
+2000.0 30.5 40.5 3.0 4.0 2.5
+"""
+
+
+def write_catalog(path, text=CATALOG):
+    with open(path, "w") as cat:
+        cat.write(text)
+    return str(path)
+
+
+def test_catalog_data_matches_loadtxt(tmp_path):
+    path = write_catalog(tmp_path / "test.cat")
+    data = catalog_data(path)
+    np.testing.assert_array_equal(data, np.loadtxt(path, ndmin=2))
+    assert not data.flags.writeable
+
+
+def test_read_catalog_names_columns(tmp_path):
+    records = read_catalog(write_catalog(tmp_path / "test.cat"))
+    np.testing.assert_array_equal(records.FLUX_AUTO, [1000.5, 2000.0])
+    np.testing.assert_array_equal(records.FLUX_APER_2, [2.0, 4.0])
+    np.testing.assert_array_equal(records.FLUX_RADIUS, [1.5, 2.5])
+
+
+def test_catalogs_are_parsed_once_until_changed(tmp_path):
+    clear_cache()
+    path = write_catalog(tmp_path / "test.cat")
+    assert catalog_data(path) is catalog_data(path)
+    write_catalog(path, CATALOG + "3000.0 1.0 2.0 5.0 6.0 3.5\n")
+    os.utime(path, ns=(1, 1))
+    assert len(catalog_data(path)) == 3
+
+
+def test_rewritten_catalogs_with_same_size_and_mtime_are_parsed(tmp_path):
+    clear_cache()
+    path = write_catalog(tmp_path / "test.cat")
+    before = os.stat(path)
+    assert catalog_data(path)[0, 0] == 1000.5
+    write_catalog(path, CATALOG.replace("1000.5", "9000.5"))
+    os.utime(path, ns=(before.st_atime_ns, before.st_mtime_ns))
+    after = os.stat(path)
+    assert (after.st_size, after.st_mtime_ns) == \
+    (before.st_size, before.st_mtime_ns)
+    assert catalog_data(path)[0, 0] == 9000.5
+
+
+def test_cache_is_bounded(tmp_path, monkeypatch):
+    clear_cache()
+    monkeypatch.setattr(catalog, "CACHE_SIZE", 2)
+    for i in range(3):
+        catalog_data(write_catalog(tmp_path / ("test" + str(i) + ".cat")))
+    assert len(catalog._cache) == 2
+
+
+def brute_force_match(og_xy, cs_xy, radius):
+    distance = np.hypot(*(og_xy[:, None, :] - cs_xy[None, :, :]).T).T
+    pairs = sorted((distance[i, j], i, j) for i in range(len(og_xy)) \
+    for j in range(len(cs_xy)) if distance[i, j] <= radius)
+    og_used, cs_used, matched = set(), set(), []
+    for d, i, j in pairs:
+        if i not in og_used and j not in cs_used:
+            og_used.add(i)
+            cs_used.add(j)
+            matched.append((i, j, d))
+    return sorted(matched)
+
+
+def test_match_catalogs_matches_brute_force():
+    rng = np.random.default_rng(0)
+    og_xy = rng.uniform(0, 50, size=(200, 2))
+    cs_xy = np.vstack([og_xy[:150] + rng.normal(0, 0.4, size=(150, 2)), \
+    rng.uniform(0, 50, size=(30, 2))])
+    og_idx, cs_idx, separations = match_catalogs(og_xy, cs_xy, 1.5)
+    expected = brute_force_match(og_xy, cs_xy, 1.5)
+    assert list(zip(og_idx.tolist(), cs_idx.tolist())) == \
+    [(i, j) for i, j, d in expected]
+    np.testing.assert_allclose(separations, [d for i, j, d in expected])
+
+
+def test_match_catalogs_is_one_to_one():
+    og_idx, cs_idx, separations = match_catalogs([[0, 0], [1, 0]], \
+    [[0.2, 0]], 1.5)
+    assert og_idx.tolist() == [0] and cs_idx.tolist() == [0]
+
+
+def test_match_catalogs_empty():
+    og_idx, cs_idx, separations = match_catalogs(np.zeros((0, 2)), \
+    [[1, 2]])
+    assert len(og_idx) == len(cs_idx) == len(separations) == 0
@@ -0,0 +1,143 @@
+import numpy as np
+from astropy.io import fits
+
+from common_tools import BiasLibrary, as_bias_library, get_corresponding_bias, \
+get_distance, get_sorted_bias, master_estimator, master_mean, radial_bins, \
+radial_profile, read_strip, stack_frames, strip_rows
+
+
+def brute_force_profile(img, bin_size, pc):
+    x, y = np.ogrid[pc:img.shape[0]-pc, pc:img.shape[1]-pc]
+    bins = np.maximum(np.ceil(get_distance(x, y, None, img.shape) / \
+    bin_size).astype(int) - 1, 0)
+    values = img[pc:img.shape[0]-pc, pc:img.shape[1]-pc]
+    means, medians, stds = [], [], []
+    for b in range(bins.max() + 1):
+        pixels = values[bins == b]
+        means.append(pixels.mean() if len(pixels) else np.nan)
+        medians.append(np.median(pixels) if len(pixels) else np.nan)
+        stds.append(pixels.std() if len(pixels) else np.nan)
+    return np.array(means), np.array(medians), np.array(stds)
+
+
+def test_radial_profile_matches_brute_force():
+    img = np.random.default_rng(0).normal(1000, 30, size=(61, 83))
+    means, medians, stds, counts = radial_profile(img, bin_size=3, pc=4)
+    expected = brute_force_profile(img, 3, 4)
+    np.testing.assert_allclose(means, expected[0], rtol=1e-12)
+    np.testing.assert_allclose(medians, expected[1], rtol=1e-12)
+    np.testing.assert_allclose(stds, expected[2], rtol=1e-9)
+    assert counts.sum() == (61 - 8) * (83 - 8)
+
+
+def test_radial_profile_accepts_a_list_center():
+    img = np.random.default_rng(1).normal(1000, 30, size=(40, 50))
+    expected = radial_profile(img, bin_size=3, pc=2, center=(15.5, 20.5))
+    for center in ([15.5, 20.5], np.array([15.5, 20.5])):
+        profile = radial_profile(img, bin_size=3, pc=2, center=center)
+        for values, wanted in zip(profile, expected):
+            np.testing.assert_array_equal(values, wanted)
+
+
+def test_radial_bins_keep_only_the_latest_geometry():
+    radial_bins.cache_clear()
+    order, starts, counts = radial_bins((40, 50), 5)
+    assert order.dtype == np.int32 and not order.flags.writeable
+    assert np.array_equal(np.sort(order), np.arange(40 * 50))
+    assert radial_bins((40, 50), 5)[0] is order
+    radial_bins((30, 50), 5)
+    assert radial_bins.cache_info().currsize == 1
+
+
+def write_frames(folder, names, shape=(23, 17), seed=0, dtype=np.uint16):
+    rng = np.random.default_rng(seed)
+    frames = {}
+    for name in names:
+        frames[name] = rng.integers(900, 1100, size=shape).astype(dtype)
+        fits.PrimaryHDU(frames[name]).writeto(str(folder / name))
+    return frames
+
+
+def test_stack_frames_matches_numpy_with_small_strips(tmp_path):
+    names = ["img_%d_r.fits" % i for i in range(5)]
+    frames = write_frames(tmp_path, names)
+    cube = np.array([frames[name] for name in names], dtype=np.float64)
+    paths = [str(tmp_path / name) for name in names]
+    # A budget of a few rows per strip, so the frames are read in many strips.
+    budget = 5 * 17 * 8 * 3 * 4
+    assert strip_rows(5, 17, budget) == 4
+    np.testing.assert_array_equal(stack_frames(paths, "median", \
+    budget=budget), np.median(cube, axis=0))
+    np.testing.assert_allclose(stack_frames(paths, "mean", budget=budget), \
+    np.mean(cube, axis=0))
+    np.testing.assert_array_equal(read_strip(paths[2], 3, 9), cube[2, 3:9])
+
+
+def test_master_estimator_matches_numpy(tmp_path):
+    names = ["img_%d_r.fits" % i for i in range(7)]
+    frames = write_frames(tmp_path, names, seed=1)
+    median, std = master_estimator(names, [], str(tmp_path) + "/", width=3, \
+    budget=6 * 17 * 8 * 3 * 2)
+    # The last frame does not fill a group of 3 and is left out.
+    cube = np.array([frames[name] for name in names[:6]], dtype=np.float64)
+    cube = cube.reshape((2, 3) + cube.shape[1:])
+    np.testing.assert_array_equal(median, \
+    np.median(np.median(cube, axis=1), axis=0))
+    np.testing.assert_allclose(std, np.std(np.mean(cube, axis=1), axis=0))
+
+
+def test_bias_library_finds_the_nearest_biases():
+    library = BiasLibrary(["bias_30_r.fits", "bias_10_r.fits", \
+    "bias_20_r.fits", "notes.txt", "bias_50_r.fits"])
+    assert len(library) == 4
+    assert library.nearest("img_24_r.fits", 2) == \
+    ["bias_20_r.fits", "bias_30_r.fits"]
+    assert library.nearest("img_5_r.fits", 2) == \
+    ["bias_10_r.fits", "bias_20_r.fits"]
+    assert library.nearest("img_60_r.fits", 3) == \
+    ["bias_50_r.fits", "bias_30_r.fits", "bias_20_r.fits"]
+    assert library.nearest("img_1_r.fits", 9) == library.names
+    assert get_corresponding_bias("img_44_r.fits", library) == "bias_50_r.fits"
+
+
+def test_bias_lists_are_indexed_once():
+    names = ["bias_30_r.fits", "bias_10_r.fits", "bias_20_r.fits"]
+    library = as_bias_library(names)
+    assert as_bias_library(list(names)) is library
+    assert get_corresponding_bias("img_24_r.fits", names) == "bias_20_r.fits"
+    assert get_sorted_bias("img_24_r.fits", names, 2) == \
+    ["bias_20_r.fits", "bias_30_r.fits"]
+    assert as_bias_library(names) is library
+
+
+def test_bias_library_evicts_the_least_recently_used(tmp_path):
+    names = ["bias_%d_r.fits" % i for i in (10, 20, 30)]
+    frames = write_frames(tmp_path, names, shape=(8, 8))
+    # Room for two 8x8 float64 biases.
+    library = BiasLibrary(names, str(tmp_path) + "/", cache_bytes=2 * 8 * 8 * 8)
+    first = library.get(names[0])
+    np.testing.assert_array_equal(first, frames[names[0]])
+    assert not first.flags.writeable
+    library.get(names[1])
+    assert library.get(names[0]) is first
+    library.get(names[2])
+    assert list(library._cache) == [names[0], names[2]]
+    assert library.cache_size == 2 * 8 * 8 * 8
+    np.testing.assert_allclose(library.nearest_mean("img_26_r.fits"), \
+    (frames[names[1]] + frames[names[2]]) / 2.0)
+    assert library.cache_size <= library.cache_bytes
+    library.clear()
+    assert library.cache_size == 0 and not library._cache
+
+
+def test_master_mean_parallel_matches_serial(tmp_path):
+    names = ["img_%d_r.fits" % i for i in (12, 27, 41, 58)]
+    bias_names = ["bias_%d_r.fits" % i for i in (10, 30, 50)]
+    write_frames(tmp_path, names, seed=2)
+    write_frames(tmp_path, bias_names, seed=3)
+    path = str(tmp_path) + "/"
+    mbias = np.random.default_rng(4).normal(5, 1, size=(23, 17))
+    kwargs = dict(sbias=True, bimgs=bias_names, bpath=path, mbias=mbias)
+    serial = master_mean(names, [], path, imsize=(23, 17), **kwargs)
+    parallel = master_mean(names, [], path, workers=2, rows=5, **kwargs)
+    np.testing.assert_array_equal(parallel, serial)
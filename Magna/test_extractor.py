@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from extractor import COLUMNS, columns, MomentExtractor, SepExtractor
+
+
+def gaussian(shape, x, y, flux, sigma_x, sigma_y):
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    g = np.exp(-(xx - x) ** 2 / (2 * sigma_x ** 2) - \
+    (yy - y) ** 2 / (2 * sigma_y ** 2))
+    return flux * g / g.sum()
+
+
+def scene(seed=0):
+    shape = (120, 150)
+    image = np.random.default_rng(seed).normal(100, 5, size=shape)
+    image += gaussian(shape, 40.3, 50.6, 20000, 2, 2)
+    image += gaussian(shape, 110.0, 80.0, 30000, 4, 2)
+    return image
+
+
+def test_moment_extractor_measures_the_sources():
+    catalog = MomentExtractor().extract(scene())
+    assert catalog.shape == (2, len(COLUMNS))
+    catalog = catalog[np.argsort(catalog[:, COLUMNS.index("X_IMAGE")])]
+    # Positions start at 1, as in Source Extractor.
+    np.testing.assert_allclose(catalog[:, 1:3], [[41.3, 51.6], [111, 81]], \
+    atol=0.1)
+    np.testing.assert_allclose(catalog[:, 0], [20000, 30000], rtol=0.05)
+    round_source, long_source = catalog
+    assert round_source[COLUMNS.index("ELLIPTICITY")] < 0.1
+    assert long_source[COLUMNS.index("A_IMAGE")] > \
+    1.5 * long_source[COLUMNS.index("B_IMAGE")]
+    assert abs(long_source[COLUMNS.index("THETA_IMAGE")]) < 5
+    np.testing.assert_allclose(round_source[COLUMNS.index("FLUX_RADIUS")], \
+    2 * np.sqrt(2 * np.log(2)), rtol=0.1)
+    np.testing.assert_array_equal(catalog[:, COLUMNS.index("NUMBER")], [1, 2])
+
+
+def test_moment_extractor_without_sources():
+    image = np.random.default_rng(1).normal(100, 5, size=(50, 50))
+    catalog = MomentExtractor(thresh=10).extract(image)
+    assert catalog.shape == (0, len(COLUMNS))
+    assert len(columns(catalog)) == len(COLUMNS)
+
+
+def test_sep_extractor_agrees_with_moment_extractor():
+    pytest.importorskip("sep")
+    image = scene(2)
+    moment = MomentExtractor().extract(image)
+    catalog = SepExtractor().extract(image)
+    # The two brightest sources, as faint noise peaks may be found as well.
+    order = lambda cat: cat[np.argsort(cat[:, 0])[-2:]]
+    np.testing.assert_allclose(order(catalog)[:, 1:3], \
+    order(moment)[:, 1:3], atol=0.1)
+    np.testing.assert_allclose(order(catalog)[:, 0], order(moment)[:, 0], \
+    rtol=0.05)
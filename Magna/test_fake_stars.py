@@ -0,0 +1,57 @@
+import numpy as np
+
+from fake_stars import COSMIC_BRIGHTNESS, COSMIC_FADE, COSMIC_LENGTH, \
+FakeStars, gaussian_kernel
+
+
+def test_create_image_is_seeded():
+    images = []
+    for i in range(2):
+        fs = FakeStars("field", 300, 400, seed=3)
+        fs.create_image(signal=1, btness=[1200, 400])
+        images.append(fs.return_image())
+    np.testing.assert_array_equal(images[0], images[1])
+    other = FakeStars("field", 300, 400, seed=4)
+    other.create_image(signal=1, btness=[1200, 400])
+    assert not np.array_equal(images[0], other.return_image())
+
+
+def test_point_stars_and_stars_match_a_loop():
+    fs = FakeStars("field", 250, 260, seed=5)
+    fs.create_point_stars(50)
+    fs.create_stars(generator=20, sz=30, xf=4, yf=3, amp=500)
+
+    rng = np.random.default_rng(5)
+    expected = np.zeros((250, 260))
+    point_star = rng.integers(6000, 60000, size=50, endpoint=True)
+    x_pos = rng.integers(0, 250, size=50)
+    y_pos = rng.integers(0, 260, size=50)
+    for i in range(50):
+        expected[x_pos[i], y_pos[i]] += point_star[i]
+    x = rng.integers(100, 150, size=20, endpoint=True)
+    y = rng.integers(100, 160, size=20, endpoint=True)
+    for i in range(20):
+        expected[x[i]:x[i]+30, y[i]:y[i]+30] += gaussian_kernel(30, 4, 3, 500)
+    np.testing.assert_allclose(fs.return_image(), expected)
+
+
+def test_cosmic_rays_match_a_loop():
+    fs = FakeStars("field", 120, 90, seed=6)
+    fs.create_cosmic_rays(30)
+
+    rng = np.random.default_rng(6)
+    expected = np.zeros((120, 90))
+    x_pos = rng.integers(0, 120, size=30)
+    y_pos = rng.integers(0, 90, size=30)
+    rotation = rng.integers(0, 3, size=30)
+    for i in range(30):
+        x, y = x_pos[i], y_pos[i]
+        brightness = COSMIC_BRIGHTNESS
+        for k in range(COSMIC_LENGTH):
+            if x >= 120 or y < 0 or y >= 90:
+                break
+            expected[x, y] += brightness
+            x += 1
+            y += [-1, 1, 0][rotation[i]]
+            brightness -= COSMIC_FADE
+    np.testing.assert_allclose(fs.return_image(), expected)
@@ -0,0 +1,268 @@
+import io
+import os
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from image_compression import as_integer_image, compress_tiled, \
+cookie_bounds, cookie_mask, decompress_tiled, map_image, plan_tiles, \
+quantize_bits, read_image, read_tiles, smallest_int, ImageCompression, \
+SourceFlags, SourcePayload
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.int16, np.int32])
+@pytest.mark.parametrize("bits", [1, 2, 3, 4, 5])
+def test_quantize_bits_integer_matches_float(dtype, bits):
+    rng = np.random.default_rng(bits)
+    info = np.iinfo(dtype)
+    low = max(int(info.min), -30000)
+    image = rng.integers(low, low + 30000, size=(64, 80)).astype(dtype)
+    shaved = quantize_bits(image.copy(), bits)
+    expected = quantize_bits(image.astype(np.float64), bits)
+    assert shaved.dtype == dtype
+    np.testing.assert_array_equal(shaved.astype(np.float64), expected)
+
+
+def test_quantize_bits_rounds_ties_to_even():
+    image = np.array([0, 1, 2, 3, 4, 5, 6, 7], dtype=np.uint16)
+    np.testing.assert_array_equal(quantize_bits(image, 1), \
+    [0, 0, 2, 4, 4, 4, 6, 8])
+
+
+def test_quantize_bits_restores_sources():
+    image = np.array([[10, 300], [11, 501]], dtype=np.int32)
+    shaved = quantize_bits(image.copy(), 2, threshold=255)
+    assert shaved[0, 1] == 300 and shaved[1, 1] == 501
+    assert shaved[0, 0] % 4 == 10 % 4
+
+
+def test_quantize_bits_rejects_bad_depth():
+    with pytest.raises(ValueError):
+        quantize_bits(np.zeros(4, dtype=np.uint8), 8)
+
+
+def test_as_integer_image():
+    assert as_integer_image(np.array([1.0, -2.0])).dtype == np.int32
+    assert as_integer_image(np.array([1.5, 2.0])).dtype == np.float64
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32, np.int32, \
+np.uint16])
+def test_rich_tiles_round_trip_exactly(dtype):
+    rng = np.random.default_rng(0)
+    image = np.round(rng.normal(1000, 30, size=(70, 90))).astype(dtype)
+    plan = plan_tiles(image.shape, tile_shape=(32, 32), min_sources=0)
+    decoded = decompress_tiled(compress_tiled(image, plan))
+    np.testing.assert_array_equal(decoded, image)
+
+
+def test_tiled_region_decode():
+    rng = np.random.default_rng(1)
+    image = np.round(rng.normal(1000, 30, size=(70, 90)))
+    # One source in the tile of rows 32-63 and columns 32-63.
+    cat = np.zeros((1, 10))
+    cat[0, 1:3] = [40.0, 50.0]
+    plan = plan_tiles(image.shape, cat, tile_shape=(32, 32))
+    assert plan[0]['sources'] == 1 and plan[0]['bounds'] == (32, 64, 32, 64)
+    compressed = compress_tiled(image, plan)
+    assert read_tiles(compressed)[0]['bounds'] == (32, 64, 32, 64)
+    region = decompress_tiled(compressed, (35, 60, 33, 63))
+    np.testing.assert_array_equal(region, image[35:60, 33:63])
+    whole = decompress_tiled(compressed)
+    assert whole.shape == image.shape
+    assert np.abs(whole - image).max() > 0
+
+
+def test_source_flags_round_trip(tmp_path):
+    rng = np.random.default_rng(2)
+    image = rng.integers(0, 400, size=(37, 41)).astype(np.uint16)
+    flags = SourceFlags.from_image(image, 255)
+    np.testing.assert_array_equal(flags.mask, image > 255)
+    assert len(flags) == np.sum(image > 255)
+
+    flags.save(str(tmp_path / "flags.npz"))
+    loaded = SourceFlags.load(str(tmp_path / "flags.npz"))
+    assert loaded.threshold == 255 and loaded.shape == image.shape
+    restored = loaded.restore(np.zeros_like(image))
+    np.testing.assert_array_equal(restored, np.where(image > 255, image, 0))
+
+
+def test_h_compression_does_not_flag_stars():
+    image = np.round(np.random.default_rng(3).normal(1000, 30, (40, 50)))
+    sbit = ImageCompression(image, cat=np.zeros((0, 10)))
+    sbit.H_Compression(0, save=False)
+    assert sbit.flags is None
+    restored = sbit.restore_flags(np.zeros_like(image))
+    np.testing.assert_array_equal(restored, np.where(image > 255, image, 0))
+
+
+def test_h_compression_round_trips_in_memory(tmp_path):
+    image = np.random.default_rng(4).integers(995, 1005, size=(200, 200))
+    image = image.astype(np.int32)
+    sbit = ImageCompression(image, cat=np.zeros((0, 10)), \
+    out_dir=str(tmp_path))
+    decompressed = sbit.H_Compression(0, save=False)
+    np.testing.assert_array_equal(decompressed, image)
+    assert 0 < sbit.compressed_size < image.nbytes
+    assert list(tmp_path.iterdir()) == []
+
+    lossy = sbit.H_Compression(16, save=False)
+    assert np.abs(lossy - image).max() > 0
+
+
+def test_write_uses_out_dir_without_changing_directory(tmp_path):
+    image = np.arange(12 * 10, dtype=np.int32).reshape(12, 10)
+    cwd = os.getcwd()
+    sbit = ImageCompression(image, cat=np.zeros((0, 10)), \
+    out_dir=str(tmp_path))
+    sbit.bit_shaving(2)
+    assert os.getcwd() == cwd
+    assert sbit.output_path("bs") == str(tmp_path / "bs_image.fits")
+    np.testing.assert_array_equal(fits.getdata(sbit.output_path("bs")), \
+    sbit.compressed_image)
+
+    buffer = io.BytesIO()
+    sbit.write("hcomp", buffer)
+    buffer.seek(0)
+    np.testing.assert_array_equal(fits.getdata(buffer), image)
+    assert sorted(os.listdir(str(tmp_path))) == ["bs_image.fits"]
+
+
+def test_working_copies_are_made_on_demand(tmp_path):
+    image = np.random.default_rng(5).integers(0, 400, size=(30, 20))
+    image = image.astype(np.int16)
+    fits.PrimaryHDU(image).writeto(str(tmp_path / "frame.fits"))
+    sbit = ImageCompression(str(tmp_path / "frame.fits"), \
+    cat=np.zeros((0, 10)), out_dir=str(tmp_path))
+    assert sbit.image_name == "frame.fits"
+    # Mapped as it is stored, big endian, without a rounded float copy.
+    assert sbit.original_image.dtype == np.dtype(">i2")
+    assert sbit._compressed_image is None and sbit._h_compress is None
+    assert sbit._masked_image is None and sbit._median is None
+
+    sbit.H_Compression(0, save=False)
+    assert sbit._compressed_image is None and sbit._masked_image is None
+    assert sbit.median == np.median(image)
+    shaved = sbit.bit_shaving(3, save=False)
+    assert shaved is sbit.compressed_image
+    assert not np.shares_memory(shaved, sbit.original_image)
+    np.testing.assert_array_equal(sbit.original_image, image)
+
+
+def test_unsigned_frames_are_mapped_raw(tmp_path):
+    image = np.random.default_rng(6).integers(0, 65535, size=(120, 130))
+    image = image.astype(np.uint16)
+    fits.PrimaryHDU(image).writeto(str(tmp_path / "frame.fits"))
+    data, header, bzero = map_image(str(tmp_path / "frame.fits"))
+    assert bzero == 32768 and data.dtype == np.dtype(">i2")
+    assert not data.flags.owndata
+    data, header = read_image(str(tmp_path / "frame.fits"))
+    assert data.dtype == np.uint16
+    np.testing.assert_array_equal(data, image)
+
+    sbit = ImageCompression(str(tmp_path / "frame.fits"), \
+    cat=np.zeros((0, 10)), crop=True, out_dir=str(tmp_path))
+    shaved = sbit.bit_shaving(2, save=False)
+    # The shaved copy is offset from the raw integers, the original image is
+    # only offset once it is used.
+    assert sbit._original_image is None
+    np.testing.assert_array_equal(shaved, quantize_bits(image[50:-50, \
+    50:-50].copy(), 2))
+    assert sbit.original_image.dtype == np.uint16
+    np.testing.assert_array_equal(sbit.original_image, image[50:-50, 50:-50])
+    assert sbit._raw_image is None
+
+
+def loop_cookie_mask(cat, shape):
+    # The per source cookie cut of square_cookie before it was vectorized.
+    mask = np.zeros(shape, dtype=bool)
+    for source in cat:
+        x, y, a_size, b_size = source[1:5]
+        if a_size <= 1.2 and b_size <= 0.950:
+            size = 3
+        elif a_size > 10:
+            size = 65
+        else:
+            size = 10
+        cuts = []
+        for center, high in ((x, shape[1]), (y, shape[0])):
+            if center - size < 0:
+                cuts.append((0, int(center + size - (center - size))))
+            elif center + size > high:
+                cuts.append((int(np.floor(center - size - \
+                (center + size - high))), high))
+            else:
+                cuts.append((int(round(center - size)), \
+                int(round(center + size))))
+        (left_x, right_x), (up_y, down_y) = cuts
+        mask[up_y:down_y, left_x:right_x] = True
+    return mask
+
+
+def test_cookie_mask_matches_per_source_loop():
+    rng = np.random.default_rng(6)
+    shape = (90, 130)
+    cat = np.zeros((60, 10))
+    cat[:, 1] = rng.uniform(-5, shape[1] + 5, 60)
+    cat[:, 2] = rng.uniform(-5, shape[0] + 5, 60)
+    cat[:, 3] = rng.choice([1.0, 5.0, 12.0], 60)
+    cat[:, 4] = rng.choice([0.5, 3.0], 60)
+    bounds = cookie_bounds(cat, shape)
+    np.testing.assert_array_equal(cookie_mask(bounds, shape), \
+    loop_cookie_mask(cat, shape))
+
+    sbit = ImageCompression(np.zeros(shape), cat=cat)
+    sbit.cc_stars()
+    assert sbit.c1 + sbit.c2 + sbit.c3 == 60
+    assert sbit.c1 == np.sum(bounds[4] == 1)
+    np.testing.assert_array_equal(sbit.cookies, loop_cookie_mask(cat, shape))
+
+
+@pytest.mark.parametrize("values, dtype", [([0, 255], np.uint8), \
+([-3, 200], np.int16), ([0, 60000], np.uint16), ([-1, 70000], np.int32), \
+([1.0, 2.0], np.uint8), ([0.5, 2.0], np.float64)])
+def test_smallest_int(values, dtype):
+    result = smallest_int(np.array(values))
+    assert result.dtype == dtype
+    np.testing.assert_array_equal(result, values)
+
+
+@pytest.mark.parametrize("dtype", [np.int32, np.float64])
+def test_source_payload_round_trip(dtype):
+    rng = np.random.default_rng(7)
+    image = rng.integers(-50, 3000, size=(50, 60)).astype(dtype)
+    cat = np.zeros((3, 10))
+    cat[:, 1:5] = [[10, 12, 1, 0.5], [45, 30, 5, 3], [58, 48, 1, 0.5]]
+    bounds = cookie_bounds(cat, image.shape)
+    payload = SourcePayload.from_image(image, bounds)
+    assert payload.values.dtype == np.int16
+    assert len(payload) == np.sum(payload.mask)
+
+    loaded = SourcePayload.from_bytes(payload.to_bytes())
+    assert loaded.shape == image.shape and loaded.dtype == dtype
+    np.testing.assert_array_equal(loaded.bounds, payload.bounds)
+    np.testing.assert_array_equal(loaded.mask, \
+    cookie_mask(bounds, image.shape))
+    restored = loaded.restore(np.zeros_like(image))
+    np.testing.assert_array_equal(restored, np.where(loaded.mask, image, 0))
+
+
+def test_empty_source_payload_round_trip():
+    payload = SourcePayload.from_image(np.ones((8, 9)), \
+    cookie_bounds(np.zeros((0, 10)), (8, 9)))
+    loaded = SourcePayload.from_bytes(payload.to_bytes())
+    assert len(loaded) == 0 and loaded.shape == (8, 9)
+    assert not loaded.mask.any()
+
+
+def test_masking_keeps_the_sources():
+    rng = np.random.default_rng(8)
+    image = rng.integers(900, 1100, size=(60, 70)).astype(np.int32)
+    cat = np.zeros((1, 10))
+    cat[0, 1:5] = [30, 25, 5, 3]
+    sbit = ImageCompression(image, cat=cat)
+    masked = sbit.masking(8, save=False)
+    mask = sbit.payload.mask
+    np.testing.assert_array_equal(masked[mask], image[mask])
+    assert np.all(sbit.masked_image[mask] == 0)
+    assert sbit.payload_size > 0 and sbit.compressed_size > 0
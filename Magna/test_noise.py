@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from fake_stars import FakeStars
+from noise import draw_noise, NoiseEngine
+
+
+def test_gaussian_noise_statistics():
+    noise = draw_noise(np.random.default_rng(0), (400, 500), mean=29, std=10)
+    assert noise.dtype == np.float64
+    np.testing.assert_array_equal(noise, np.round(noise))
+    assert abs(noise.mean() - 29) < 0.1 and abs(noise.std() - 10) < 0.1
+
+
+def test_noise_is_written_into_out():
+    out = np.empty((50, 60), dtype=np.int16)
+    assert draw_noise(np.random.default_rng(1), std=5, out=out) is out
+    assert out.std() > 4
+    direct = np.empty((50, 60), dtype=np.float32)
+    assert draw_noise(np.random.default_rng(1), std=5, out=direct, \
+    rounded=False) is direct
+
+
+def test_poisson_and_read_noise():
+    signal = np.zeros((300, 300))
+    signal[:, 150:] = 400
+    rng = np.random.default_rng(2)
+    noise = draw_noise(rng, signal.shape, "poisson", mean=100, signal=signal, \
+    gain=2)
+    assert abs(noise[:, :150].mean() - 100) < 0.5
+    assert abs(noise[:, 150:].mean() - 100) < 0.5
+    # Shot noise of (signal + mean) * gain electrons, in ADU.
+    assert abs(noise[:, 150:].std() - np.sqrt(500 / 2)) < 0.5
+    read = draw_noise(rng, signal.shape, "read", mean=100, read_noise=20, \
+    rounded=False)
+    assert abs(read.std() - np.sqrt(100 + 400)) < 0.5
+    with pytest.raises(ValueError):
+        draw_noise(rng, signal.shape, "pink")
+
+
+def test_engine_streams():
+    engine = NoiseEngine((20, 30), seed=3)
+    frames = engine.stack(4)
+    again = NoiseEngine((20, 30), seed=3)
+    np.testing.assert_array_equal(frames, np.array(list( \
+    again.realizations(4))))
+    reused = list(NoiseEngine((20, 30), seed=3).realizations(2, reuse=True))
+    assert reused[0] is reused[1]
+    children = engine.spawn(2)
+    assert not np.array_equal(children[0].draw(), children[1].draw())
+    np.testing.assert_array_equal(NoiseEngine((20, 30), seed=3).spawn(2)[1] \
+    .draw(), NoiseEngine((20, 30), seed=3).spawn(2)[1].draw())
+
+
+def test_new_noise_keeps_the_sources():
+    fs = FakeStars("source", 60, 60, seed=4)
+    fs.create_single_source(bt=3000, xf=3, yf=3, sz=60)
+    noise = fs.noise
+    sources = fs.return_image() - fs.noise
+    old = fs.noise.copy()
+    fs.new_noise(std=10, mean=29)
+    assert fs.noise is noise and not np.array_equal(fs.noise, old)
+    np.testing.assert_allclose(fs.return_image() - fs.noise, sources, \
+    atol=1e-9)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from extractor import MomentExtractor
+from image_compression import ImageCompression
+from optimizer import FactorOptimizer, compress_bs, compress_hcomp, \
+training_set
+
+
+@pytest.fixture(scope="module")
+def optimizer():
+    images = [np.round(image) for image in training_set(12, bt=[300, 3, 3], \
+    seed=0)]
+    return FactorOptimizer(images, extractor=MomentExtractor(), min_sources=5)
+
+
+def test_rejects_empty_image_list():
+    with pytest.raises(ValueError):
+        FactorOptimizer([], extractor=MomentExtractor())
+
+
+def test_smallest_factor_passes(optimizer):
+    metrics = optimizer.evaluate("hcomp", 0)
+    assert metrics["passed"]
+    assert metrics["images"] == 12 and metrics["lost"] == 0
+
+
+def test_aggressive_factor_is_rejected_early(optimizer):
+    metrics = optimizer.evaluate("hcomp", 10000)
+    assert not metrics["passed"]
+    assert metrics["images"] < 12
+
+
+def test_optimize_returns_a_passing_factor(optimizer):
+    factor, metrics = optimizer.optimize("bs")
+    assert metrics["passed"]
+    assert factor is None or 1 <= factor <= 12
+    if factor is not None and factor < 12:
+        assert not optimizer.evaluate("bs", factor + 1)["passed"]
+
+
+def test_compress_bs_keeps_integer_values():
+    image = np.round(np.random.default_rng(0).normal(1000, 30, (20, 20)))
+    shaved, size = compress_bs(image, 2)
+    assert np.array_equal(shaved, np.round(shaved)) and size > 0
+    assert np.all((shaved - shaved.min()) % 4 == 0)
+
+
+@pytest.mark.parametrize("scale", [0, 2, 8])
+def test_compress_hcomp_matches_image_compression(scale):
+    image = np.random.default_rng(1).normal(1000, 30, (64, 64))
+    decompressed, size = compress_hcomp(image, scale)
+    sbit = ImageCompression(image, cat=np.zeros((0, 10)))
+    assert np.array_equal(decompressed, sbit.H_Compression(scale, save=False))
+    assert size == sbit.compressed_size
+
+
+def test_compress_bs_matches_image_compression():
+    image = np.random.default_rng(2).normal(1000, 30, (32, 32))
+    shaved, _ = compress_bs(image, 3)
+    sbit = ImageCompression(image, cat=np.zeros((0, 10)))
+    assert np.array_equal(shaved, sbit.bit_shaving(3, save=False))
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import pytest
+
+from extractor import MomentExtractor
+from pipeline import scenes, single_source_pipeline, threaded, IMAGE
+
+
+def test_scenes_are_seeded_per_item():
+    first = [item[IMAGE] for item in scenes(3, sz=30, seed=1)]
+    again = list(scenes(5, sz=30, seed=1))
+    assert [item["index"] for item in again] == [0, 1, 2, 3, 4]
+    for image, item in zip(first, again):
+        np.testing.assert_array_equal(image, item[IMAGE])
+    assert not np.array_equal(first[0], first[1])
+
+
+def test_threaded_pipeline_matches_serial(tmp_path):
+    kwargs = dict(sz=40, bt=[2000, 3, 3], sd=10, seed=2)
+    serial = list(single_source_pipeline(4, MomentExtractor(), "hcomp", 2, \
+    **kwargs))
+    overlapped = list(single_source_pipeline(4, MomentExtractor(), "hcomp", \
+    2, overlap=True, debug_dir=str(tmp_path), **kwargs))
+    assert [item["index"] for item in overlapped] == [0, 1, 2, 3]
+    for a, b in zip(serial, overlapped):
+        for key in ("image", "compressed", "og_cat", "cs_cat", "og_idx", \
+        "cs_idx"):
+            np.testing.assert_array_equal(a[key], b[key])
+        assert a["compressed_size"] == b["compressed_size"] > 0
+        assert len(a["og_idx"]) == 1
+    assert len(os.listdir(str(tmp_path))) == 8
+
+
+def test_threaded_raises_in_the_consumer():
+    def failing():
+        yield {"index": 0}
+        raise RuntimeError("stage failed")
+    items = threaded(failing())
+    assert next(items) == {"index": 0}
+    with pytest.raises(RuntimeError, match="stage failed"):
+        next(items)
+
+
+def test_threaded_stops_the_producer():
+    produced = []
+    def endless():
+        i = 0
+        while True:
+            produced.append(i)
+            yield i
+            i += 1
+    items = threaded(endless(), maxsize=2)
+    assert [next(items) for i in range(3)] == [0, 1, 2]
+    # Closing waits for the producer, which stops within a few items.
+    items.close()
+    assert len(produced) <= 3 + 2 + 2
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from fake_stars import FakeStars, gaussian_kernel
+from psf import PSFLibrary
+
+
+def sampled_gaussian(shape, center, xfwhm, yfwhm, btness):
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    return btness * np.exp(-4 * np.log(2) * ((x - center[0]) ** 2 / \
+    xfwhm ** 2 + (y - center[1]) ** 2 / yfwhm ** 2))
+
+
+@pytest.mark.parametrize("center", [(20, 20), (20.3, 17.75), (0.4, 39.2), \
+(-3.5, 12.0)])
+def test_render_matches_a_sampled_gaussian(center):
+    image = np.zeros((40, 41))
+    PSFLibrary(phases=None).render(image, center, 3, 2, 500)
+    np.testing.assert_allclose(image, \
+    sampled_gaussian(image.shape, center, 3, 2, 500), atol=1e-9)
+
+
+def test_phases_round_the_centre():
+    image = np.zeros((30, 30))
+    PSFLibrary(phases=4).render(image, (10.3, 12.9), 2, 2, 100)
+    np.testing.assert_allclose(image, \
+    sampled_gaussian(image.shape, (10.25, 13.0), 2, 2, 100), atol=1e-9)
+
+
+def test_integrated_profiles_hold_the_flux():
+    library = PSFLibrary(integrate=True)
+    kernel = library.kernel(61, 4, 6, center=(30.2, 29.6))
+    fwhm_to_sigma = 1 / (2 * np.sqrt(2 * np.log(2)))
+    flux = 2 * np.pi * (4 * fwhm_to_sigma) * (6 * fwhm_to_sigma)
+    np.testing.assert_allclose(kernel.sum(), flux, rtol=1e-9)
+
+
+def test_profiles_are_cached():
+    library = PSFLibrary()
+    first = library.profile(3, 10.5)[1]
+    assert library.profile(3, 42.5)[1] is first
+    assert not first.flags.writeable
+
+
+def test_create_2d_gaussian_centres():
+    fs = FakeStars("source", 10, 10)
+    np.testing.assert_allclose(fs.create_2d_gaussian(21, 3, 5, btness=300), \
+    gaussian_kernel(21, 3, 5, 300))
+    np.testing.assert_allclose(fs.create_2d_gaussian(21, 3, 5, (10, 10), \
+    300), gaussian_kernel(21, 3, 5, 300), atol=1e-9)
@@ -0,0 +1,102 @@
+import numpy as np
+from astropy.io import fits
+
+import image_compression
+import se_experiment
+from extractor import MomentExtractor
+from se_experiment import SE_Comparison, split_mosaic
+
+
+def test_run_im_experiment_reads_the_image_once(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    image = np.round(rng.normal(1000, 10, size=(80, 90)))
+    image[30:35, 40:45] += 500
+    fits.PrimaryHDU(data=image).writeto(str(tmp_path / "frame.fits"))
+
+    reads = []
+    original_read_image = image_compression.read_image
+    def read_image(path):
+        reads.append(path)
+        return original_read_image(path)
+    monkeypatch.setattr(se_experiment, "OG_SOURCE", str(tmp_path))
+    monkeypatch.setattr(se_experiment, "read_image", read_image)
+    monkeypatch.setattr(image_compression, "read_image", read_image)
+
+    comparison = SE_Comparison(0, "hcomp", extractor=MomentExtractor())
+    comparison.run_im_experiment("frame.fits")
+    assert len(reads) == 1
+    assert len(comparison.og_cat) == 1
+    np.testing.assert_allclose(comparison.cs_cat[:, 1:3], \
+    comparison.og_cat[:, 1:3], atol=0.05)
+
+
+def test_run_ss_parallel_does_not_depend_on_the_workers():
+    runs = []
+    for workers in (1, 3):
+        comparison = SE_Comparison(2, "hcomp", extractor=MomentExtractor())
+        comparison.run_ss_parallel(6, sd=10, bt=[2000, 3, 3], sz=40, \
+        workers=workers, seed=11)
+        assert comparison.seed == 11 and len(comparison.og_sources) == 6
+        runs.append(comparison)
+    for index in range(10):
+        np.testing.assert_array_equal(runs[0].og_dict[index], \
+        runs[1].og_dict[index])
+        np.testing.assert_array_equal(runs[0].comp_dict[index], \
+        runs[1].comp_dict[index])
+    # Every trial has its own seed, so the noise (and the fluxes) differ.
+    assert len(set(runs[0].og_dict[1])) == 6
+
+
+class RightHalfExtractor(MomentExtractor):
+    # Only finds the sources right of the centre of the image (positions
+    # start at 1), so about half of the randomly placed sources are missed.
+    def extract(self, image):
+        catalog = MomentExtractor.extract(self, image)
+        return catalog[catalog[:, 1] > image.shape[1] / 2 + 1]
+
+
+def test_run_ss_parallel_records_missed_trials():
+    comparison = SE_Comparison(0, "hcomp", extractor=RightHalfExtractor())
+    comparison.run_ss_parallel(12, sd=10, rp=True, bt=[2000, 3, 3], sz=40, \
+    workers=2, seed=3)
+    assert 0 < len(comparison.missed) < 12
+    assert len(comparison.og_sources) + len(comparison.missed) == 12
+
+
+def test_split_mosaic_gives_sources_to_their_cell():
+    sz, guard = 30, 10
+    cell = sz + guard
+    # Stamp i is at guard + (i % 2) * cell, guard + (i // 2) * cell.
+    catalog = np.zeros((4, 10))
+    catalog[:, 0] = [1, 2, 3, 4]
+    catalog[:, 1] = [1 + guard + 12, 1 + guard + cell + 5, \
+    1 + guard + 20, 1 + 2 * cell + guard + 8]
+    catalog[:, 2] = [1 + guard + 15, 1 + guard + 3, 1 + guard + cell + 7, \
+    1 + guard + 9]
+    cells = split_mosaic(catalog, 3, sz, guard)
+    assert len(cells) == 3
+    np.testing.assert_array_equal(cells[0][0], [1])
+    np.testing.assert_array_equal(cells[0][1], [1 + 12])
+    np.testing.assert_array_equal(cells[0][2], [1 + 15])
+    np.testing.assert_array_equal(cells[1][1], [1 + 5])
+    np.testing.assert_array_equal(cells[2][1:3], [[1 + 20], [1 + 7]])
+    # Outside of the 2 columns of cells.
+    assert 4 not in np.concatenate([c[0] for c in cells])
+
+
+def test_run_ss_batched_finds_every_source():
+    runs = []
+    for workers in (1, 2):
+        comparison = SE_Comparison(0, "hcomp", extractor=MomentExtractor())
+        comparison.run_ss_batched(7, batch=4, sd=10, bt=[2000, 3, 3], sz=40, \
+        workers=workers, seed=5)
+        assert comparison.missed == [] and len(comparison.og_sources) == 7
+        runs.append(comparison)
+    for index in range(10):
+        np.testing.assert_array_equal(runs[0].og_dict[index], \
+        runs[1].og_dict[index])
+    # The sources are in the centre of their stamp (SExtractor positions).
+    np.testing.assert_allclose(runs[0].og_dict[2], 21, atol=1)
+    np.testing.assert_allclose(runs[0].og_dict[3], 21, atol=1)
+    np.testing.assert_allclose(runs[0].comp_dict[2], runs[0].og_dict[2], \
+    atol=0.01)